@@ -1,47 +1,53 @@
 from django.contrib import admin
-from django.http import HttpResponse
-from .models import UserEmail, EmailTemplate, SiteSettings
-import openpyxl
+from .models import UserEmail, RecipientAttribute, EmailTemplate, SiteSettings, Campaign, OutboundMessage, DeliveryRecord, Suppression, RelayProfile
+from .exporters import csv_export_response, xlsx_export_response
+from . import stats
+from .search import search_emails
 from datetime import datetime
 
 
+class RecipientAttributeInline(admin.TabularInline):
+    model = RecipientAttribute
+    extra = 0
+
+
 @admin.register(UserEmail)
 class UserEmailAdmin(admin.ModelAdmin):
     list_display = ("username", "email")
+    inlines = [RecipientAttributeInline]
     search_fields = ("username", "email")
     ordering = ("username",)
-    actions = ["export_to_excel"]
+    actions = ["export_to_excel", "export_to_csv"]
+
+    def get_search_results(self, request, queryset, search_term):
+        return search_emails(queryset, search_term), False
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        stats.recipients_removed(1)
+
+    def delete_queryset(self, request, queryset):
+        _, deleted = queryset.delete()
+        stats.recipients_removed(deleted.get(UserEmail._meta.label, 0))
 
     def export_to_excel(self, request, queryset):
         """
         Export selected UserEmail objects to an Excel file.
         """
-        # Create a new workbook and select the active sheet
-        workbook = openpyxl.Workbook()
-        sheet = workbook.active
-        sheet.title = "User Emails"
-
-        # Define headers
-        headers = ["Username", "Email"]
-        sheet.append(headers)
-
-        # Add data from queryset
-        for user in queryset:
-            sheet.append([user.username, user.email])
-
-        # Prepare response with Excel file
-        response = HttpResponse(
-            content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        response["Content-Disposition"] = f"attachment; filename=user_emails_{timestamp}.xlsx"
-
-        # Save workbook to response
-        workbook.save(response)
-        return response
+        return xlsx_export_response(queryset, f"user_emails_{timestamp}.xlsx")
 
     export_to_excel.short_description = "Export selected users to Excel"
 
+    def export_to_csv(self, request, queryset):
+        """
+        Stream selected UserEmail objects as a CSV file.
+        """
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        return csv_export_response(queryset, f"user_emails_{timestamp}.csv")
+
+    export_to_csv.short_description = "Export selected users to CSV"
+
 
 @admin.register(EmailTemplate)
 class EmailTemplateAdmin(admin.ModelAdmin):
@@ -68,7 +74,7 @@ class SiteSettingsAdmin(admin.ModelAdmin):
         }),
         ("SMTP Settings", {
             "fields": ("email_host", "email_port", "email_use_tls", "email_use_ssl"),
-            "description": "Configure your SMTP server details."
+            "description": "Configure your SMTP server details. Used when no relay profiles are active."
         }),
         ("Authentication", {
             "fields": ("email_host_user", "email_host_password"),
@@ -78,10 +84,78 @@ class SiteSettingsAdmin(admin.ModelAdmin):
             "fields": ("default_from_email",),
             "description": "Set the default email sender address."
         }),
+        ("Sending Limits", {
+            "fields": ("rate_limit_per_second", "rate_limit_per_minute", "rate_limit_per_day"),
+            "description": "Throttle delivery to stay within your provider's sending quotas."
+        }),
     )
 
     def has_add_permission(self, request):
         """
-        Prevent multiple SiteSettings objects. Only one should exist.
+        Prevent multiple SiteSettings objects. Only one should exist; extra
+        relays are added as Relay Profiles.
         """
-        return not SiteSettings.objects.exists()
\ No newline at end of file
+        return not SiteSettings.objects.exists()
+
+
+@admin.register(RelayProfile)
+class RelayProfileAdmin(admin.ModelAdmin):
+    list_display = ("name", "email_host", "email_port", "weight", "rate_limit_per_day", "is_active")
+    list_filter = ("is_active",)
+    search_fields = ("name", "email_host", "email_host_user")
+    list_editable = ("weight", "is_active")
+    fieldsets = (
+        (None, {
+            "fields": ("name", "is_active", "weight"),
+            "description": "Campaigns are spread over all active relays in proportion to their weight."
+        }),
+        ("SMTP Settings", {
+            "fields": ("email_host", "email_port", "email_use_tls", "email_use_ssl"),
+        }),
+        ("Authentication", {
+            "fields": ("email_host_user", "email_host_password", "default_from_email"),
+        }),
+        ("Sending Limits", {
+            "fields": ("rate_limit_per_second", "rate_limit_per_minute", "rate_limit_per_day"),
+            "description": "This relay's own quotas; the limits in Site Settings still cap the total."
+        }),
+    )
+
+
+@admin.register(Campaign)
+class CampaignAdmin(admin.ModelAdmin):
+    list_display = (
+        "id", "template", "status", "total", "sent_count", "failed_count", "suppressed_count", "checkpoint_at",
+        "created_at",
+    )
+    list_filter = ("status",)
+    ordering = ("-created_at",)
+    readonly_fields = (
+        "total", "sent_count", "failed_count", "suppressed_count", "checkpoint", "checkpoint_at", "completed_at",
+    )
+
+
+@admin.register(OutboundMessage)
+class OutboundMessageAdmin(admin.ModelAdmin):
+    list_display = ("email", "campaign", "status", "attempts", "next_attempt_at", "sent_at")
+    list_filter = ("status",)
+    search_fields = ("email",)
+    raw_id_fields = ("campaign", "recipient")
+    readonly_fields = ("claimed_by", "claimed_at", "next_attempt_at", "created_at", "sent_at")
+
+
+@admin.register(DeliveryRecord)
+class DeliveryRecordAdmin(admin.ModelAdmin):
+    list_display = ("email", "campaign", "status", "smtp_code", "relay", "attempt", "finished_at")
+    list_filter = ("status", "relay")
+    search_fields = ("email",)
+    raw_id_fields = ("campaign", "message", "recipient")
+    readonly_fields = ("started_at", "finished_at")
+
+
+@admin.register(Suppression)
+class SuppressionAdmin(admin.ModelAdmin):
+    list_display = ("email", "reason", "created_at")
+    list_filter = ("reason",)
+    search_fields = ("email",)
+    readonly_fields = ("created_at",)
@@ -0,0 +1,374 @@
+import asyncio
+import base64
+import logging
+import re
+import smtplib
+import ssl
+import time
+
+from django.conf import settings
+from django.core.mail.message import sanitize_address
+
+from . import metrics
+from .backends import get_smtp_config
+from .mailer import DeliveryResult
+
+logger = logging.getLogger(__name__)
+
+_LINE_ENDINGS = re.compile(br'\r\n|\n|\r')
+_LEADING_DOT = re.compile(br'(?m)^\.')
+
+
+def _encode_body(data):
+    """
+    Normalise line endings to CRLF and dot-stuff the body for DATA.
+    """
+    data = _LINE_ENDINGS.sub(b'\r\n', data)
+    data = _LEADING_DOT.sub(b'..', data)
+    if not data.endswith(b'\r\n'):
+        data += b'\r\n'
+    return data + b'.\r\n'
+
+
+class AsyncSMTPSession:
+    """
+    A single ESMTP session on asyncio streams.
+
+    Errors are raised as the matching smtplib exceptions so callers can treat
+    failures exactly like those from Django's SMTP backend. When the server
+    advertises PIPELINING, MAIL/RCPT/DATA for a message go out in one write
+    and cost one round trip instead of three or more.
+    """
+
+    def __init__(self, host, port, username='', password='', use_tls=False,
+                 use_ssl=False, timeout=None, local_hostname='localhost'):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.local_hostname = local_hostname
+        self.extensions = {}
+        self.reader = None
+        self.writer = None
+
+    @property
+    def pipelining(self):
+        return 'pipelining' in self.extensions
+
+    async def connect(self):
+        ssl_context = ssl.create_default_context() if (self.use_ssl or self.use_tls) else None
+        with metrics.stage('connect'):
+            try:
+                self.reader, self.writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port, ssl=ssl_context if self.use_ssl else None),
+                    self.timeout,
+                )
+            except asyncio.TimeoutError:
+                raise smtplib.SMTPConnectError(-1, b"Timed out connecting to SMTP server")
+            code, msg = await self._read_reply()
+            if code != 220:
+                await self.close()
+                raise smtplib.SMTPConnectError(code, msg)
+
+        with metrics.stage('handshake'):
+            await self._ehlo()
+            if self.use_tls:
+                if 'starttls' not in self.extensions:
+                    raise smtplib.SMTPNotSupportedError("STARTTLS extension not supported by server.")
+                code, msg = await self._command('STARTTLS')
+                if code != 220:
+                    raise smtplib.SMTPResponseException(code, msg)
+                await self.writer.start_tls(ssl_context, server_hostname=self.host)
+                await self._ehlo()
+            if self.username and self.password:
+                await self._login()
+
+    async def _read_reply(self):
+        lines = []
+        while True:
+            try:
+                line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+            except asyncio.TimeoutError:
+                raise smtplib.SMTPServerDisconnected("Timed out waiting for SMTP reply")
+            if not line:
+                raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+            try:
+                code = int(line[:3])
+            except ValueError:
+                raise smtplib.SMTPServerDisconnected(f"Malformed SMTP reply: {line!r}")
+            lines.append(line[4:].strip())
+            if line[3:4] != b'-':
+                return code, b'\n'.join(lines)
+
+    async def _command(self, command):
+        self.writer.write(command.encode('utf-8') + b'\r\n')
+        await self.writer.drain()
+        return await self._read_reply()
+
+    async def _ehlo(self):
+        code, msg = await self._command(f'EHLO {self.local_hostname}')
+        self.extensions = {}
+        if code != 250:
+            code, msg = await self._command(f'HELO {self.local_hostname}')
+            if code != 250:
+                raise smtplib.SMTPHeloError(code, msg)
+            return
+        for line in msg.decode('latin-1').split('\n')[1:]:
+            keyword, _, params = line.partition(' ')
+            self.extensions[keyword.lower()] = params
+
+    async def _login(self):
+        mechanisms = self.extensions.get('auth', '').upper().split()
+        if 'PLAIN' in mechanisms or not mechanisms:
+            token = base64.b64encode(f'\0{self.username}\0{self.password}'.encode('utf-8')).decode('ascii')
+            code, msg = await self._command(f'AUTH PLAIN {token}')
+        else:
+            code, msg = await self._command('AUTH LOGIN')
+            if code == 334:
+                code, msg = await self._command(base64.b64encode(self.username.encode('utf-8')).decode('ascii'))
+            if code == 334:
+                code, msg = await self._command(base64.b64encode(self.password.encode('utf-8')).decode('ascii'))
+        if code not in (235, 503):
+            raise smtplib.SMTPAuthenticationError(code, msg)
+
+    async def sendmail(self, from_addr, to_addrs, data):
+        """
+        Send one message. Returns the dict of refused recipients, like
+        smtplib.SMTP.sendmail, and raises if nobody accepted it.
+        """
+        commands = [f'MAIL FROM:<{from_addr}>'] + [f'RCPT TO:<{rcpt}>' for rcpt in to_addrs] + ['DATA']
+        replies = []
+        if self.pipelining:
+            self.writer.write(b''.join(command.encode('utf-8') + b'\r\n' for command in commands))
+            await self.writer.drain()
+            for _ in commands:
+                replies.append(await self._read_reply())
+        else:
+            for command in commands:
+                if command == 'DATA' and all(code not in (250, 251) for code, _ in replies[1:]):
+                    # Every RCPT was refused; don't open a body nobody gets.
+                    replies.append((554, b"No valid recipients"))
+                    break
+                reply = await self._command(command)
+                replies.append(reply)
+                if command.startswith('MAIL') and reply[0] != 250:
+                    break
+
+        code, msg = replies[0]
+        if code != 250:
+            await self._rset(data_pending=len(replies) == len(commands) and replies[-1][0] == 354)
+            raise smtplib.SMTPSenderRefused(code, msg, from_addr)
+
+        refused = {}
+        for rcpt, (code, msg) in zip(to_addrs, replies[1:-1]):
+            if code not in (250, 251):
+                refused[rcpt] = (code, msg)
+
+        code, msg = replies[-1]
+        if len(refused) == len(to_addrs):
+            await self._rset(data_pending=code == 354)
+            raise smtplib.SMTPRecipientsRefused(refused)
+        if code != 354:
+            await self._rset()
+            raise smtplib.SMTPDataError(code, msg)
+
+        self.writer.write(_encode_body(data))
+        await self.writer.drain()
+        code, msg = await self._read_reply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, msg)
+        return refused
+
+    async def _rset(self, data_pending=False):
+        try:
+            if data_pending:
+                # The server already said 354, so end the (empty) body first.
+                self.writer.write(b'.\r\n')
+                await self.writer.drain()
+                await self._read_reply()
+            await self._command('RSET')
+        except smtplib.SMTPServerDisconnected:
+            pass
+
+    async def send_message(self, message, default_from_email):
+        encoding = message.encoding or settings.DEFAULT_CHARSET
+        from_email = sanitize_address(message.from_email or default_from_email, encoding)
+        recipients = [sanitize_address(addr, encoding) for addr in message.recipients()]
+        if not recipients:
+            raise ValueError("Message has no recipients")
+        if message.from_email is None:
+            message.from_email = default_from_email
+        with metrics.stage('serialize'):
+            data = message.message().as_bytes(linesep='\r\n')
+        with metrics.stage('transmit'):
+            return await self.sendmail(from_email, recipients, data)
+
+    async def quit(self):
+        try:
+            await self._command('QUIT')
+        except (smtplib.SMTPException, OSError):
+            pass
+        await self.close()
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (OSError, ssl.SSLError):
+                pass
+            self.writer = None
+            self.reader = None
+
+
+class AsyncDeliveryEngine:
+    """
+    Deliver messages over a pool of concurrent SMTP sessions.
+
+    Uses the same relay settings as DynamicSMTPBackend. Messages are fed to
+    the sessions through a bounded queue, so a lazy iterable of messages is
+    only rendered as fast as the relay accepts them; a ``limiter`` (see
+    sender.ratelimit) paces the sessions together. After deliver() returns,
+    ``sent``, ``failed``, ``elapsed`` and ``messages_per_second`` describe the
+    run.
+    """
+
+    def __init__(self, config=None, concurrency=None, max_per_connection=None, timeout=None, limiter=None):
+        self.config = dict(config) if config is not None else get_smtp_config()
+        if concurrency is None:
+            concurrency = getattr(settings, 'EMAIL_ASYNC_CONCURRENCY', 4)
+        if max_per_connection is None:
+            max_per_connection = getattr(settings, 'EMAIL_MAX_MESSAGES_PER_CONNECTION', 100)
+        if timeout is None:
+            timeout = getattr(settings, 'EMAIL_TIMEOUT', None) or 30
+        self.concurrency = max(1, concurrency)
+        self.max_per_connection = max_per_connection
+        self.timeout = timeout
+        self.limiter = limiter
+        self.sent = 0
+        self.failed = 0
+        self.elapsed = 0.0
+
+    @property
+    def messages_per_second(self):
+        return self.sent / self.elapsed if self.elapsed else 0.0
+
+    def _session(self):
+        return AsyncSMTPSession(
+            host=self.config['host'],
+            port=self.config['port'],
+            username=self.config.get('username', ''),
+            password=self.config.get('password', ''),
+            use_tls=self.config.get('use_tls', False),
+            use_ssl=self.config.get('use_ssl', False),
+            timeout=self.timeout,
+        )
+
+    async def _open(self):
+        session = self._session()
+        try:
+            await session.connect()
+        except BaseException:
+            await session.close()
+            raise
+        metrics.CONNECTIONS.inc(engine='async')
+        return session
+
+    async def _worker(self, queue, results):
+        default_from_email = self.config.get('default_from_email')
+        session = None
+        sent_on_session = 0
+        open_error = None
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                index, message = item
+                if open_error is not None:
+                    results[index] = DeliveryResult(message, False, open_error)
+                    continue
+
+                if session is not None and self.max_per_connection and sent_on_session >= self.max_per_connection:
+                    await session.quit()
+                    session = None
+
+                if session is None:
+                    try:
+                        session = await self._open()
+                        sent_on_session = 0
+                    except Exception as e:
+                        logger.exception("Could not open SMTP connection")
+                        open_error = e
+                        results[index] = DeliveryResult(message, False, e)
+                        continue
+
+                if self.limiter is not None:
+                    await self.limiter.wait_async()
+                try:
+                    try:
+                        await session.send_message(message, default_from_email)
+                    except smtplib.SMTPServerDisconnected:
+                        logger.info("SMTP server closed the session, reconnecting")
+                        metrics.RECONNECTS.inc(engine='async')
+                        await session.close()
+                        session = None
+                        session = await self._open()
+                        sent_on_session = 0
+                        await session.send_message(message, default_from_email)
+                except Exception as e:
+                    logger.exception("Error sending to %s", ', '.join(message.to))
+                    results[index] = DeliveryResult(message, False, e)
+                    if session is not None and isinstance(e, (smtplib.SMTPServerDisconnected, ConnectionError)):
+                        await session.close()
+                        session = None
+                    continue
+
+                sent_on_session += 1
+                results[index] = DeliveryResult(message, True, None)
+        finally:
+            if session is not None:
+                await session.quit()
+
+    async def deliver(self, messages):
+        """
+        Send every message and return DeliveryResults in input order.
+        """
+        results = {}
+        # Twice the pool size keeps every session busy while still applying
+        # backpressure to whatever produces the messages.
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        started = time.perf_counter()
+        workers = [asyncio.create_task(self._worker(queue, results)) for _ in range(self.concurrency)]
+        try:
+            count = 0
+            for item in enumerate(messages):
+                await queue.put(item)
+                count += 1
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+        self.elapsed = time.perf_counter() - started
+
+        ordered = [results[index] for index in range(count)]
+        self.sent = sum(1 for result in ordered if result.sent)
+        self.failed = count - self.sent
+        logger.info(
+            "Delivered %d messages (%d failed) in %.2fs, %.1f msg/s over %d sessions",
+            self.sent, self.failed, self.elapsed, self.messages_per_second, self.concurrency,
+        )
+        return ordered
+
+
+def deliver_messages(messages, concurrency=None, config=None, limiter=None):
+    """
+    Synchronous entry point: deliver messages with an AsyncDeliveryEngine.
+    """
+    engine = AsyncDeliveryEngine(config=config, concurrency=concurrency, limiter=limiter)
+    return asyncio.run(engine.deliver(messages))
@@ -1,42 +1,113 @@
+import smtplib
+import time
+
 from django.core.mail.backends.smtp import EmailBackend as SMTPBackend
+from django.core.mail.message import sanitize_address
 from django.conf import settings
-from .models import SiteSettings
+from . import metrics
+from .site_config import get_site_settings
+
+
+class _TimedConnect:
+    # smtplib connects from __init__ (TCP, TLS for SMTP_SSL, the greeting);
+    # timing connect() tells that apart from the EHLO/STARTTLS/AUTH that
+    # EmailBackend.open() does next.
+    def connect(self, *args, **kwargs):
+        with metrics.stage('connect'):
+            code, msg = super().connect(*args, **kwargs)
+        self.connected_at = time.perf_counter()
+        return code, msg
+
+
+class TimedSMTP(_TimedConnect, smtplib.SMTP):
+    pass
+
+
+class TimedSMTP_SSL(_TimedConnect, smtplib.SMTP_SSL):
+    pass
+
+
+def get_smtp_config():
+    """
+    Resolve the SMTP relay settings, preferring SiteSettings over settings.py.
+    """
+    site_settings = get_site_settings()
+    if site_settings is not None:
+        host = site_settings.email_host or getattr(settings, 'EMAIL_HOST', 'smtp.gmail.com')
+        port = site_settings.email_port or getattr(settings, 'EMAIL_PORT', 587)
+        username = site_settings.email_host_user or getattr(settings, 'EMAIL_HOST_USER', '')
+        password = site_settings.email_host_password or getattr(settings, 'EMAIL_HOST_PASSWORD', '')
+        use_tls = site_settings.email_use_tls if site_settings.email_use_tls is not None else getattr(settings, 'EMAIL_USE_TLS', True)
+        use_ssl = site_settings.email_use_ssl if site_settings.email_use_ssl is not None else getattr(settings, 'EMAIL_USE_SSL', False)
+        default_from_email = site_settings.default_from_email or getattr(settings, 'DEFAULT_FROM_EMAIL', 'no-reply@example.com')
+    else:
+        host = getattr(settings, 'EMAIL_HOST', 'smtp.gmail.com')
+        port = getattr(settings, 'EMAIL_PORT', 587)
+        username = getattr(settings, 'EMAIL_HOST_USER', '')
+        password = getattr(settings, 'EMAIL_HOST_PASSWORD', '')
+        use_tls = getattr(settings, 'EMAIL_USE_TLS', True)
+        use_ssl = getattr(settings, 'EMAIL_USE_SSL', False)
+        default_from_email = getattr(settings, 'DEFAULT_FROM_EMAIL', 'no-reply@example.com')
+
+    return {
+        'host': host,
+        'port': port,
+        'username': username,
+        'password': password,
+        'use_tls': use_tls,
+        'use_ssl': use_ssl,
+        'default_from_email': default_from_email,
+    }
 
 
 class DynamicSMTPBackend(SMTPBackend):
-    def __init__(self, *args, **kwargs):
-        try:
-            site_settings = SiteSettings.objects.get()
-            host = site_settings.email_host or getattr(settings, 'EMAIL_HOST', 'smtp.gmail.com')
-            port = site_settings.email_port or getattr(settings, 'EMAIL_PORT', 587)
-            username = site_settings.email_host_user or getattr(settings, 'EMAIL_HOST_USER', '')
-            password = site_settings.email_host_password or getattr(settings, 'EMAIL_HOST_PASSWORD', '')
-            use_tls = site_settings.email_use_tls if site_settings.email_use_tls is not None else getattr(settings, 'EMAIL_USE_TLS', True)
-            use_ssl = site_settings.email_use_ssl if site_settings.email_use_ssl is not None else getattr(settings, 'EMAIL_USE_SSL', False)
-            default_from_email = site_settings.default_from_email or getattr(settings, 'DEFAULT_FROM_EMAIL', 'no-reply@example.com')
-        except SiteSettings.DoesNotExist:
-            host = getattr(settings, 'EMAIL_HOST', 'smtp.gmail.com')
-            port = getattr(settings, 'EMAIL_PORT', 587)
-            username = getattr(settings, 'EMAIL_HOST_USER', '')
-            password = getattr(settings, 'EMAIL_HOST_PASSWORD', '')
-            use_tls = getattr(settings, 'EMAIL_USE_TLS', True)
-            use_ssl = getattr(settings, 'EMAIL_USE_SSL', False)
-            default_from_email = getattr(settings, 'DEFAULT_FROM_EMAIL', 'no-reply@example.com')
+    def __init__(self, *args, relay=None, **kwargs):
+        # ``relay`` is a resolved config dict (see sender.relays) to use
+        # instead of the SiteSettings relay.
+        config = dict(relay) if relay is not None else get_smtp_config()
+        default_from_email = config.pop('default_from_email')
 
         super().__init__(
-            host=host,
-            port=port,
-            username=username,
-            password=password,
-            use_tls=use_tls,
-            use_ssl=use_ssl,
             *args,
+            **config,
             **kwargs
         )
         self.default_from_email = default_from_email
 
+    def open(self):
+        if self.connection:
+            # send_messages() calls open() for every batch; only time real connects.
+            return False
+        opened = super().open()
+        if opened:
+            metrics.observe_stage('handshake', time.perf_counter() - self.connection.connected_at)
+            metrics.CONNECTIONS.inc(engine='smtp')
+        return opened
+
+    @property
+    def connection_class(self):
+        return TimedSMTP_SSL if self.use_ssl else TimedSMTP
+
+    def _send(self, email_message):
+        # Same as SMTPBackend._send, split into timed stages.
+        if not email_message.recipients():
+            return False
+        encoding = email_message.encoding or settings.DEFAULT_CHARSET
+        from_email = sanitize_address(email_message.from_email, encoding)
+        recipients = [sanitize_address(addr, encoding) for addr in email_message.recipients()]
+        with metrics.stage('serialize'):
+            data = email_message.message().as_bytes(linesep='\r\n')
+        try:
+            with metrics.stage('transmit'):
+                self.connection.sendmail(from_email, recipients, data)
+        except smtplib.SMTPException:
+            if not self.fail_silently:
+                raise
+            return False
+        return True
+
     def send_messages(self, email_messages):
         for message in email_messages:
             if message.from_email is None:
                 message.from_email = self.default_from_email
-        return super().send_messages(email_messages)
\ No newline at end of file
+        return super().send_messages(email_messages)
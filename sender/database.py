@@ -0,0 +1,77 @@
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+# Applied to every new SQLite connection; SQLITE_PRAGMAS entries override
+# these, and an entry set to None leaves SQLite's own default in place.
+DEFAULT_PRAGMAS = {
+    # Readers no longer block the writer or each other; persistent per file.
+    'journal_mode': 'WAL',
+    # Durable at every checkpoint, without an fsync per commit.
+    'synchronous': 'NORMAL',
+    # Negative sizes are in KiB: 64 MiB of page cache per connection.
+    'cache_size': -65536,
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+    # Milliseconds a statement waits for a lock before "database is locked".
+    'busy_timeout': 30000,
+}
+
+_lane = threading.RLock()
+
+
+def get_pragmas():
+    pragmas = dict(DEFAULT_PRAGMAS)
+    pragmas.update(getattr(settings, 'SQLITE_PRAGMAS', {}))
+    return {name: value for name, value in pragmas.items() if value is not None}
+
+
+def configure_connection(connection):
+    """
+    Apply the configured pragmas to a freshly opened SQLite connection.
+    """
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for name, value in get_pragmas().items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+
+
+@contextmanager
+def write_lane(using=None):
+    """
+    Run a block as a write transaction, one lane per process.
+
+    SQLite has a single writer. A default (deferred) transaction that reads
+    before it writes can't wait for that lock: when another connection is
+    writing it fails straight away with "database is locked". Transactions
+    in the lane start with BEGIN IMMEDIATE, so they queue for the lock under
+    busy_timeout instead, and threads of one process take turns here rather
+    than all polling SQLite. Callers keep each block to one chunk of work so
+    readers and the other writers get in between. Set SQLITE_WRITE_LANE =
+    False to fall back to plain transaction.atomic().
+    """
+    using = using or DEFAULT_DB_ALIAS
+    connection = connections[using]
+    if (
+        connection.vendor != 'sqlite'
+        or connection.in_atomic_block
+        or not getattr(settings, 'SQLITE_WRITE_LANE', True)
+    ):
+        with transaction.atomic(using=using):
+            yield
+        return
+
+    with _lane:
+        # Connecting resets transaction_mode from the settings, so connect first.
+        connection.ensure_connection()
+        configured = connection.transaction_mode
+        connection.transaction_mode = 'IMMEDIATE'
+        try:
+            with transaction.atomic(using=using):
+                connection.transaction_mode = configured
+                yield
+        finally:
+            connection.transaction_mode = configured
@@ -1,14 +1,24 @@
 from django import forms
-from .models import UserEmail, EmailTemplate, SiteSettings
+from django.template import Template, TemplateSyntaxError
+from .models import UserEmail, EmailTemplate, SiteSettings, normalize_email
+from .importers import SUPPORTED_EXTENSIONS
 
 
 class UploadExcelForm(forms.Form):
     excel_file = forms.FileField(
-        label='Upload Excel File',
-        help_text='Upload an Excel file containing "username" and "email" columns.',
-        widget=forms.FileInput(attrs={'accept': '.xlsx, .xls'})
+        label='Upload Contacts File',
+        help_text='Upload an Excel, CSV (optionally gzipped) or Parquet file containing "username" and "email" columns.',
+        widget=forms.FileInput(attrs={'accept': '.xlsx, .xls, .csv, .gz, .parquet'})
     )
 
+    def clean_excel_file(self):
+        uploaded = self.cleaned_data['excel_file']
+        if not uploaded.name.lower().endswith(SUPPORTED_EXTENSIONS):
+            raise forms.ValidationError(
+                f"Unsupported file type. Use one of: {', '.join(SUPPORTED_EXTENSIONS)}."
+            )
+        return uploaded
+
 
 class AddEmailForm(forms.ModelForm):
     class Meta:
@@ -19,6 +29,10 @@ class AddEmailForm(forms.ModelForm):
             'email': forms.EmailInput(attrs={'placeholder': 'Enter email address'}),
         }
 
+    def clean_email(self):
+        # Normalize before the uniqueness check so Bob@x.com matches bob@x.com.
+        return normalize_email(self.cleaned_data['email'])
+
 
 class EmailTemplateForm(forms.ModelForm):
     class Meta:
@@ -29,6 +43,16 @@ class EmailTemplateForm(forms.ModelForm):
             'html_content': forms.Textarea(attrs={'placeholder': 'Enter HTML content here', 'rows': 10}),
         }
 
+    def clean_html_content(self):
+        html_content = self.cleaned_data['html_content']
+        # Caught here, a typo in a tag is a form error instead of every
+        # message of the next campaign failing to render.
+        try:
+            Template(html_content)
+        except TemplateSyntaxError as e:
+            raise forms.ValidationError(f"Invalid template syntax: {e}")
+        return html_content
+
 
 class SiteSettingsForm(forms.ModelForm):
     class Meta:
@@ -42,6 +66,9 @@ class SiteSettingsForm(forms.ModelForm):
             'email_host_user',
             'email_host_password',
             'default_from_email',
+            'rate_limit_per_second',
+            'rate_limit_per_minute',
+            'rate_limit_per_day',
         ]
         widgets = {
             'email_backend': forms.TextInput(attrs={'placeholder': 'e.g., django.core.mail.backends.smtp.EmailBackend'}),
@@ -50,4 +77,7 @@ class SiteSettingsForm(forms.ModelForm):
             'email_host_user': forms.TextInput(attrs={'placeholder': 'e.g., your-email@example.com'}),
             'email_host_password': forms.PasswordInput(attrs={'placeholder': 'SMTP password or app-specific password'}),
             'default_from_email': forms.EmailInput(attrs={'placeholder': 'e.g., your-email@example.com'}),
+            'rate_limit_per_second': forms.NumberInput(attrs={'placeholder': 'e.g., 14'}),
+            'rate_limit_per_minute': forms.NumberInput(attrs={'placeholder': 'No limit'}),
+            'rate_limit_per_day': forms.NumberInput(attrs={'placeholder': 'e.g., 2000'}),
         }
\ No newline at end of file
@@ -0,0 +1,352 @@
+import os
+import re
+import time
+import uuid
+import zipfile
+from itertools import islice
+
+import pandas as pd
+from django.conf import settings
+from django.db.models.functions import Lower
+
+from . import stats
+from .database import write_lane
+from .models import RecipientAttribute, UserEmail, normalize_attribute_name
+
+IMPORT_CHUNK_SIZE = 500
+REQUIRED_COLUMNS = ('username', 'email')
+SUPPORTED_EXTENSIONS = ('.xlsx', '.xls', '.csv', '.csv.gz', '.parquet')
+# What pandas calls a column with an empty header cell.
+UNNAMED_COLUMN = re.compile(r'Unnamed: \d+')
+
+# Deliberately simpler than Django's validate_email so it can run as one
+# vectorised match over a whole column. Applied after lowercasing.
+EMAIL_PATTERN = (
+    r"[a-z0-9.!#$%&'*+/=?^_`{|}~-]+"
+    r"@(?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\.)+[a-z]{2,63}"
+)
+EMAIL_MAX_LENGTH = 254
+
+
+class ImportSummary:
+    def __init__(self):
+        self.inserted = 0
+        self.duplicates = 0
+        self.invalid = 0
+        self.attributes = 0
+        self.rejects_token = None
+
+    @property
+    def total(self):
+        return self.inserted + self.duplicates + self.invalid
+
+    def __str__(self):
+        text = f"{self.inserted} emails saved, {self.duplicates} duplicates skipped, {self.invalid} invalid rows"
+        if self.attributes:
+            text += f", {self.attributes} attribute values saved"
+        return text
+
+
+def _normalise_columns(columns):
+    return [str(name).strip().lower() if name is not None else '' for name in columns]
+
+
+def _column_positions(header):
+    names = _normalise_columns(header)
+    missing = [column for column in REQUIRED_COLUMNS if column not in names]
+    if missing:
+        raise ValueError(f"Missing required column(s): {', '.join(missing)}")
+    return [names.index(column) for column in REQUIRED_COLUMNS]
+
+
+def _attribute_positions(header):
+    """
+    Return (position, attribute name) for every extra column worth keeping.
+    """
+    positions = []
+    seen = set(REQUIRED_COLUMNS)
+    for position, column in enumerate(header):
+        if column is None or UNNAMED_COLUMN.match(str(column)):
+            continue
+        name = normalize_attribute_name(column)
+        if name and name not in seen:
+            seen.add(name)
+            positions.append((position, name))
+    return positions
+
+
+def _select_columns(df):
+    """
+    Return username, email and the attribute columns, under their stored names.
+    """
+    positions = _column_positions(df.columns)
+    attributes = _attribute_positions(df.columns)
+    selected = df.iloc[:, positions + [position for position, _ in attributes]]
+    selected.columns = list(REQUIRED_COLUMNS) + [name for _, name in attributes]
+    return selected
+
+
+def iter_excel_rows(excel_file):
+    """
+    Yield the column names (username, email, then any attribute columns),
+    followed by one tuple per row, from the first sheet of a workbook.
+
+    .xlsx files are read in openpyxl's read-only mode, which streams rows
+    from the archive instead of building the whole sheet in memory.
+    """
+    name = getattr(excel_file, 'name', '') or ''
+    if name.lower().endswith('.xls'):
+        # Legacy .xls can't be streamed, but the format caps out at 65k rows.
+        df = _select_columns(pd.read_excel(excel_file, dtype=str))
+        yield tuple(df.columns)
+        yield from df.itertuples(index=False, name=None)
+        return
+
+    import openpyxl
+    from openpyxl.utils.exceptions import InvalidFileException
+    try:
+        workbook = openpyxl.load_workbook(excel_file, read_only=True, data_only=True)
+    except (InvalidFileException, zipfile.BadZipFile, KeyError):
+        raise ValueError("The uploaded file is not a valid Excel workbook.")
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            raise ValueError("The uploaded file is empty.")
+        positions = _column_positions(header)
+        attributes = _attribute_positions(header)
+        positions += [position for position, _ in attributes]
+        yield tuple(REQUIRED_COLUMNS) + tuple(name for _, name in attributes)
+        for row in rows:
+            yield tuple(row[position] if position < len(row) else None for position in positions)
+    finally:
+        workbook.close()
+
+
+def iter_excel_chunks(excel_file, chunk_size=IMPORT_CHUNK_SIZE):
+    rows = iter_excel_rows(excel_file)
+    columns = list(next(rows))
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield pd.DataFrame(chunk, columns=columns, dtype=object)
+
+
+def iter_csv_chunks(csv_file, chunk_size=IMPORT_CHUNK_SIZE):
+    """
+    Read a CSV (optionally gzip-compressed) export in chunks.
+    """
+    name = (getattr(csv_file, 'name', '') or '').lower()
+    try:
+        reader = pd.read_csv(
+            # Hand pandas the underlying binary file; Django's UploadedFile
+            # wrapper isn't recognised as binary, which disables decompression.
+            getattr(csv_file, 'file', csv_file),
+            chunksize=chunk_size,
+            dtype=str,
+            keep_default_na=False,
+            compression='gzip' if name.endswith('.gz') else None,
+            encoding_errors='replace',
+        )
+        for df in reader:
+            yield _select_columns(df)
+    except (pd.errors.ParserError, pd.errors.EmptyDataError, UnicodeDecodeError, OSError) as e:
+        raise ValueError(f"The uploaded CSV file could not be read: {e}")
+
+
+def iter_parquet_chunks(parquet_file, chunk_size=IMPORT_CHUNK_SIZE):
+    """
+    Read a Parquet file one record batch at a time. Requires pyarrow.
+    """
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ValueError("Parquet import requires the pyarrow package to be installed.")
+    try:
+        parquet = pq.ParquetFile(parquet_file)
+    except Exception as e:
+        raise ValueError(f"The uploaded Parquet file could not be read: {e}")
+    _column_positions(parquet.schema_arrow.names)
+    for batch in parquet.iter_batches(batch_size=chunk_size):
+        yield _select_columns(batch.to_pandas())
+
+
+def iter_chunks(uploaded_file, chunk_size=IMPORT_CHUNK_SIZE):
+    """
+    Pick a reader from the file extension and yield DataFrame chunks.
+    """
+    name = (getattr(uploaded_file, 'name', '') or '').lower()
+    if name.endswith(('.csv', '.csv.gz')):
+        return iter_csv_chunks(uploaded_file, chunk_size)
+    if name.endswith('.parquet'):
+        return iter_parquet_chunks(uploaded_file, chunk_size)
+    return iter_excel_chunks(uploaded_file, chunk_size)
+
+
+def normalise_chunk(df):
+    """
+    Trim, lowercase and validate a chunk column-wise.
+
+    Returns (valid, rejected, duplicate_count): ``valid`` has unique, clean
+    username/email rows plus the trimmed attribute columns; ``rejected``
+    holds the original rows that failed validation plus a ``reason`` column.
+    """
+    email = df['email'].astype('string').str.strip().str.lower()
+    username = df['username'].astype('string').fillna('').str.strip().str.slice(0, 255)
+
+    missing = email.isna() | (email == '')
+    malformed = ~missing & ~(
+        email.str.fullmatch(EMAIL_PATTERN).fillna(False) & (email.str.len() <= EMAIL_MAX_LENGTH)
+    )
+    bad = (missing | malformed).astype(bool)
+
+    rejected = df.loc[bad].copy()
+    rejected['reason'] = 'invalid email'
+    rejected.loc[missing[bad].astype(bool), 'reason'] = 'missing email'
+
+    clean = pd.DataFrame({'username': username[~bad], 'email': email[~bad]})
+    for name in _attribute_columns(df):
+        clean[name] = df.loc[~bad, name].astype('string').fillna('').str.strip().str.slice(0, 255)
+    duplicated = clean['email'].duplicated()
+    return clean[~duplicated], rejected, int(duplicated.sum())
+
+
+def _attribute_columns(df):
+    return [name for name in df.columns if name not in REQUIRED_COLUMNS]
+
+
+def _ids_by_email(emails):
+    """
+    Map the given (normalized) addresses already in the table to their ids.
+
+    Compared the way the case-insensitive unique constraint compares them,
+    through its index, so a contact stored before addresses were normalized
+    still counts as existing.
+    """
+    return dict(
+        UserEmail.objects.annotate(normalized=Lower('email'))
+        .filter(normalized__in=emails)
+        .values_list('normalized', 'id')
+    )
+
+
+def _attribute_rows(valid, ids):
+    """
+    RecipientAttributes for a chunk's non-blank attribute cells.
+    """
+    emails = valid['email'].tolist()
+    rows = []
+    for name in _attribute_columns(valid):
+        for email, value in zip(emails, valid[name].tolist()):
+            if value and email in ids:
+                rows.append(RecipientAttribute(recipient_id=ids[email], name=name, value=value))
+    return rows
+
+
+class RejectsWriter:
+    """
+    Append rejected rows to a CSV under IMPORT_REJECTS_DIR.
+
+    The file is only created once there is something to write; ``token``
+    identifies it for the download view.
+    """
+
+    max_age = 24 * 60 * 60
+
+    def __init__(self):
+        self.directory = self.rejects_dir()
+        self.token = None
+        self._handle = None
+
+    @staticmethod
+    def rejects_dir():
+        return getattr(settings, 'IMPORT_REJECTS_DIR', settings.BASE_DIR / 'import_rejects')
+
+    @classmethod
+    def path_for(cls, token):
+        return os.path.join(cls.rejects_dir(), f"{token}.csv")
+
+    def write(self, rejected):
+        if rejected.empty:
+            return
+        header = self._handle is None
+        if header:
+            os.makedirs(self.directory, exist_ok=True)
+            self._purge_old_files()
+            self.token = uuid.uuid4().hex
+            self._handle = open(self.path_for(self.token), 'w', newline='', encoding='utf-8')
+        rejected.to_csv(self._handle, header=header, index=False)
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+
+    def _purge_old_files(self):
+        cutoff = time.time() - self.max_age
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.csv') and entry.stat().st_mtime < cutoff:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+
+def import_chunks(chunks):
+    """
+    Insert DataFrame chunks of username/email and return an ImportSummary.
+
+    Each chunk is validated column-wise, checked against the table with a
+    single query and written with one bulk insert in its own transaction,
+    so a 200k row file costs a few hundred queries instead of 400k.
+
+    Any other columns are stored as RecipientAttributes with one bulk
+    upsert per chunk, for new and already known contacts alike; a blank
+    cell leaves the contact's current value alone.
+    """
+    summary = ImportSummary()
+    rejects = RejectsWriter()
+    try:
+        for df in chunks:
+            valid, rejected, duplicates = normalise_chunk(df)
+            rejects.write(rejected)
+            summary.invalid += len(rejected)
+            summary.duplicates += duplicates
+
+            emails = valid['email'].tolist()
+            with write_lane():
+                existing = _ids_by_email(emails)
+                new_rows = [
+                    UserEmail(username=username, email=email)
+                    for username, email in zip(valid['username'].tolist(), emails)
+                    if email not in existing
+                ]
+                UserEmail.objects.bulk_create(new_rows, ignore_conflicts=True)
+                # The insert skips conflicting rows without saying which, and
+                # SQLite returns no ids from it, so the rows are looked up.
+                added = _ids_by_email([row.email for row in new_rows]) if new_rows else {}
+                stats.recipients_added(len(added))
+
+                if _attribute_columns(valid):
+                    attributes = _attribute_rows(valid, {**existing, **added})
+                    RecipientAttribute.objects.bulk_create(
+                        attributes,
+                        update_conflicts=True,
+                        unique_fields=['recipient', 'name'],
+                        update_fields=['value'],
+                    )
+                    summary.attributes += len(attributes)
+            summary.duplicates += len(existing) + len(new_rows) - len(added)
+            summary.inserted += len(added)
+    finally:
+        rejects.close()
+    summary.rejects_token = rejects.token
+    return summary
+
+
+def import_file(uploaded_file, chunk_size=IMPORT_CHUNK_SIZE):
+    return import_chunks(iter_chunks(uploaded_file, chunk_size))
+
+
+def import_excel(excel_file, chunk_size=IMPORT_CHUNK_SIZE):
+    return import_chunks(iter_excel_chunks(excel_file, chunk_size))
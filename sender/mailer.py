@@ -0,0 +1,189 @@
+import logging
+import smtplib
+import socket
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.template import Context
+from django.utils.html import strip_tags
+
+from . import metrics
+from .templating import get_compiled_template, get_split_template
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SUBJECT = "Hello from Django App"
+
+# One entry per message handed to send_batch(), in the same order.
+# ``relay`` names the relay profile that handled it, when there are several.
+DeliveryResult = namedtuple('DeliveryResult', ['message', 'sent', 'error', 'relay'], defaults=[None])
+
+
+def build_message(template, user_email, attributes=None):
+    """
+    Render the template for one recipient and wrap it in a multipart message.
+
+    ``attributes`` maps the recipient's RecipientAttribute names to values;
+    they are template variables next to ``username`` and ``email``, which
+    take precedence.
+    """
+    context = dict(attributes or ())
+    context['username'] = user_email.username
+    context['email'] = user_email.email
+    split = get_split_template(template)
+    if split is not None:
+        # Pre-rendered at save time: just join the static chunks.
+        with metrics.stage('render'):
+            html_content, text_content = split.render(context)
+    else:
+        with metrics.stage('render'):
+            html_content = get_compiled_template(template).render(Context(context))
+        with metrics.stage('strip_tags'):
+            text_content = strip_tags(html_content)
+
+    with metrics.stage('build'):
+        msg = EmailMultiAlternatives(
+            subject=DEFAULT_SUBJECT,
+            body=text_content,
+            from_email=None,  # Use dynamic DEFAULT_FROM_EMAIL from SiteSettings
+            to=[user_email.email]
+        )
+        msg.attach_alternative(html_content, "text/html")
+    return msg
+
+
+def describe_failure(result):
+    """
+    Human readable error line for a failed DeliveryResult.
+    """
+    if result.message is None:
+        return f"Could not build the message: {result.error}"
+    recipient = ', '.join(result.message.to)
+    if isinstance(result.error, smtplib.SMTPException):
+        return f"SMTP error sending to {recipient}: {result.error}"
+    return f"Unexpected error sending to {recipient}: {result.error}"
+
+
+def smtp_reply(error):
+    """
+    Return (code, text) of the SMTP reply behind a failure, or (None, '').
+    """
+    if isinstance(error, smtplib.SMTPRecipientsRefused) and error.recipients:
+        error = smtplib.SMTPResponseException(*next(iter(error.recipients.values())))
+    if isinstance(error, smtplib.SMTPResponseException):
+        text = error.smtp_error
+        if isinstance(text, bytes):
+            text = text.decode('utf-8', 'replace')
+        return (error.smtp_code if error.smtp_code > 0 else None), str(text)
+    return None, ''
+
+
+def is_transient(error):
+    """
+    Whether a failure is worth retrying later.
+
+    4xx replies (greylisting, mailbox busy, rate limited) and network
+    failures with no reply at all (refused or dropped connections, timeouts,
+    DNS lookups) are transient. 5xx replies, other SMTP errors (failed
+    authentication, no recipients left) and problems with the message itself
+    are not: retrying would fail the same way.
+    """
+    code, _ = smtp_reply(error)
+    if code is not None:
+        return 400 <= code < 500
+    if isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)):
+        return True
+    if isinstance(error, smtplib.SMTPException):
+        # Every SMTPException is an OSError, so rule the rest out first.
+        return False
+    return isinstance(error, (ConnectionError, TimeoutError, socket.gaierror))
+
+
+def _close_quietly(connection):
+    try:
+        connection.close()
+    except Exception:
+        logger.warning("Error while closing SMTP connection", exc_info=True)
+
+
+def _open(connection):
+    """
+    Open the session if it isn't already. A half-open session (e.g. the
+    connect worked but AUTH failed) is torn down so the error is re-raised
+    consistently instead of surfacing later as "please run connect() first".
+    """
+    if connection.connection is not None:
+        return
+    try:
+        connection.open()
+    except Exception:
+        _close_quietly(connection)
+        connection.connection = None
+        raise
+
+
+def _send_one(connection, message):
+    if connection.send_messages([message]) != 1:
+        raise ValueError("Message has no recipients")
+
+
+def send_batch(messages, connection=None, max_per_connection=None, limiter=None):
+    """
+    Send messages over a single SMTP connection and report each outcome.
+
+    The connection is recycled every ``max_per_connection`` messages
+    (EMAIL_MAX_MESSAGES_PER_CONNECTION by default) and re-opened once if the
+    relay drops the session mid-batch. A failing recipient never aborts the
+    rest of the batch. With a ``limiter`` (see sender.ratelimit) each message
+    waits for its turn before it is sent.
+    """
+    if max_per_connection is None:
+        max_per_connection = getattr(settings, 'EMAIL_MAX_MESSAGES_PER_CONNECTION', 100)
+    if connection is None:
+        connection = get_connection()
+
+    results = []
+    sent_on_connection = 0
+    open_error = None
+    try:
+        for message in messages:
+            if open_error is not None:
+                # The relay refused the session itself; don't hammer it.
+                results.append(DeliveryResult(message, False, open_error))
+                continue
+
+            if max_per_connection and sent_on_connection >= max_per_connection:
+                _close_quietly(connection)
+                sent_on_connection = 0
+
+            try:
+                _open(connection)
+            except Exception as e:
+                logger.exception("Could not open SMTP connection")
+                open_error = e
+                results.append(DeliveryResult(message, False, e))
+                continue
+
+            if limiter is not None:
+                limiter.wait()
+            try:
+                try:
+                    _send_one(connection, message)
+                except smtplib.SMTPServerDisconnected:
+                    logger.info("SMTP server closed the session, reconnecting")
+                    metrics.RECONNECTS.inc(engine='smtp')
+                    _close_quietly(connection)
+                    sent_on_connection = 0
+                    _open(connection)
+                    _send_one(connection, message)
+            except Exception as e:
+                logger.exception("Error sending to %s", ', '.join(message.to))
+                results.append(DeliveryResult(message, False, e))
+                continue
+
+            sent_on_connection += 1
+            results.append(DeliveryResult(message, True, None))
+    finally:
+        _close_quietly(connection)
+    return results
@@ -0,0 +1,408 @@
+import csv
+import gzip
+import io
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+
+import django
+import pandas as pd
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection
+from django.test import RequestFactory
+from django.test.utils import override_settings
+
+from sender import outbox, stats
+from sender.async_smtp import deliver_messages
+from sender.importers import IMPORT_CHUNK_SIZE, import_chunks, import_file
+from sender.mailer import DeliveryResult, send_batch
+from sender.models import EmailTemplate, OutboundMessage, SiteSettings, UserEmail
+from sender.pagination import encode_cursor
+from sender.smtp_sink import SMTPSink
+from sender.views import EmailListView, ajax_search
+
+INSERT_CHUNK_SIZE = 5000
+
+# What a stock SQLite connection gets, for the concurrency baseline: rollback
+# journal, an fsync per commit, the driver's 5s timeout and deferred writes.
+BASELINE_SETTINGS = {
+    'SQLITE_PRAGMAS': {
+        'journal_mode': 'DELETE',
+        'synchronous': 'FULL',
+        'cache_size': None,
+        'mmap_size': None,
+        'temp_store': None,
+        'busy_timeout': 5000,
+    },
+    'SQLITE_WRITE_LANE': False,
+}
+
+
+def summarise(samples):
+    """
+    Summarise wall times in milliseconds.
+    """
+    if not samples:
+        return {'runs': 0}
+    samples = sorted(samples)
+    return {
+        'runs': len(samples),
+        'min_ms': round(samples[0], 3),
+        'median_ms': round(statistics.median(samples), 3),
+        'p95_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 3),
+        'max_ms': round(samples[-1], 3),
+    }
+
+
+def timed(func, repeat):
+    """
+    Call ``func`` ``repeat`` times and summarise the wall time in milliseconds.
+    """
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - started) * 1000)
+    return summarise(samples)
+
+
+def instant_send(messages):
+    # Stands in for the relay so the concurrency run measures the database.
+    return [DeliveryResult(message, True, None) for message in messages]
+
+
+def synthetic_rows(start, stop, domain='example.test'):
+    for n in range(start, stop):
+        yield f"user{n}", f"user{n}@{domain}"
+
+
+class Command(BaseCommand):
+    help = (
+        "Time the app's hot paths (import, search, pagination, sending) on synthetic data "
+        "and write the results as JSON. Runs against a throwaway test database, so the "
+        "configured database is never touched."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipients', type=int, default=10000,
+                            help="Contacts in the table for the largest search/pagination run.")
+        parser.add_argument('--sizes', default='',
+                            help="Comma-separated table sizes for search and pagination "
+                                 "(default: 1%%, 10%% and 100%% of --recipients).")
+        parser.add_argument('--import-rows', type=int, default=5000,
+                            help="Rows in each generated CSV/Excel import file.")
+        parser.add_argument('--send', type=int, default=1000,
+                            help="Messages to push through the queue for each send engine.")
+        parser.add_argument('--smtp-delay', type=float, default=0.0,
+                            help="Seconds the SMTP sink waits per message, to mimic relay latency.")
+        parser.add_argument('--sessions', type=int, default=4,
+                            help="Concurrent sessions for the async engine.")
+        parser.add_argument('--repeat', type=int, default=20,
+                            help="Timed runs per search/pagination measurement.")
+        parser.add_argument('--concurrency-seconds', type=float, default=5.0,
+                            help="Length of each mixed read/write run (0 to skip).")
+        parser.add_argument('--readers', type=int, default=4,
+                            help="Search threads running during the mixed read/write run.")
+        parser.add_argument('--output', default='-',
+                            help="File to write the JSON results to ('-' for stdout).")
+
+    def handle(self, *args, **options):
+        if options['recipients'] < 1:
+            raise CommandError("--recipients must be at least 1.")
+        sizes = self.parse_sizes(options['sizes'], options['recipients'])
+
+        test_settings = connection.settings_dict['TEST']
+        workdir = None
+        if connection.vendor == 'sqlite' and not test_settings.get('NAME'):
+            # The default in-memory test database has neither a journal nor
+            # file locking, so it can't show what concurrent access costs.
+            workdir = tempfile.mkdtemp(prefix='sender-benchmark-')
+            test_settings['NAME'] = os.path.join(workdir, 'benchmark.sqlite3')
+
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            results = {
+                'meta': {
+                    'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                    'python': platform.python_version(),
+                    'django': django.get_version(),
+                    'database': connection.vendor,
+                    'sqlite': sqlite3.sqlite_version if connection.vendor == 'sqlite' else None,
+                    'options': {key: options[key] for key in (
+                        'recipients', 'import_rows', 'send', 'smtp_delay', 'sessions', 'repeat',
+                        'concurrency_seconds', 'readers',
+                    )},
+                },
+                'search': [],
+                'pagination': [],
+            }
+            self.factory = RequestFactory()
+            for size in sizes:
+                self.grow_to(size)
+                self.stderr.write(f"Benchmarking search and pagination at {size} contacts...")
+                results['search'].append(self.bench_search(size, options['repeat']))
+                results['pagination'].append(self.bench_pagination(size, options['repeat']))
+            self.stderr.write("Benchmarking imports...")
+            results['import'] = self.bench_import(options['import_rows'])
+            self.stderr.write("Benchmarking sending...")
+            results['send'] = self.bench_send(options['send'], options['smtp_delay'], options['sessions'])
+            if options['concurrency_seconds'] > 0 and connection.vendor == 'sqlite':
+                self.stderr.write("Benchmarking concurrent reads and writes...")
+                results['concurrency'] = self.bench_concurrency(
+                    options['concurrency_seconds'], options['readers'],
+                )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            if workdir:
+                test_settings['NAME'] = None
+                shutil.rmtree(workdir, ignore_errors=True)
+
+        output = json.dumps(results, indent=2)
+        if options['output'] == '-':
+            self.stdout.write(output)
+        else:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                f.write(output + '\n')
+            self.stderr.write(f"Results written to {options['output']}")
+
+    @staticmethod
+    def parse_sizes(value, recipients):
+        if value:
+            try:
+                sizes = [int(size) for size in value.split(',') if size.strip()]
+            except ValueError:
+                raise CommandError("--sizes must be a comma-separated list of integers.")
+        else:
+            sizes = [recipients // 100, recipients // 10, recipients]
+        return sorted({size for size in sizes if size > 0})
+
+    def grow_to(self, size):
+        current = UserEmail.objects.count()
+        for start in range(current, size, INSERT_CHUNK_SIZE):
+            stop = min(size, start + INSERT_CHUNK_SIZE)
+            UserEmail.objects.bulk_create(
+                [UserEmail(username=username, email=email) for username, email in synthetic_rows(start, stop)]
+            )
+        stats.recount()
+
+    def bench_search(self, size, repeat):
+        queries = {
+            'empty': '',
+            'short': 'us',
+            'common': 'user1',
+            'exact': f"user{size - 1}@example.test",
+            'no_match': 'nobody-here',
+        }
+        timings = {}
+        for label, query in queries.items():
+            request = self.factory.get('/ajax_search/', {'q': query, 'page_size': 10})
+            timings[label] = timed(lambda: ajax_search(request), repeat)
+        return {'size': size, 'queries': timings}
+
+    def bench_pagination(self, size, repeat):
+        view = EmailListView.as_view()
+        page_size = 50
+        timings = {}
+        for label, fraction in (('first', 0), ('middle', 0.5), ('last', 1)):
+            offset = min(size - 1, int(size * fraction))
+            params = {'page_size': page_size, 'sort_by': 'email'}
+            if offset:
+                # Build the cursor a user would hold after paging to this row.
+                row = UserEmail.objects.order_by('email', 'id')[offset - 1]
+                params['cursor'] = encode_cursor({'s': 'email:asc', 'k': row.email, 'i': row.pk, 'd': 'next'})
+            request = self.factory.get('/emails/', params)
+            timings[label] = dict(timed(lambda: view(request).render(), repeat), offset=offset)
+        return {'size': size, 'page_size': page_size, 'sort_by': 'email', 'pages': timings}
+
+    def bench_import(self, rows):
+        results = {}
+        # Half of each file is already in the table, so dedupe is exercised too.
+        existing = min(rows // 2, UserEmail.objects.count())
+
+        def source():
+            yield from synthetic_rows(0, existing)
+            yield from synthetic_rows(0, rows - existing, domain='import.test')
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(['username', 'email'])
+        writer.writerows(source())
+        csv_bytes = buffer.getvalue().encode('utf-8')
+        files = {
+            'csv': ('contacts.csv', csv_bytes),
+            'csv_gz': ('contacts.csv.gz', gzip.compress(csv_bytes)),
+        }
+
+        import openpyxl
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        sheet.append(['username', 'email'])
+        for username, email in source():
+            sheet.append([username, email])
+        buffer = io.BytesIO()
+        workbook.save(buffer)
+        files['xlsx'] = ('contacts.xlsx', buffer.getvalue())
+
+        for label, (name, content) in files.items():
+            started = time.perf_counter()
+            summary = import_file(SimpleUploadedFile(name, content))
+            elapsed = time.perf_counter() - started
+            results[label] = {
+                'rows': rows,
+                'bytes': len(content),
+                'inserted': summary.inserted,
+                'duplicates': summary.duplicates,
+                'invalid': summary.invalid,
+                'seconds': round(elapsed, 3),
+                'rows_per_second': round(rows / elapsed, 1) if elapsed else None,
+            }
+            # Remove the new rows so every format starts from the same table.
+            UserEmail.objects.filter(email__endswith='@import.test').delete()
+        stats.recount()
+        return results
+
+    def bench_send(self, count, delay, sessions):
+        template, _ = EmailTemplate.objects.get_or_create(
+            name="Benchmark Template",
+            defaults={'html_content': "<p>Hello {{ username }},</p><p>This is a benchmark message.</p>"},
+        )
+        self.grow_to(max(count, UserEmail.objects.count()))
+        cutoff = UserEmail.objects.order_by('id').values_list('id', flat=True)[count - 1]
+        engines = {
+            'smtp': send_batch,
+            'async': lambda messages, limiter=None: deliver_messages(messages, concurrency=sessions, limiter=limiter),
+        }
+        results = {}
+        with SMTPSink(delay=delay) as sink:
+            SiteSettings.objects.all().delete()
+            SiteSettings.objects.create(email_host=sink.host, email_port=sink.port, email_use_tls=False)
+            for label, send in engines.items():
+                received = sink.received
+                started = time.perf_counter()
+                campaign, queued = outbox.enqueue(template, UserEmail.objects.filter(id__lte=cutoff))
+                enqueued = time.perf_counter()
+                sent = failed = 0
+                while True:
+                    batch = outbox.claim_batch('benchmark', 100)
+                    if not batch:
+                        break
+                    batch_sent, batch_failed = outbox.deliver(batch, send=send)
+                    sent += batch_sent
+                    failed += batch_failed
+                finished = time.perf_counter()
+                results[label] = {
+                    'messages': queued,
+                    'sent': sent,
+                    'failed': failed,
+                    'received_by_sink': sink.received - received,
+                    'enqueue_seconds': round(enqueued - started, 3),
+                    'deliver_seconds': round(finished - enqueued, 3),
+                    'messages_per_second': round(sent / (finished - started), 1) if finished > started else None,
+                }
+        return results
+
+    def bench_concurrency(self, seconds, readers):
+        """
+        Run searches against an import and a campaign delivery at the same
+        time, first with stock SQLite settings, then with sender.database's.
+        """
+        template = EmailTemplate.objects.get(name="Benchmark Template")
+        results = {'seconds': seconds, 'readers': readers}
+        for label, overrides in (('baseline', BASELINE_SETTINGS), ('tuned', {})):
+            with override_settings(**overrides):
+                # Reconnect so the pragmas, and the journal mode, take effect.
+                connection.close()
+                outbox.enqueue(template, UserEmail.objects.all())
+                results[label] = self.run_mixed_load(seconds, readers, label)
+            OutboundMessage.objects.filter(status=OutboundMessage.STATUS_PENDING).delete()
+            UserEmail.objects.filter(email__endswith='@concurrency.test').delete()
+        connection.close()
+        stats.recount()
+        return results
+
+    def run_mixed_load(self, seconds, readers, label):
+        stop = threading.Event()
+        lock = threading.Lock()
+        totals = {'read_errors': 0, 'import_errors': 0, 'deliver_errors': 0, 'imported': 0, 'delivered': 0}
+        latencies = []
+
+        def count(key, amount=1):
+            with lock:
+                totals[key] += amount
+
+        def read(index):
+            queries = ['', 'user1', f'user{index}', 'nobody-here']
+            requests = [self.factory.get('/ajax_search/', {'q': q, 'page_size': 10}) for q in queries]
+            n = 0
+            while not stop.is_set():
+                started = time.perf_counter()
+                try:
+                    ajax_search(requests[n % len(requests)])
+                except OperationalError:
+                    count('read_errors')
+                else:
+                    with lock:
+                        latencies.append((time.perf_counter() - started) * 1000)
+                n += 1
+
+        def write_imports():
+            start = 0
+            while not stop.is_set():
+                rows = list(synthetic_rows(start, start + IMPORT_CHUNK_SIZE, domain='concurrency.test'))
+                start += IMPORT_CHUNK_SIZE
+                try:
+                    summary = import_chunks([pd.DataFrame(rows, columns=['username', 'email'])])
+                except OperationalError:
+                    count('import_errors')
+                else:
+                    count('imported', summary.inserted)
+
+        def write_deliveries():
+            while not stop.is_set():
+                try:
+                    batch = outbox.claim_batch(f'benchmark-{label}', 100)
+                    if not batch:
+                        return
+                    sent, _ = outbox.deliver(batch, send=instant_send)
+                except OperationalError:
+                    count('deliver_errors')
+                else:
+                    count('delivered', sent)
+
+        def run(func, *args):
+            try:
+                func(*args)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=run, args=(read, index)) for index in range(readers)]
+        threads += [threading.Thread(target=run, args=(write_imports,)),
+                    threading.Thread(target=run, args=(write_deliveries,))]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        stop.wait(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        return {
+            'journal_mode': connection.cursor().execute('PRAGMA journal_mode').fetchone()[0],
+            'searches': summarise(latencies),
+            'searches_per_second': round(len(latencies) / elapsed, 1),
+            'search_errors': totals['read_errors'],
+            'imported_rows': totals['imported'],
+            'import_rows_per_second': round(totals['imported'] / elapsed, 1),
+            'import_errors': totals['import_errors'],
+            'delivered': totals['delivered'],
+            'delivered_per_second': round(totals['delivered'] / elapsed, 1),
+            'deliver_errors': totals['deliver_errors'],
+        }
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from sender import stats
+
+
+class Command(BaseCommand):
+    help = "Rebuild the maintained recipient counters from the contacts table."
+
+    def handle(self, *args, **options):
+        stats.recount()
+        self.stdout.write(f"Recipients: {stats.get_value(stats.RECIPIENTS)}")
@@ -0,0 +1,154 @@
+import functools
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+
+from sender import metrics, outbox, ratelimit, relays
+from sender.async_smtp import deliver_messages
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Deliver queued campaign emails. Run one or more of these next to the web server. "
+        "Each batch is spread over the active relay profiles (or the Site Settings relay). "
+        "Rate limits (per second, minute and day) are shared by all workers."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=4,
+                            help="Number of sender threads, each with its own SMTP connection.")
+        parser.add_argument('--batch-size', type=int, default=50,
+                            help="Messages claimed and sent per SMTP session.")
+        parser.add_argument('--poll-interval', type=float, default=5.0,
+                            help="Seconds to wait when the queue is empty.")
+        parser.add_argument('--lease', type=int, default=600,
+                            help="Seconds after which a batch claimed by any worker but not finished is "
+                                 "requeued. Checked every --poll-interval; keep it well above the time a batch "
+                                 "takes to send.")
+        parser.add_argument('--engine', choices=['smtp', 'async'], default='smtp',
+                            help="'smtp' sends each batch over one Django SMTP connection; "
+                                 "'async' spreads it over --sessions concurrent pipelined sessions.")
+        parser.add_argument('--sessions', type=int, default=4,
+                            help="Concurrent SMTP sessions per thread with --engine async.")
+        parser.add_argument('--once', action='store_true',
+                            help="Exit when the queue is empty instead of polling.")
+        parser.add_argument('--metrics-port', type=int,
+                            help="Serve this worker's metrics at http://0.0.0.0:PORT/metrics.")
+
+    def handle(self, *args, **options):
+        self.stop = threading.Event()
+        self.release_lock = threading.Lock()
+        self.next_release = time.monotonic() + options['poll_interval']
+        signal.signal(signal.SIGTERM, lambda *_: self.stop.set())
+
+        released = outbox.release_orphaned(socket.gethostname()) + outbox.release_stale(options['lease'])
+        if released:
+            self.stdout.write(f"Requeued {released} messages from an interrupted worker.")
+
+        if options['metrics_port']:
+            self.serve_metrics(options['metrics_port'])
+
+        if options['engine'] == 'async':
+            self.engine = functools.partial(deliver_messages, concurrency=options['sessions'])
+        else:
+            self.engine = relays.smtp_engine
+
+        worker_prefix = f"{socket.gethostname()}:{os.getpid()}"
+        threads = [
+            threading.Thread(
+                target=self.work,
+                args=(f"{worker_prefix}:{n}", options),
+                name=f"send_outbox-{n}",
+            )
+            for n in range(max(1, options['concurrency']))
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(timeout=1)
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping after the current batches...")
+            self.stop.set()
+            for thread in threads:
+                thread.join()
+
+    def serve_metrics(self, port):
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split('?')[0] != '/metrics':
+                    handler.send_error(404)
+                    return
+                try:
+                    body = metrics.render().encode('utf-8')
+                finally:
+                    # Scrapes run on their own thread; don't leak its connection.
+                    connection.close()
+                handler.send_response(200)
+                handler.send_header('Content-Type', metrics.CONTENT_TYPE)
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, *args):
+                pass
+
+        server = ThreadingHTTPServer(('0.0.0.0', port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, name='send_outbox-metrics', daemon=True).start()
+        self.stdout.write(f"Serving metrics on port {server.server_port}")
+
+    def release_stale(self, worker_id, options):
+        # Another worker may have died mid-batch on another host, where
+        # release_orphaned() can't see it; one thread per process checks
+        # for expired leases at most once per poll interval.
+        with self.release_lock:
+            now = time.monotonic()
+            if now < self.next_release:
+                return
+            self.next_release = now + options['poll_interval']
+        released = outbox.release_stale(options['lease'])
+        if released:
+            self.stdout.write(f"[{worker_id}] requeued {released} messages with an expired lease")
+
+    def work(self, worker_id, options):
+        try:
+            while not self.stop.is_set():
+                close_old_connections()
+                outbox.promote_due_retries()
+                self.release_stale(worker_id, options)
+                per_second, per_minute, per_day = ratelimit.get_rate_limits()
+                limiter = ratelimit.get_rate_limiter(per_second, per_minute)
+                pool = relays.get_relay_pool()
+                batch = ratelimit.claim_within_quota(
+                    functools.partial(outbox.claim_batch, worker_id), options['batch_size'], per_day,
+                    relay_remaining=pool.daily_remaining,
+                )
+                if not batch:
+                    if options['once']:
+                        return
+                    self.stop.wait(options['poll_interval'])
+                    continue
+                try:
+                    sent, failed = outbox.deliver(
+                        batch, send=functools.partial(pool.send, self.engine, limiter=limiter),
+                    )
+                except Exception:
+                    # Keep the thread alive and hand the batch back; whatever
+                    # was not recorded as sent goes out again on the next claim.
+                    logger.exception("[%s] batch of %d failed", worker_id, len(batch))
+                    outbox.release_claimed(worker_id)
+                    self.stop.wait(options['poll_interval'])
+                    continue
+                self.stdout.write(f"[{worker_id}] sent {sent}, failed {failed}")
+        finally:
+            connection.close()
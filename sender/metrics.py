@@ -0,0 +1,233 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _label_text(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+def sample(name, value, **labels):
+    """
+    One exposition line, for collectors reporting values they compute.
+    """
+    return f"{name}{_label_text(tuple(labels), tuple(labels.values()))} {value}"
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class CounterMetric(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        if not values and not self.labelnames:
+            values = [((), 0)]
+        return [f"{self.name}{_label_text(self.labelnames, key)} {value}" for key, value in values]
+
+
+class HistogramMetric(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: [count per bucket (+Inf last), sum].
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def count(self, **labels):
+        entry = self._values.get(self._key(labels))
+        return sum(entry[0]) if entry else 0
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        lines = []
+        names = self.labelnames + ('le',)
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f"{self.name}_bucket{_label_text(names, key + (le,))} {cumulative}")
+            labels = _label_text(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(CounterMetric(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(HistogramMetric(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collector):
+        """
+        Register a callable returning exposition lines, evaluated per scrape.
+        """
+        self.collectors.append(collector)
+        return collector
+
+    def render(self, collected_only=False):
+        """
+        The exposition text. ``collected_only`` leaves out the metrics this
+        process records itself and keeps the collectors' values.
+        """
+        lines = []
+        for metric in [] if collected_only else self.metrics:
+            lines.extend(metric.header())
+            lines.extend(metric.samples())
+        for collector in self.collectors:
+            lines.extend(collector())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    'sender_stage_seconds',
+    "Time spent in each stage of building and sending a message.",
+    ['stage'],
+)
+MESSAGES_SENT = REGISTRY.counter(
+    'sender_messages_sent_total',
+    "Messages accepted by the relay.",
+)
+MESSAGES_FAILED = REGISTRY.counter(
+    'sender_messages_failed_total',
+    "Messages that failed, by SMTP reply code ('none' when there was no reply).",
+    ['code'],
+)
+MESSAGES_DEFERRED = REGISTRY.counter(
+    'sender_messages_deferred_total',
+    "Messages that failed temporarily and were scheduled for a retry, by SMTP reply code.",
+    ['code'],
+)
+CONNECTIONS = REGISTRY.counter(
+    'sender_smtp_connections_total',
+    "SMTP sessions opened, by engine.",
+    ['engine'],
+)
+RECONNECTS = REGISTRY.counter(
+    'sender_smtp_reconnects_total',
+    "Sessions re-opened after the relay dropped them mid-batch, by engine.",
+    ['engine'],
+)
+RELAY_MESSAGES = REGISTRY.counter(
+    'sender_relay_messages_total',
+    "Messages handed to each relay, by outcome.",
+    ['relay', 'outcome'],
+)
+RELAY_TRIPS = REGISTRY.counter(
+    'sender_relay_trips_total',
+    "Times a relay was benched for failing too often.",
+    ['relay'],
+)
+RELAY_FAILOVERS = REGISTRY.counter(
+    'sender_relay_failovers_total',
+    "Messages retried on another relay after a relay failure.",
+)
+
+
+def enabled():
+    return getattr(settings, 'METRICS_ENABLED', True)
+
+
+@contextmanager
+def _noop():
+    yield
+
+
+def stage(name):
+    """
+    Context manager timing one send-pipeline stage into STAGE_SECONDS.
+
+    Stages: render, strip_tags and build (per message, in build_message),
+    connect (TCP connect, the TLS handshake for implicit TLS, and the
+    greeting), handshake (EHLO, STARTTLS and AUTH, once per session),
+    serialize (MIME to bytes) and transmit (MAIL/RCPT/DATA up to the
+    relay's reply). Set METRICS_ENABLED = False to skip the timing entirely.
+    """
+    if not enabled():
+        return _noop()
+    return STAGE_SECONDS.time(stage=name)
+
+
+def observe_stage(name, seconds):
+    """
+    Record a stage timed by the caller, for stages that don't fit a block.
+    """
+    if enabled():
+        STAGE_SECONDS.observe(seconds, stage=name)
+
+
+def render(collected_only=False):
+    return REGISTRY.render(collected_only)
+
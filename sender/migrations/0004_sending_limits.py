@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sender', '0003_outbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sitesettings',
+            name='rate_limit_per_day',
+            field=models.PositiveIntegerField(blank=True, help_text='Maximum emails per rolling 24 hours (e.g., 2000 for Google Workspace). Leave empty for no limit.', null=True),
+        ),
+        migrations.AddField(
+            model_name='sitesettings',
+            name='rate_limit_per_minute',
+            field=models.PositiveIntegerField(blank=True, help_text='Maximum emails per minute accepted by the relay. Leave empty for no limit.', null=True),
+        ),
+        migrations.AddField(
+            model_name='sitesettings',
+            name='rate_limit_per_second',
+            field=models.PositiveIntegerField(blank=True, help_text='Maximum emails per second accepted by the relay. Leave empty for no limit.', null=True),
+        ),
+        migrations.AddIndex(
+            model_name='outboundmessage',
+            index=models.Index(fields=['sent_at'], name='outbound_sent_at_idx'),
+        ),
+    ]
@@ -0,0 +1,81 @@
+from django.db import migrations
+
+# Trigram FTS5 index over UserEmail.username/email. It is an external
+# content table, so it only stores the index; triggers keep it in sync with
+# every insert, update and delete, including bulk_create and queryset
+# deletes that bypass model signals.
+CREATE_SQL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS sender_useremail_fts USING fts5(
+        username, email,
+        content='sender_useremail', content_rowid='id',
+        tokenize='trigram'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS sender_useremail_fts_ai AFTER INSERT ON sender_useremail BEGIN
+        INSERT INTO sender_useremail_fts(rowid, username, email)
+        VALUES (new.id, new.username, new.email);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS sender_useremail_fts_ad AFTER DELETE ON sender_useremail BEGIN
+        INSERT INTO sender_useremail_fts(sender_useremail_fts, rowid, username, email)
+        VALUES ('delete', old.id, old.username, old.email);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS sender_useremail_fts_au AFTER UPDATE ON sender_useremail BEGIN
+        INSERT INTO sender_useremail_fts(sender_useremail_fts, rowid, username, email)
+        VALUES ('delete', old.id, old.username, old.email);
+        INSERT INTO sender_useremail_fts(rowid, username, email)
+        VALUES (new.id, new.username, new.email);
+    END
+    """,
+    "INSERT INTO sender_useremail_fts(sender_useremail_fts) VALUES ('rebuild')",
+]
+
+DROP_SQL = [
+    "DROP TRIGGER IF EXISTS sender_useremail_fts_ai",
+    "DROP TRIGGER IF EXISTS sender_useremail_fts_ad",
+    "DROP TRIGGER IF EXISTS sender_useremail_fts_au",
+    "DROP TABLE IF EXISTS sender_useremail_fts",
+]
+
+
+def fts5_trigram_supported(connection):
+    with connection.cursor() as cursor:
+        try:
+            cursor.execute("CREATE VIRTUAL TABLE temp.sender_fts_probe USING fts5(x, tokenize='trigram')")
+        except Exception:
+            return False
+        cursor.execute("DROP TABLE temp.sender_fts_probe")
+    return True
+
+
+def create_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    # Other databases (and SQLite builds older than 3.34) keep using the
+    # icontains fallback in sender.search.
+    if connection.vendor != 'sqlite' or not fts5_trigram_supported(connection):
+        return
+    for statement in CREATE_SQL:
+        schema_editor.execute(statement)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for statement in DROP_SQL:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sender', '0004_sending_limits'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sender', '0005_useremail_search_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='useremail',
+            index=models.Index(fields=['username', 'id'], name='useremail_username_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='useremail',
+            index=models.Index(fields=['email', 'id'], name='useremail_email_id_idx'),
+        ),
+    ]
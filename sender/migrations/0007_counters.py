@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:11
+
+from django.db import migrations, models
+
+
+def seed_counters(apps, schema_editor):
+    Counter = apps.get_model('sender', 'Counter')
+    UserEmail = apps.get_model('sender', 'UserEmail')
+    Counter.objects.create(name='recipients', value=UserEmail.objects.count())
+    Counter.objects.create(name='uploads', value=0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sender', '0006_useremail_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Counter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('value', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Counter',
+                'verbose_name_plural': 'Counters',
+            },
+        ),
+        migrations.RunPython(seed_counters, migrations.RunPython.noop),
+    ]
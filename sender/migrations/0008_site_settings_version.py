@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sender', '0007_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sitesettings',
+            name='version',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Bumped on every save so cached copies in other processes can tell they are stale.'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:14
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sender', '0008_site_settings_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeliveryRecord',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('email', models.EmailField(max_length=254)),
+                ('status', models.CharField(choices=[('sent', 'Sent'), ('failed', 'Failed')], max_length=10)),
+                ('smtp_code', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('smtp_response', models.TextField(blank=True)),
+                ('attempt', models.PositiveIntegerField(default=1)),
+                ('started_at', models.DateTimeField()),
+                ('finished_at', models.DateTimeField()),
+                ('campaign', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='deliveries', to='sender.campaign')),
+                ('message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='deliveries', to='sender.outboundmessage')),
+                ('recipient', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='sender.useremail')),
+            ],
+            options={
+                'verbose_name': 'Delivery Record',
+                'verbose_name_plural': 'Delivery Records',
+                'indexes': [models.Index(fields=['campaign', 'status', 'id'], name='delivery_campaign_status_idx'), models.Index(fields=['status', 'finished_at'], name='delivery_status_finished_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,76 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:15
+
+from django.db import migrations, models
+from django.db.models import Count, Max, Q
+
+
+def backfill_progress(apps, schema_editor):
+    Campaign = apps.get_model('sender', 'Campaign')
+    campaigns = Campaign.objects.annotate(
+        queued=Count('messages'),
+        sent=Count('messages', filter=Q(messages__status='sent')),
+        failed=Count('messages', filter=Q(messages__status='failed')),
+        last_sent_at=Max('messages__sent_at'),
+    )
+    for campaign in campaigns:
+        campaign.total = campaign.queued
+        campaign.sent_count = campaign.sent
+        campaign.failed_count = campaign.failed
+        if campaign.sent + campaign.failed == campaign.queued:
+            campaign.status = 'completed'
+            campaign.completed_at = campaign.last_sent_at or campaign.created_at
+        campaign.save(update_fields=['total', 'sent_count', 'failed_count', 'status', 'completed_at'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sender', '0009_delivery_records'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='campaign',
+            name='checkpoint',
+            field=models.BigIntegerField(blank=True, help_text='Highest queue row id in a committed batch.', null=True),
+        ),
+        migrations.AddField(
+            model_name='campaign',
+            name='checkpoint_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='campaign',
+            name='completed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='campaign',
+            name='failed_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='campaign',
+            name='sent_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='campaign',
+            name='status',
+            field=models.CharField(choices=[('sending', 'Sending'), ('completed', 'Completed')], default='sending', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='campaign',
+            name='total',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='outboundmessage',
+            index=models.Index(fields=['campaign', 'status'], name='outbound_campaign_status_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='outboundmessage',
+            constraint=models.UniqueConstraint(fields=('campaign', 'recipient'), name='outbound_unique_recipient'),
+        ),
+        migrations.RunPython(backfill_progress, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:22
+
+import django.db.models.functions.text
+from django.db import migrations, models
+
+# Every contact whose address differs only in case or surrounding spaces
+# from an older one, mapped to that older one. The oldest row is kept.
+CREATE_MERGE_TABLE = """
+    CREATE TEMPORARY TABLE sender_email_merge AS
+    SELECT u.id AS old_id, k.keep_id AS keep_id
+    FROM sender_useremail u
+    JOIN (
+        SELECT LOWER(TRIM(email)) AS normalized, MIN(id) AS keep_id
+        FROM sender_useremail
+        GROUP BY LOWER(TRIM(email))
+        HAVING COUNT(*) > 1
+    ) k ON LOWER(TRIM(u.email)) = k.normalized
+    WHERE u.id <> k.keep_id
+"""
+
+
+def merge_duplicate_emails(apps, schema_editor):
+    """
+    Merge case-variant duplicates and normalize stored addresses, set-based.
+
+    Queue and delivery history that pointed at a removed duplicate is kept
+    but detached, exactly as deleting the contact would do.
+    """
+    execute = schema_editor.execute
+    execute(CREATE_MERGE_TABLE)
+    for table in ('sender_outboundmessage', 'sender_deliveryrecord'):
+        execute(
+            f"UPDATE {table} SET recipient_id = NULL "
+            f"WHERE recipient_id IN (SELECT old_id FROM sender_email_merge)"
+        )
+    execute("DELETE FROM sender_useremail WHERE id IN (SELECT old_id FROM sender_email_merge)")
+    execute("DROP TABLE sender_email_merge")
+    execute("UPDATE sender_useremail SET email = LOWER(TRIM(email)) WHERE email <> LOWER(TRIM(email))")
+    execute(
+        "UPDATE sender_counter SET value = (SELECT COUNT(*) FROM sender_useremail) "
+        "WHERE name = 'recipients'"
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sender', '0010_resumable_campaigns'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_emails, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='useremail',
+            constraint=models.UniqueConstraint(django.db.models.functions.text.Lower('email'), name='useremail_email_ci_unique', violation_error_message='A contact with this email already exists.'),
+        ),
+    ]
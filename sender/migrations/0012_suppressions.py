@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sender', '0011_case_insensitive_email'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Suppression',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('email', models.EmailField(max_length=254, unique=True)),
+                ('reason', models.CharField(choices=[('unsubscribe', 'Unsubscribed'), ('bounce', 'Hard bounce'), ('complaint', 'Complaint'), ('manual', 'Added manually')], default='manual', max_length=20)),
+                ('detail', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Suppression',
+                'verbose_name_plural': 'Suppressions',
+            },
+        ),
+        migrations.AddField(
+            model_name='campaign',
+            name='suppressed_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='outboundmessage',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('sending', 'Sending'), ('sent', 'Sent'), ('failed', 'Failed'), ('suppressed', 'Suppressed')], default='pending', max_length=10),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:31
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sender', '0012_suppressions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RelayProfile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('email_host', models.CharField(help_text="SMTP server host (e.g., 'smtp.sendgrid.net').", max_length=255)),
+                ('email_port', models.PositiveIntegerField(default=587, help_text='SMTP server port.')),
+                ('email_use_tls', models.BooleanField(default=True, help_text='Use STARTTLS.')),
+                ('email_use_ssl', models.BooleanField(default=False, help_text='Use implicit SSL (port 465).')),
+                ('email_host_user', models.CharField(blank=True, max_length=255)),
+                ('email_host_password', models.CharField(blank=True, max_length=255)),
+                ('default_from_email', models.EmailField(blank=True, help_text='Sender address for this relay. Leave empty to use the one in Site Settings.', max_length=254)),
+                ('weight', models.PositiveIntegerField(default=1, help_text='Share of the traffic relative to the other relays (e.g., 3 gets three times as much as 1).', validators=[django.core.validators.MinValueValidator(1)])),
+                ('rate_limit_per_second', models.PositiveIntegerField(blank=True, help_text='Maximum emails per second for this relay. Leave empty for no limit.', null=True)),
+                ('rate_limit_per_minute', models.PositiveIntegerField(blank=True, help_text='Maximum emails per minute for this relay. Leave empty for no limit.', null=True)),
+                ('rate_limit_per_day', models.PositiveIntegerField(blank=True, help_text='Maximum emails per rolling 24 hours for this relay. Leave empty for no limit.', null=True)),
+                ('is_active', models.BooleanField(default=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Relay Profile',
+                'verbose_name_plural': 'Relay Profiles',
+                'ordering': ['name'],
+            },
+        ),
+        migrations.AddField(
+            model_name='deliveryrecord',
+            name='relay',
+            field=models.CharField(blank=True, help_text='Relay profile the attempt went through.', max_length=100),
+        ),
+        migrations.AddIndex(
+            model_name='deliveryrecord',
+            index=models.Index(fields=['relay', 'status', 'finished_at'], name='delivery_relay_quota_idx'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sender', '0013_relay_profiles'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboundmessage',
+            name='next_attempt_at',
+            field=models.DateTimeField(blank=True, help_text='When a message waiting to retry goes back in the queue.', null=True),
+        ),
+        migrations.AlterField(
+            model_name='deliveryrecord',
+            name='status',
+            field=models.CharField(choices=[('sent', 'Sent'), ('failed', 'Failed'), ('deferred', 'Deferred')], max_length=10),
+        ),
+        migrations.AlterField(
+            model_name='outboundmessage',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('sending', 'Sending'), ('sent', 'Sent'), ('failed', 'Failed'), ('suppressed', 'Suppressed'), ('retry', 'Waiting to retry')], default='pending', max_length=10),
+        ),
+        migrations.AddIndex(
+            model_name='outboundmessage',
+            index=models.Index(fields=['status', 'next_attempt_at'], name='outbound_retry_due_idx'),
+        ),
+    ]
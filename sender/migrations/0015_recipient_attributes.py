@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:36
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sender', '0014_retry_schedule'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecipientAttribute',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64)),
+                ('value', models.CharField(blank=True, max_length=255)),
+                ('recipient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='attributes', to='sender.useremail')),
+            ],
+            options={
+                'verbose_name': 'Recipient Attribute',
+                'verbose_name_plural': 'Recipient Attributes',
+                'indexes': [models.Index(fields=['name', 'value', 'recipient'], name='attribute_segment_idx')],
+                'constraints': [models.UniqueConstraint(fields=('recipient', 'name'), name='attribute_recipient_name_unique')],
+            },
+        ),
+    ]
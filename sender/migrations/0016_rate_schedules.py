@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sender', '0015_recipient_attributes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RateSchedule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=150, unique=True)),
+                ('next_at', models.FloatField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Rate Schedule',
+                'verbose_name_plural': 'Rate Schedules',
+            },
+        ),
+    ]
@@ -1,4 +1,26 @@
-from django.db import models
+import re
+
+from django.core.validators import MinValueValidator
+from django.db import models, transaction
+from django.db.models import F
+from django.db.models.functions import Lower
+
+
+def normalize_email(email):
+    """
+    The stored form of an address: trimmed and lowercased, as imports do.
+    """
+    return (email or '').strip().lower()
+
+
+def normalize_attribute_name(name):
+    """
+    The stored form of an attribute name, usable as a template variable:
+    lowercase letters, digits and underscores, starting with a letter.
+    Returns '' for names that can't be made into one.
+    """
+    name = re.sub(r'[^a-z0-9_]+', '_', str(name or '').strip().lower()).strip('_')[:64]
+    return name if name[:1].isalpha() else ''
 
 
 class UserEmail(models.Model):
@@ -8,9 +30,54 @@ class UserEmail(models.Model):
     def __str__(self):
         return f"{self.username} <{self.email}>"
 
+    def save(self, *args, **kwargs):
+        self.email = normalize_email(self.email)
+        super().save(*args, **kwargs)
+
     class Meta:
         verbose_name = "User Email"
         verbose_name_plural = "User Emails"
+        indexes = [
+            # Keyset pagination walks (sort key, id) in both directions.
+            models.Index(fields=['username', 'id'], name='useremail_username_id_idx'),
+            models.Index(fields=['email', 'id'], name='useremail_email_id_idx'),
+        ]
+        constraints = [
+            # Emails are stored normalized; this also stops raw SQL or a
+            # bulk write from adding Bob@x.com next to bob@x.com.
+            models.UniqueConstraint(
+                Lower('email'),
+                name='useremail_email_ci_unique',
+                violation_error_message="A contact with this email already exists.",
+            ),
+        ]
+
+
+class RecipientAttribute(models.Model):
+    """
+    An extra column from an import (country, plan...) for one contact.
+
+    Exposed to templates as a variable of the same name and used to resolve
+    segments; see sender.segments.
+    """
+    recipient = models.ForeignKey(UserEmail, on_delete=models.CASCADE, related_name='attributes')
+    name = models.CharField(max_length=64)
+    value = models.CharField(max_length=255, blank=True)
+
+    def __str__(self):
+        return f"{self.name}={self.value}"
+
+    class Meta:
+        verbose_name = "Recipient Attribute"
+        verbose_name_plural = "Recipient Attributes"
+        indexes = [
+            # A segment term is one range scan over (name, value) that yields
+            # recipient ids without touching the table.
+            models.Index(fields=['name', 'value', 'recipient'], name='attribute_segment_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['recipient', 'name'], name='attribute_recipient_name_unique'),
+        ]
 
 
 class EmailTemplate(models.Model):
@@ -62,10 +129,291 @@ class SiteSettings(models.Model):
         blank=True,
         help_text="Default sender email address (e.g., 'your-email@example.com')."
     )
+    rate_limit_per_second = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text="Maximum emails per second accepted by the relay. Leave empty for no limit."
+    )
+    rate_limit_per_minute = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text="Maximum emails per minute accepted by the relay. Leave empty for no limit."
+    )
+    rate_limit_per_day = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text="Maximum emails per rolling 24 hours (e.g., 2000 for Google Workspace). Leave empty for no limit."
+    )
+    version = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        help_text="Bumped on every save so cached copies in other processes can tell they are stale."
+    )
 
     def __str__(self):
         return "Site Email Settings"
 
+    def save(self, *args, **kwargs):
+        # The version is bumped in the database rather than from this copy of
+        # the row: two saves that start from the same version must still end
+        # on different ones, or another process could miss the second.
+        if not self._state.adding:
+            fields = kwargs.get('update_fields')
+            if fields is None:
+                fields = [field.name for field in self._meta.concrete_fields if not field.primary_key]
+            kwargs['update_fields'] = [name for name in fields if name != 'version']
+        with transaction.atomic(using=kwargs.get('using')):
+            super().save(*args, **kwargs)
+            rows = type(self)._base_manager.using(self._state.db).filter(pk=self.pk)
+            rows.update(version=F('version') + 1)
+            self.version = rows.values_list('version', flat=True).get()
+
     class Meta:
         verbose_name = "Site Settings"
-        verbose_name_plural = "Site Settings"
\ No newline at end of file
+        verbose_name_plural = "Site Settings"
+
+
+class RelayProfile(models.Model):
+    """
+    One SMTP relay the sender spreads campaigns over.
+
+    With no active profiles, mail goes through the single relay configured in
+    SiteSettings. Empty fields fall back to SiteSettings as well.
+    """
+    name = models.CharField(max_length=100, unique=True)
+    email_host = models.CharField(max_length=255, help_text="SMTP server host (e.g., 'smtp.sendgrid.net').")
+    email_port = models.PositiveIntegerField(default=587, help_text="SMTP server port.")
+    email_use_tls = models.BooleanField(default=True, help_text="Use STARTTLS.")
+    email_use_ssl = models.BooleanField(default=False, help_text="Use implicit SSL (port 465).")
+    email_host_user = models.CharField(max_length=255, blank=True)
+    email_host_password = models.CharField(max_length=255, blank=True)
+    default_from_email = models.EmailField(
+        blank=True,
+        help_text="Sender address for this relay. Leave empty to use the one in Site Settings."
+    )
+    weight = models.PositiveIntegerField(
+        default=1,
+        validators=[MinValueValidator(1)],
+        help_text="Share of the traffic relative to the other relays (e.g., 3 gets three times as much as 1)."
+    )
+    rate_limit_per_second = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text="Maximum emails per second for this relay. Leave empty for no limit."
+    )
+    rate_limit_per_minute = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text="Maximum emails per minute for this relay. Leave empty for no limit."
+    )
+    rate_limit_per_day = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text="Maximum emails per rolling 24 hours for this relay. Leave empty for no limit."
+    )
+    is_active = models.BooleanField(default=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.name
+
+    class Meta:
+        verbose_name = "Relay Profile"
+        verbose_name_plural = "Relay Profiles"
+        ordering = ['name']
+
+
+class Campaign(models.Model):
+    STATUS_SENDING = 'sending'
+    STATUS_COMPLETED = 'completed'
+    STATUS_CHOICES = [
+        (STATUS_SENDING, 'Sending'),
+        (STATUS_COMPLETED, 'Completed'),
+    ]
+
+    template = models.ForeignKey(EmailTemplate, on_delete=models.PROTECT, related_name='campaigns')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_SENDING)
+    # Size of the recipient snapshot taken when the campaign was queued.
+    total = models.PositiveIntegerField(default=0)
+    # Progress as of the last committed batch. The queue rows themselves are
+    # the resume point: anything not yet committed is still pending.
+    sent_count = models.PositiveIntegerField(default=0)
+    failed_count = models.PositiveIntegerField(default=0)
+    # Recipients skipped because they are on the suppression list, whether
+    # they were left out of the snapshot or caught at send time.
+    suppressed_count = models.PositiveIntegerField(default=0)
+    checkpoint = models.BigIntegerField(
+        null=True, blank=True, help_text="Highest queue row id in a committed batch."
+    )
+    checkpoint_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Campaign #{self.pk} ({self.template})"
+
+    @property
+    def remaining(self):
+        return max(0, self.total - self.sent_count - self.failed_count - self.suppressed_count)
+
+    class Meta:
+        verbose_name = "Campaign"
+        verbose_name_plural = "Campaigns"
+
+
+class OutboundMessage(models.Model):
+    STATUS_PENDING = 'pending'
+    STATUS_SENDING = 'sending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+    STATUS_SUPPRESSED = 'suppressed'
+    STATUS_RETRY = 'retry'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_SENDING, 'Sending'),
+        (STATUS_SENT, 'Sent'),
+        (STATUS_FAILED, 'Failed'),
+        (STATUS_SUPPRESSED, 'Suppressed'),
+        (STATUS_RETRY, 'Waiting to retry'),
+    ]
+
+    campaign = models.ForeignKey(Campaign, on_delete=models.CASCADE, related_name='messages')
+    # The recipient is copied onto the queue row so deleting or editing a
+    # contact mid-send doesn't change what was queued.
+    recipient = models.ForeignKey(UserEmail, on_delete=models.SET_NULL, null=True, blank=True)
+    username = models.CharField(max_length=255)
+    email = models.EmailField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    claimed_by = models.CharField(max_length=64, blank=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    next_attempt_at = models.DateTimeField(
+        null=True, blank=True, help_text="When a message waiting to retry goes back in the queue."
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.email} ({self.status})"
+
+    class Meta:
+        verbose_name = "Outbound Message"
+        verbose_name_plural = "Outbound Messages"
+        indexes = [
+            models.Index(fields=['status', 'id'], name='outbound_status_id_idx'),
+            models.Index(fields=['sent_at'], name='outbound_sent_at_idx'),
+            models.Index(fields=['campaign', 'status'], name='outbound_campaign_status_idx'),
+            models.Index(fields=['status', 'next_attempt_at'], name='outbound_retry_due_idx'),
+        ]
+        constraints = [
+            # A recipient is snapshotted into a campaign at most once.
+            models.UniqueConstraint(fields=['campaign', 'recipient'], name='outbound_unique_recipient'),
+        ]
+
+
+class Counter(models.Model):
+    """
+    A maintained aggregate, so pages can show totals without scanning tables.
+    """
+    name = models.CharField(max_length=100, unique=True)
+    value = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} = {self.value}"
+
+    class Meta:
+        verbose_name = "Counter"
+        verbose_name_plural = "Counters"
+
+
+class RateSchedule(models.Model):
+    """
+    The next free send slot of one rate limit, shared by every worker.
+
+    ``next_at`` is a Unix timestamp; see ratelimit.SharedTokenBucket.
+    """
+    key = models.CharField(max_length=150, unique=True)
+    next_at = models.FloatField(default=0)
+
+    def __str__(self):
+        return self.key
+
+    class Meta:
+        verbose_name = "Rate Schedule"
+        verbose_name_plural = "Rate Schedules"
+
+
+class DeliveryRecord(models.Model):
+    """
+    One delivery attempt for one recipient, written in batches by the sender.
+    """
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+    STATUS_DEFERRED = 'deferred'
+    STATUS_CHOICES = [
+        (STATUS_SENT, 'Sent'),
+        (STATUS_FAILED, 'Failed'),
+        (STATUS_DEFERRED, 'Deferred'),
+    ]
+
+    campaign = models.ForeignKey(Campaign, on_delete=models.CASCADE, related_name='deliveries')
+    message = models.ForeignKey(
+        OutboundMessage, on_delete=models.SET_NULL, null=True, blank=True, related_name='deliveries'
+    )
+    recipient = models.ForeignKey(UserEmail, on_delete=models.SET_NULL, null=True, blank=True)
+    email = models.EmailField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES)
+    smtp_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    smtp_response = models.TextField(blank=True)
+    attempt = models.PositiveIntegerField(default=1)
+    relay = models.CharField(max_length=100, blank=True, help_text="Relay profile the attempt went through.")
+    started_at = models.DateTimeField()
+    finished_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.email} ({self.status})"
+
+    class Meta:
+        verbose_name = "Delivery Record"
+        verbose_name_plural = "Delivery Records"
+        indexes = [
+            # "Failed in campaign N" and per-campaign reports.
+            models.Index(fields=['campaign', 'status', 'id'], name='delivery_campaign_status_idx'),
+            models.Index(fields=['status', 'finished_at'], name='delivery_status_finished_idx'),
+            # Per-relay daily quotas.
+            models.Index(fields=['relay', 'status', 'finished_at'], name='delivery_relay_quota_idx'),
+        ]
+
+
+class Suppression(models.Model):
+    """
+    An address that must never be mailed again.
+    """
+    REASON_UNSUBSCRIBE = 'unsubscribe'
+    REASON_BOUNCE = 'bounce'
+    REASON_COMPLAINT = 'complaint'
+    REASON_MANUAL = 'manual'
+    REASON_CHOICES = [
+        (REASON_UNSUBSCRIBE, 'Unsubscribed'),
+        (REASON_BOUNCE, 'Hard bounce'),
+        (REASON_COMPLAINT, 'Complaint'),
+        (REASON_MANUAL, 'Added manually'),
+    ]
+
+    email = models.EmailField(unique=True)
+    reason = models.CharField(max_length=20, choices=REASON_CHOICES, default=REASON_MANUAL)
+    detail = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.email} ({self.get_reason_display()})"
+
+    def save(self, *args, **kwargs):
+        self.email = normalize_email(self.email)
+        super().save(*args, **kwargs)
+
+    class Meta:
+        verbose_name = "Suppression"
+        verbose_name_plural = "Suppressions"
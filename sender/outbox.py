@@ -0,0 +1,390 @@
+import logging
+import os
+import random
+import smtplib
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Count, F, Value
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+
+from . import metrics
+from .database import write_lane
+from .mailer import DeliveryResult, build_message, describe_failure, is_transient, send_batch, smtp_reply
+from .models import Campaign, DeliveryRecord, OutboundMessage, RecipientAttribute, Suppression
+from .suppression import get_suppression_filter, suppress
+
+logger = logging.getLogger(__name__)
+
+# Retries requeued per promote_due_retries() call.
+RETRY_PROMOTE_CHUNK_SIZE = 1000
+# Permanent recipient rejections that put the address on the suppression list.
+HARD_BOUNCE_CODES = (550, 551, 553)
+
+
+def enqueue(template, recipients):
+    """
+    Create a campaign and queue one OutboundMessage per recipient.
+
+    ``recipients`` is a UserEmail queryset. The queue rows are the
+    campaign's frozen recipient set, and the database takes the snapshot:
+    one INSERT ... SELECT copies the recipients and one UPDATE marks the
+    suppressed ones, in a single transaction. The write lock is held for
+    those two statements, however long the list, rather than while rows
+    travel through Python.
+
+    Returns (campaign, queued), where ``queued`` leaves out recipients on
+    the suppression list; those are counted in campaign.suppressed_count.
+    """
+    recipients = recipients.order_by().values('id', 'username', 'email')
+    connection = connections[recipients.db]
+    select, params = recipients.query.sql_with_params()
+    with write_lane(recipients.db):
+        campaign = Campaign.objects.create(template=template)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {connection.ops.quote_name(OutboundMessage._meta.db_table)} "
+                "(campaign_id, recipient_id, username, email, status, attempts, last_error, claimed_by, created_at) "
+                f"SELECT %s, id, username, email, %s, 0, '', '', %s FROM ({select}) recipients ORDER BY id",
+                [
+                    campaign.pk,
+                    OutboundMessage.STATUS_PENDING,
+                    connection.ops.adapt_datetimefield_value(timezone.now()),
+                    *params,
+                ],
+            )
+            total = cursor.rowcount
+        # Suppressed recipients stay in the snapshot, marked as such, so the
+        # campaign still accounts for everyone it was queued for.
+        suppressed = OutboundMessage.objects.filter(
+            campaign=campaign,
+            email__in=Suppression.objects.values('email'),
+        ).update(status=OutboundMessage.STATUS_SUPPRESSED)
+        campaign.total = total
+        campaign.suppressed_count = suppressed
+        campaign.save(update_fields=['total', 'suppressed_count'])
+        if total == suppressed:
+            complete_finished([campaign.pk])
+    return campaign, total - suppressed
+
+
+def enqueue_selection(template, selection):
+    """
+    Like enqueue(), for a sender.selection.Selection.
+    """
+    return enqueue(template, selection.queryset())
+
+
+def release_stale(lease_seconds):
+    """
+    Put messages claimed by a worker that died mid-batch back in the queue.
+    """
+    cutoff = timezone.now() - timedelta(seconds=lease_seconds)
+    return OutboundMessage.objects.filter(
+        status=OutboundMessage.STATUS_SENDING,
+        claimed_at__lt=cutoff,
+    ).update(status=OutboundMessage.STATUS_PENDING, claimed_by='', claimed_at=None)
+
+
+def release_claimed(worker_id):
+    """
+    Put the messages ``worker_id`` claimed but never finished back in the queue.
+
+    Used when a batch fails part way, so the worker that claimed it can
+    hand it straight back instead of waiting for release_stale().
+    """
+    return OutboundMessage.objects.filter(
+        status=OutboundMessage.STATUS_SENDING,
+        claimed_by=worker_id,
+    ).update(status=OutboundMessage.STATUS_PENDING, claimed_by='', claimed_at=None)
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def release_orphaned(hostname):
+    """
+    Requeue batches claimed by workers on ``hostname`` that no longer run.
+
+    Worker ids are "host:pid:thread", so a restarted worker can pick up where
+    a crashed one on the same machine stopped without waiting for its lease
+    to expire. Claims from other hosts are left to release_stale().
+    """
+    claimed_by = (
+        OutboundMessage.objects.filter(
+            status=OutboundMessage.STATUS_SENDING,
+            claimed_by__startswith=f"{hostname}:",
+        )
+        .values_list('claimed_by', flat=True)
+        .distinct()
+    )
+    dead = []
+    for worker_id in claimed_by:
+        try:
+            pid = int(worker_id.split(':')[1])
+        except (IndexError, ValueError):
+            continue
+        if not _process_alive(pid):
+            dead.append(worker_id)
+    if not dead:
+        return 0
+    return OutboundMessage.objects.filter(
+        status=OutboundMessage.STATUS_SENDING,
+        claimed_by__in=dead,
+    ).update(status=OutboundMessage.STATUS_PENDING, claimed_by='', claimed_at=None)
+
+
+def claim_batch(worker_id, size):
+    """
+    Atomically claim up to ``size`` pending messages for ``worker_id``.
+
+    The claim is a conditional UPDATE on status, so concurrent workers never
+    receive the same row even on databases without SELECT ... SKIP LOCKED.
+    """
+    candidate_ids = list(
+        OutboundMessage.objects.filter(status=OutboundMessage.STATUS_PENDING)
+        .order_by('id')
+        .values_list('id', flat=True)[:size]
+    )
+    if not candidate_ids:
+        return []
+    OutboundMessage.objects.filter(
+        id__in=candidate_ids,
+        status=OutboundMessage.STATUS_PENDING,
+    ).update(
+        status=OutboundMessage.STATUS_SENDING,
+        claimed_by=worker_id,
+        claimed_at=timezone.now(),
+    )
+    return list(
+        OutboundMessage.objects.filter(
+            id__in=candidate_ids,
+            status=OutboundMessage.STATUS_SENDING,
+            claimed_by=worker_id,
+        ).select_related('campaign__template').order_by('id')
+    )
+
+
+def deliver(batch, send=send_batch):
+    """
+    Send a claimed batch and record each outcome.
+
+    ``send`` takes a list of messages and returns one DeliveryResult per
+    message; by default that is send_batch over one SMTP connection. The
+    queue rows, the DeliveryRecord log and each campaign's checkpoint are
+    committed together once per batch, so a restarted worker resends at
+    most the batch that was in flight.
+
+    Temporary failures (see mailer.is_transient) wait for another try, per
+    retry_delay(), until EMAIL_MAX_ATTEMPTS is reached; only then, or on a
+    permanent failure, does a message count as failed.
+
+    Recipient attributes are read when the batch is sent, with one query,
+    so a corrected value reaches the messages still in the queue.
+    """
+    if not batch:
+        return 0, 0
+    # Addresses suppressed since the campaign was queued are dropped here.
+    suppressed = get_suppression_filter().suppressed([item.email for item in batch])
+    if suppressed:
+        skipped = [item for item in batch if item.email in suppressed]
+        batch = [item for item in batch if item.email not in suppressed]
+        _mark_suppressed(skipped)
+        if not batch:
+            return 0, 0
+
+    started = timezone.now()
+    attributes = _recipient_attributes(batch)
+    messages = []
+    unbuilt = {}
+    for item in batch:
+        try:
+            messages.append(build_message(item.campaign.template, item, attributes.get(item.recipient_id)))
+        except Exception as e:
+            # A template that fails to render for one recipient (a broken
+            # tag, an attribute a filter chokes on) fails that message
+            # instead of taking the whole claimed batch down with it.
+            logger.warning("Could not build message %s for %s", item.pk, item.email, exc_info=True)
+            unbuilt[item.pk] = DeliveryResult(None, False, e)
+    sent_results = iter(send(messages) if messages else ())
+    results = [unbuilt.get(item.pk) or next(sent_results) for item in batch]
+
+    now = timezone.now()
+    max_attempts = getattr(settings, 'EMAIL_MAX_ATTEMPTS', 5)
+    sent = failed = deferred = 0
+    records = []
+    progress = defaultdict(lambda: [0, 0, 0])
+    bounced = []
+    for item, result in zip(batch, results):
+        item.attempts += 1
+        item.claimed_by = ''
+        item.claimed_at = None
+        code, response = smtp_reply(result.error)
+        if result.sent:
+            item.status = OutboundMessage.STATUS_SENT
+            item.sent_at = now
+            item.last_error = ''
+            record_status = DeliveryRecord.STATUS_SENT
+            sent += 1
+        elif is_transient(result.error) and item.attempts < max_attempts:
+            item.status = OutboundMessage.STATUS_RETRY
+            item.next_attempt_at = now + timedelta(seconds=retry_delay(item.attempts))
+            item.last_error = describe_failure(result)
+            record_status = DeliveryRecord.STATUS_DEFERRED
+            metrics.MESSAGES_DEFERRED.inc(code=code or 'none')
+            deferred += 1
+        else:
+            item.status = OutboundMessage.STATUS_FAILED
+            item.next_attempt_at = None
+            item.last_error = describe_failure(result)
+            record_status = DeliveryRecord.STATUS_FAILED
+            metrics.MESSAGES_FAILED.inc(code=code or 'none')
+            if code in HARD_BOUNCE_CODES and isinstance(result.error, smtplib.SMTPRecipientsRefused):
+                bounced.append((item.email, response))
+            failed += 1
+        records.append(DeliveryRecord(
+            campaign_id=item.campaign_id,
+            message=item,
+            recipient_id=item.recipient_id,
+            email=item.email,
+            status=record_status,
+            smtp_code=code,
+            smtp_response=response or ('' if result.sent else str(result.error)),
+            attempt=item.attempts,
+            relay=result.relay or '',
+            started_at=started,
+            finished_at=now,
+        ))
+        campaign_progress = progress[item.campaign_id]
+        if item.status != OutboundMessage.STATUS_RETRY:
+            campaign_progress[0 if result.sent else 1] += 1
+        campaign_progress[2] = max(campaign_progress[2], item.pk)
+    delivered = [item.pk for item in batch if item.status == OutboundMessage.STATUS_SENT]
+    undelivered = [item for item in batch if item.status != OutboundMessage.STATUS_SENT]
+    with write_lane():
+        # Successful rows all change the same way, so one UPDATE covers them;
+        # a CASE-per-row bulk_update held the write lock far longer.
+        OutboundMessage.objects.filter(pk__in=delivered).update(
+            status=OutboundMessage.STATUS_SENT,
+            attempts=F('attempts') + 1,
+            last_error='',
+            claimed_by='',
+            claimed_at=None,
+            next_attempt_at=None,
+            sent_at=now,
+        )
+        OutboundMessage.objects.bulk_update(
+            undelivered, ['status', 'attempts', 'last_error', 'claimed_by', 'claimed_at', 'next_attempt_at']
+        )
+        DeliveryRecord.objects.bulk_create(records)
+        for campaign_id, (campaign_sent, campaign_failed, last_id) in progress.items():
+            Campaign.objects.filter(pk=campaign_id).update(
+                sent_count=F('sent_count') + campaign_sent,
+                failed_count=F('failed_count') + campaign_failed,
+                checkpoint=Greatest(Coalesce('checkpoint', Value(0)), Value(last_id)),
+                checkpoint_at=now,
+            )
+    for email, response in bounced:
+        suppress([email], Suppression.REASON_BOUNCE, response)
+    metrics.MESSAGES_SENT.inc(sent)
+    if deferred:
+        logger.info("Deferred %d messages after temporary failures", deferred)
+    complete_finished(progress.keys())
+    return sent, failed
+
+
+def _recipient_attributes(batch):
+    attributes = {}
+    rows = RecipientAttribute.objects.filter(
+        recipient_id__in={item.recipient_id for item in batch if item.recipient_id is not None}
+    ).values_list('recipient_id', 'name', 'value')
+    for recipient_id, name, value in rows:
+        attributes.setdefault(recipient_id, {})[name] = value
+    return attributes
+
+
+def _mark_suppressed(items):
+    per_campaign = defaultdict(int)
+    for item in items:
+        item.status = OutboundMessage.STATUS_SUPPRESSED
+        item.claimed_by = ''
+        item.claimed_at = None
+        per_campaign[item.campaign_id] += 1
+    with write_lane():
+        OutboundMessage.objects.bulk_update(items, ['status', 'claimed_by', 'claimed_at'])
+        for campaign_id, count in per_campaign.items():
+            Campaign.objects.filter(pk=campaign_id).update(suppressed_count=F('suppressed_count') + count)
+    complete_finished(per_campaign.keys())
+
+
+def retry_delay(attempts):
+    """
+    Seconds to wait before retrying a message that has failed ``attempts`` times.
+
+    Doubles from EMAIL_RETRY_BASE_SECONDS up to EMAIL_RETRY_MAX_SECONDS, and
+    half of it is random so a greylisted batch comes back spread out rather
+    than as one burst.
+    """
+    base = getattr(settings, 'EMAIL_RETRY_BASE_SECONDS', 60)
+    delay = min(getattr(settings, 'EMAIL_RETRY_MAX_SECONDS', 6 * 60 * 60), base * 2 ** (attempts - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def promote_due_retries(limit=RETRY_PROMOTE_CHUNK_SIZE):
+    """
+    Put up to ``limit`` messages whose retry time has come back in the queue.
+
+    Returns how many were requeued; the worker calls this before claiming,
+    so retries are sent by the normal claim/deliver loop.
+    """
+    due_ids = list(
+        OutboundMessage.objects.filter(
+            status=OutboundMessage.STATUS_RETRY,
+            next_attempt_at__lte=timezone.now(),
+        ).order_by('next_attempt_at').values_list('id', flat=True)[:limit]
+    )
+    if not due_ids:
+        return 0
+    return OutboundMessage.objects.filter(
+        id__in=due_ids, status=OutboundMessage.STATUS_RETRY,
+    ).update(status=OutboundMessage.STATUS_PENDING, next_attempt_at=None)
+
+
+def complete_finished(campaign_ids):
+    """
+    Mark campaigns with nothing left pending, in flight or waiting to retry
+    as completed.
+    """
+    unfinished = OutboundMessage.objects.filter(
+        campaign_id__in=campaign_ids,
+        status__in=[
+            OutboundMessage.STATUS_PENDING, OutboundMessage.STATUS_SENDING, OutboundMessage.STATUS_RETRY,
+        ],
+    ).values('campaign_id')
+    return Campaign.objects.filter(
+        pk__in=campaign_ids, status=Campaign.STATUS_SENDING,
+    ).exclude(pk__in=unfinished).update(status=Campaign.STATUS_COMPLETED, completed_at=timezone.now())
+
+
+@metrics.REGISTRY.add_collector
+def queue_metrics():
+    counts = dict(
+        OutboundMessage.objects.order_by().values_list('status').annotate(count=Count('id'))
+    )
+    lines = [
+        "# HELP sender_outbox_messages Messages in the outbox, by status.",
+        "# TYPE sender_outbox_messages gauge",
+    ]
+    for status, _ in OutboundMessage.STATUS_CHOICES:
+        lines.append(f'sender_outbox_messages{{status="{status}"}} {counts.get(status, 0)}')
+    return lines
@@ -0,0 +1,144 @@
+import base64
+import binascii
+import json
+
+from django.db.models import Q
+
+SORT_FIELDS = ('id', 'username', 'email')
+DEFAULT_PAGE_SIZE = 10
+MAX_PAGE_SIZE = 500
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(payload):
+    raw = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        payload = json.loads(raw)
+    except (binascii.Error, ValueError, TypeError):
+        raise InvalidCursor("Malformed cursor.")
+    if not isinstance(payload, dict) or not {'s', 'k', 'i', 'd'} <= payload.keys():
+        raise InvalidCursor("Malformed cursor.")
+    sort_by = payload['s'].split(':')[0] if isinstance(payload['s'], str) else None
+    # The boundary values end up in the query; a wrong type there is a
+    # database error, not a bad request.
+    key_type = int if sort_by == 'id' else str
+    if (
+        sort_by not in SORT_FIELDS
+        or payload['d'] not in ('next', 'prev')
+        or not _is_int(payload['i'])
+        or not (_is_int(payload['k']) if key_type is int else isinstance(payload['k'], str))
+    ):
+        raise InvalidCursor("Malformed cursor.")
+    return payload
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def parse_page_size(value, default=DEFAULT_PAGE_SIZE):
+    try:
+        return max(1, min(int(value), MAX_PAGE_SIZE))
+    except (TypeError, ValueError):
+        return default
+
+
+class KeysetPage:
+    """
+    One page of a keyset-paginated queryset.
+
+    ``next_cursor``/``previous_cursor`` are opaque tokens to pass back as
+    ``cursor`` for the adjacent page, or None at either end.
+    """
+
+    def __init__(self, items, next_cursor, previous_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def _after(field, value, pk, descending):
+    # Rows strictly after (value, pk) in the (field, id) ordering.
+    if field == 'id':
+        return Q(id__lt=pk) if descending else Q(id__gt=pk)
+    lookup = 'lt' if descending else 'gt'
+    return Q(**{f'{field}__{lookup}': value}) | Q(**{field: value, f'id__{lookup}': pk})
+
+
+def normalise_sort(sort_by, sort_dir):
+    return (sort_by if sort_by in SORT_FIELDS else 'id'), sort_dir == 'desc'
+
+
+def ordering_for(sort_by, descending):
+    prefix = '-' if descending else ''
+    if sort_by == 'id':
+        return [f'{prefix}id']
+    return [f'{prefix}{sort_by}', f'{prefix}id']
+
+
+def keyset_paginate(queryset, sort_by='id', sort_dir='asc', page_size=DEFAULT_PAGE_SIZE, cursor=None):
+    """
+    Return a KeysetPage of ``queryset`` ordered by (sort_by, id).
+
+    Each page is a range scan from the previous page's boundary row, so page
+    1000 costs the same as page 1: no OFFSET and no COUNT(*). A cursor from
+    a different sort order is ignored and the first page returned.
+    """
+    sort_by, descending = normalise_sort(sort_by, sort_dir)
+    sort_key = f"{sort_by}:{'desc' if descending else 'asc'}"
+
+    payload = None
+    if cursor:
+        payload = decode_cursor(cursor)
+        if payload['s'] != sort_key:
+            payload = None
+
+    backwards = payload is not None and payload['d'] == 'prev'
+    # Walking backwards means scanning the reverse ordering from the cursor.
+    scan_descending = descending != backwards
+    ordering = ordering_for(sort_by, scan_descending)
+
+    if payload is not None:
+        queryset = queryset.filter(_after(sort_by, payload['k'], payload['i'], scan_descending))
+    rows = list(queryset.order_by(*ordering)[:page_size + 1])
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if backwards:
+        rows.reverse()
+
+    def boundary(row, direction):
+        return encode_cursor({'s': sort_key, 'k': getattr(row, sort_by), 'i': row.pk, 'd': direction})
+
+    if not rows:
+        return KeysetPage([], None, None)
+    if backwards:
+        has_next, has_previous = True, has_more
+    else:
+        has_next, has_previous = has_more, payload is not None
+    return KeysetPage(
+        rows,
+        boundary(rows[-1], 'next') if has_next else None,
+        boundary(rows[0], 'prev') if has_previous else None,
+    )
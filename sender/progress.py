@@ -0,0 +1,152 @@
+import asyncio
+import json
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import Campaign
+
+PROGRESS_FIELDS = (
+    'status', 'total', 'sent_count', 'failed_count', 'suppressed_count', 'created_at', 'completed_at',
+)
+
+
+def _refresh_seconds():
+    return getattr(settings, 'PROGRESS_REFRESH_SECONDS', 1)
+
+
+def _build_snapshot(campaign_id, row, previous, now):
+    processed = row['sent_count'] + row['failed_count'] + row['suppressed_count']
+    # Throughput is measured against a reference sample at least
+    # PROGRESS_RATE_WINDOW seconds old, so it doesn't jump with every batch.
+    window = getattr(settings, 'PROGRESS_RATE_WINDOW', 10)
+    reference = (now, processed)
+    rate = 0.0
+    if previous is not None:
+        reference = tuple(previous['reference'])
+        if now - reference[0] > 0:
+            rate = max(0.0, (processed - reference[1]) / (now - reference[0]))
+        if now - reference[0] >= window:
+            reference = (previous['at'], previous['processed'])
+    done = row['status'] == Campaign.STATUS_COMPLETED
+    if done:
+        rate = 0.0
+    remaining = max(0, row['total'] - processed)
+    finished_at = row['completed_at'].timestamp() if row['completed_at'] else now
+    elapsed = finished_at - row['created_at'].timestamp()
+    return {
+        'campaign': campaign_id,
+        'status': row['status'],
+        'done': done,
+        'total': row['total'],
+        'sent': row['sent_count'],
+        'failed': row['failed_count'],
+        'suppressed': row['suppressed_count'],
+        'processed': processed,
+        'remaining': remaining,
+        'rate': round(rate, 1),
+        'average_rate': round(processed / elapsed, 1) if elapsed > 0 else 0.0,
+        'eta_seconds': round(remaining / rate) if rate and remaining else None,
+        'at': now,
+        'reference': reference,
+    }
+
+
+def get_progress(campaign_id):
+    """
+    Return a campaign's progress counters as a dict, or None if it's gone.
+
+    Only the campaign row is read, at most once per PROGRESS_REFRESH_SECONDS
+    per cache backend however many viewers ask, so watching a send never
+    touches the contacts or the queue.
+    """
+    key = f'sender:campaign-progress:{campaign_id}'
+    now = time.time()
+    snapshot = cache.get(key)
+    if snapshot is not None and (snapshot['done'] or now - snapshot['at'] < _refresh_seconds()):
+        return snapshot
+    row = Campaign.objects.filter(pk=campaign_id).values(*PROGRESS_FIELDS).first()
+    if row is None:
+        cache.delete(key)
+        return None
+    snapshot = _build_snapshot(campaign_id, row, snapshot, now)
+    cache.set(key, snapshot, 60 * 60)
+    return snapshot
+
+
+def wsgi_stream_seconds():
+    """
+    How long a progress stream may hold a WSGI worker thread.
+
+    PROGRESS_WSGI_STREAM_SECONDS, 0 by default: one event per request, and
+    the browser asks again after the stream's ``retry`` delay, so a page
+    left open never pins a thread.
+    """
+    return getattr(settings, 'PROGRESS_WSGI_STREAM_SECONDS', 0)
+
+
+def _event(name, data):
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+class ProgressStream:
+    """
+    Server-Sent Events for one campaign.
+
+    Emits a ``progress`` event whenever the counters change, a comment line
+    as a keep-alive, and ends after the campaign completes or after
+    ``duration`` seconds (EventSource then reconnects on its own, after the
+    ``retry`` delay). Use aevents() under ASGI, where a waiting viewer costs
+    no thread, and events() under WSGI, where every open stream holds a
+    worker thread: there a short duration, see wsgi_stream_seconds(), turns
+    the stream into polling.
+    """
+
+    def __init__(self, campaign_id, duration=None):
+        self.campaign_id = campaign_id
+        self.duration = getattr(settings, 'PROGRESS_STREAM_SECONDS', 300) if duration is None else duration
+        self.started = self.written = time.monotonic()
+        self.last = None
+
+    def step(self):
+        """
+        Return (text to send, possibly empty; whether the stream is finished).
+        """
+        snapshot = get_progress(self.campaign_id)
+        now = time.monotonic()
+        if snapshot is None:
+            return _event('gone', {'campaign': self.campaign_id}), True
+        finished = snapshot['done'] or now - self.started >= self.duration
+        state = (snapshot['status'], snapshot['processed'], snapshot['rate'])
+        if state != self.last:
+            self.last = state
+            self.written = now
+            data = {name: value for name, value in snapshot.items() if name != 'reference'}
+            return _event('progress', data), finished
+        if now - self.written >= 15:
+            self.written = now
+            return ": keep-alive\n\n", finished
+        return '', finished
+
+    def events(self):
+        yield "retry: 3000\n\n"
+        while True:
+            text, finished = self.step()
+            if text:
+                yield text
+            if finished:
+                return
+            time.sleep(_refresh_seconds())
+
+    async def aevents(self):
+        yield "retry: 3000\n\n"
+        step = sync_to_async(self.step)
+        while True:
+            text, finished = await step()
+            if text:
+                yield text
+            if finished:
+                return
+            await asyncio.sleep(_refresh_seconds())
@@ -0,0 +1,237 @@
+import asyncio
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .database import write_lane
+from .models import DeliveryRecord, OutboundMessage, RateSchedule
+from .site_config import get_site_settings
+
+
+class TokenBucket:
+    """
+    Token bucket allowing ``rate`` sends per ``period`` seconds.
+
+    Tokens are reserved ahead of time: a caller that finds the bucket empty
+    is told exactly how long to wait for its token rather than polling, so
+    concurrent senders are spaced evenly at the configured rate. ``burst``
+    is the bucket size; the default of one token means no bursts at all.
+    """
+
+    def __init__(self, rate, period, burst=1):
+        self.interval = period / rate
+        self.capacity = max(1, burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, n=1):
+        """
+        Take ``n`` tokens and return the seconds to wait before using them.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) / self.interval)
+            self.updated = now
+            self.tokens -= n
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens * self.interval
+
+
+class SharedTokenBucket:
+    """
+    A TokenBucket whose pace is shared by every worker process.
+
+    The schedule of send slots lives in a RateSchedule row: a process takes
+    a block of consecutive slots (RATE_LIMIT_BLOCK_SECONDS worth) in one
+    short write transaction and hands them out locally, one ``interval``
+    apart. Blocks never overlap, so however many workers run, the relay
+    sees at most ``rate`` messages per ``period``. Slots a slow process
+    didn't use in time are skipped rather than sent late in a burst.
+
+    Workers on different machines compare wall clocks, so keep them in sync.
+    """
+
+    shared = True
+
+    def __init__(self, key, rate, period):
+        self.key = key
+        self.interval = period / rate
+        self.block = max(1, int(getattr(settings, 'RATE_LIMIT_BLOCK_SECONDS', 1.0) / self.interval))
+        self.next_at = 0.0
+        self.left = 0
+        self._lock = threading.Lock()
+
+    def _take_block(self, count, now):
+        with write_lane():
+            schedule, _ = RateSchedule.objects.select_for_update().get_or_create(
+                key=self.key, defaults={'next_at': now},
+            )
+            start = max(schedule.next_at, now)
+            RateSchedule.objects.filter(pk=schedule.pk).update(next_at=start + count * self.interval)
+        return start
+
+    def reserve(self, n=1):
+        """
+        Take ``n`` slots and return the seconds to wait before using them.
+        """
+        with self._lock:
+            now = time.time()
+            if self.left and now - self.next_at > self.interval:
+                skipped = min(self.left, int((now - self.next_at) / self.interval))
+                self.next_at += skipped * self.interval
+                self.left -= skipped
+            if self.left < n:
+                count = max(self.block, n)
+                self.next_at = self._take_block(count, now)
+                self.left = count
+            at = self.next_at
+            self.next_at += n * self.interval
+            self.left -= n
+            return max(0.0, at - now)
+
+
+class RateLimiter:
+    """
+    Combine per-second and per-minute buckets for one relay.
+
+    With a ``key`` the buckets are SharedTokenBuckets, so the limits hold
+    across every send_outbox process; without one they only pace this
+    process. wait() blocks a thread, wait_async() suspends a coroutine;
+    both return once a message may be sent without exceeding either limit.
+    """
+
+    def __init__(self, per_second=None, per_minute=None, key=None):
+        self.limits = (per_second, per_minute)
+        self.buckets = []
+        if per_second:
+            self.buckets.append(self._bucket(key, 'second', per_second, 1.0))
+        if per_minute:
+            self.buckets.append(self._bucket(key, 'minute', per_minute, 60.0))
+
+    @staticmethod
+    def _bucket(key, name, rate, period):
+        if key is None:
+            return TokenBucket(rate, period)
+        return SharedTokenBucket(f'{key}:{name}', rate, period)
+
+    @property
+    def shared(self):
+        return any(getattr(bucket, 'shared', False) for bucket in self.buckets)
+
+    def reserve(self):
+        # Every bucket is charged up front, so the delay is the longest wait.
+        return max([bucket.reserve() for bucket in self.buckets], default=0.0)
+
+    def wait(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def wait_async(self):
+        if self.shared:
+            # Taking a block of slots is a database write; keep it off the loop.
+            delay = await asyncio.to_thread(self.reserve)
+        else:
+            delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def combine_limiters(*limiters):
+    """
+    Return a limiter enforcing all of ``limiters`` at once, or None.
+
+    The buckets are shared, not copied, so pacing state carries over.
+    """
+    limiters = [limiter for limiter in limiters if limiter is not None and limiter.buckets]
+    if len(limiters) <= 1:
+        return limiters[0] if limiters else None
+    combined = RateLimiter()
+    combined.limits = tuple(limiter.limits for limiter in limiters)
+    combined.buckets = [bucket for limiter in limiters for bucket in limiter.buckets]
+    return combined
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+_claim_lock = threading.Lock()
+
+
+def get_rate_limits():
+    """
+    Return (per_second, per_minute, per_day) from SiteSettings; None means unlimited.
+    """
+    site_settings = get_site_settings()
+    if site_settings is None:
+        return None, None, None
+    return (
+        site_settings.rate_limit_per_second,
+        site_settings.rate_limit_per_minute,
+        site_settings.rate_limit_per_day,
+    )
+
+
+def get_rate_limiter(per_second=None, per_minute=None):
+    """
+    Return the process-wide limiter for the SiteSettings limits, shared by
+    every sender thread and paced together with the other workers.
+
+    The existing limiter (and the pacing state in it) is kept as long as the
+    limits don't change.
+    """
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None or _limiter.limits != (per_second, per_minute):
+            _limiter = RateLimiter(per_second, per_minute, key='site')
+        return _limiter
+
+
+def daily_remaining(per_day):
+    """
+    Messages that may still be handed to the relay in the rolling 24 hours.
+
+    Every delivery attempt counts against the quota, deferred and refused
+    ones too, since providers meter what they are handed rather than what
+    they accept; so do batches currently claimed by any worker, so several
+    workers can share it.
+    """
+    if not per_day:
+        return None
+    used = attempts_since(timezone.now() - timedelta(days=1)).count()
+    used += OutboundMessage.objects.filter(status=OutboundMessage.STATUS_SENDING).count()
+    return max(0, per_day - used)
+
+
+def attempts_since(cutoff):
+    """
+    DeliveryRecords of the attempts finished since ``cutoff``.
+    """
+    # Every status, listed so the (status, finished_at) indexes are used.
+    return DeliveryRecord.objects.filter(
+        status__in=[DeliveryRecord.STATUS_SENT, DeliveryRecord.STATUS_DEFERRED, DeliveryRecord.STATUS_FAILED],
+        finished_at__gte=cutoff,
+    )
+
+
+def claim_within_quota(claim, batch_size, per_day, relay_remaining=None):
+    """
+    Call ``claim(size)`` with the batch size capped by the daily quota.
+
+    ``relay_remaining``, if given, returns what the relays' own daily quotas
+    still allow in total (None for unlimited) and caps the batch too.
+    """
+    # Checking the quota and claiming must not interleave between threads,
+    # or each of them could claim the same remaining allowance.
+    with _claim_lock:
+        size = batch_size
+        for remaining in (daily_remaining(per_day), relay_remaining() if relay_remaining else None):
+            if remaining is not None:
+                size = min(size, remaining)
+        if size <= 0:
+            return []
+        return claim(size)
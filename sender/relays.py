@@ -0,0 +1,362 @@
+import logging
+import smtplib
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import metrics
+from .backends import DynamicSMTPBackend, get_smtp_config
+from .mailer import DeliveryResult, send_batch
+from .models import RelayProfile
+from .ratelimit import RateLimiter, attempts_since, combine_limiters
+
+logger = logging.getLogger(__name__)
+
+# Name used for the SiteSettings relay when no profiles are active.
+DEFAULT_RELAY = 'default'
+
+# Errors that say something about the relay rather than the recipient.
+_RELAY_ERRORS = (
+    smtplib.SMTPConnectError,
+    smtplib.SMTPHeloError,
+    smtplib.SMTPAuthenticationError,
+    smtplib.SMTPSenderRefused,
+    smtplib.SMTPServerDisconnected,
+    smtplib.SMTPNotSupportedError,
+)
+
+
+def is_relay_fault(error):
+    """
+    Whether a failed send should count against the relay's health.
+
+    Temporary (4xx) replies, refused sessions, logins or senders and
+    network errors do; permanent rejections of a recipient or of the
+    content, and any other SMTP error, don't, since another relay would
+    get the same answer.
+    """
+    if error is None:
+        return False
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return any(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, _RELAY_ERRORS):
+        return True
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    if isinstance(error, smtplib.SMTPException):
+        # Every SMTPException is an OSError, so rule the rest out first.
+        return False
+    return isinstance(error, (ConnectionError, TimeoutError, socket.gaierror))
+
+
+def smtp_engine(messages, config=None, limiter=None):
+    """
+    Send over one Django SMTP connection to the relay described by ``config``.
+    """
+    return send_batch(messages, connection=DynamicSMTPBackend(relay=config), limiter=limiter)
+
+
+class RelayHealth:
+    """
+    How one relay has been doing in this process.
+
+    ``error_rate`` is a moving average of the share of relay faults per
+    batch; it scales the relay's traffic down (to no less than
+    RELAY_MIN_SHARE of its weight). Once it reaches RELAY_TRIP_ERROR_RATE
+    the relay is benched for RELAY_COOLDOWN_SECONDS, doubling on every
+    consecutive trip up to RELAY_MAX_COOLDOWN_SECONDS. After the cool-down
+    one clean batch brings it back; one more faulty batch benches it again.
+    """
+
+    def __init__(self):
+        self.error_rate = 0.0
+        self.trips = 0
+        self.cooldown_until = 0.0
+        self._lock = threading.Lock()
+
+    def available(self, now=None):
+        return (time.monotonic() if now is None else now) >= self.cooldown_until
+
+    def factor(self):
+        return max(getattr(settings, 'RELAY_MIN_SHARE', 0.1), 1.0 - self.error_rate)
+
+    def record(self, attempted, faults):
+        """
+        Update the health after a batch; return True if the relay was benched.
+        """
+        if not attempted:
+            return False
+        with self._lock:
+            self.error_rate = 0.5 * self.error_rate + 0.5 * faults / attempted
+            if self.error_rate >= getattr(settings, 'RELAY_TRIP_ERROR_RATE', 0.5):
+                self.trips += 1
+                base = getattr(settings, 'RELAY_COOLDOWN_SECONDS', 30)
+                cooldown = min(getattr(settings, 'RELAY_MAX_COOLDOWN_SECONDS', 600), base * 2 ** (self.trips - 1))
+                self.cooldown_until = time.monotonic() + cooldown
+                return True
+            if not faults:
+                self.trips = 0
+            return False
+
+
+class Relay:
+    def __init__(self, name, config, weight=1, per_second=None, per_minute=None, per_day=None, health=None):
+        self.name = name
+        self.config = config
+        self.weight = weight
+        self.per_day = per_day
+        self.limiter = RateLimiter(per_second, per_minute, key=f'relay:{name}')
+        self.health = health or RelayHealth()
+
+    def effective_weight(self):
+        return self.weight * self.health.factor()
+
+    def remaining_today(self):
+        """
+        Messages this relay may still take in the rolling 24 hours, or None.
+
+        Counts every attempt it was handed, like ratelimit.daily_remaining().
+        """
+        if not self.per_day:
+            return None
+        used = attempts_since(timezone.now() - timedelta(days=1)).filter(relay=self.name).count()
+        return max(0, self.per_day - used)
+
+
+def _split(count, relays, allowances):
+    """
+    Share ``count`` messages over ``relays`` by effective weight, within
+    each relay's daily allowance where possible. Returns a list of counts.
+    """
+    weights = [relay.effective_weight() for relay in relays]
+    total = sum(weights)
+    exact = [count * weight / total for weight in weights]
+    shares = [int(value) for value in exact]
+    # Largest remainders get the messages lost to rounding down.
+    for index in sorted(range(len(relays)), key=lambda i: exact[i] - shares[i], reverse=True)[:count - sum(shares)]:
+        shares[index] += 1
+
+    overflow = 0
+    for index, allowance in enumerate(allowances):
+        if allowance is not None and shares[index] > allowance:
+            overflow += shares[index] - allowance
+            shares[index] = allowance
+    for index in sorted(range(len(relays)), key=lambda i: weights[i], reverse=True):
+        if not overflow:
+            break
+        room = overflow if allowances[index] is None else max(0, allowances[index] - shares[index])
+        taken = min(room, overflow)
+        shares[index] += taken
+        overflow -= taken
+    if overflow:
+        # Every quota is used up (another worker got there first); the
+        # overshoot goes to the heaviest relay rather than failing the batch.
+        shares[weights.index(max(weights))] += overflow
+    return shares
+
+
+class RelayPool:
+    """
+    Weighted, health-aware load balancing over the configured relays.
+
+    send() splits a batch over the available relays by weight times health,
+    sends the shares in parallel, then retries the messages that failed
+    because of a relay (see is_relay_fault) once on the relays that had no
+    such failures. A relay returning 4xx replies therefore loses traffic
+    gradually and is benched if it keeps failing, without its share of the
+    batch being lost.
+    """
+
+    def __init__(self, relays, signature=None):
+        self.relays = relays
+        self.signature = signature
+
+    def get(self, name):
+        for relay in self.relays:
+            if relay.name == name:
+                return relay
+        return None
+
+    def available(self, exclude=(), probe=True):
+        """
+        Relays not cooling down. With ``probe``, if every relay is benched,
+        the one whose cool-down ends first is returned so mail keeps moving.
+        """
+        now = time.monotonic()
+        candidates = [relay for relay in self.relays if relay.name not in exclude]
+        healthy = [relay for relay in candidates if relay.health.available(now)]
+        if healthy or not probe or not candidates:
+            return healthy
+        return [min(candidates, key=lambda relay: relay.health.cooldown_until)]
+
+    def daily_remaining(self):
+        """
+        Combined daily allowance of the relays, or None if any is unlimited.
+        """
+        total = 0
+        for relay in self.relays:
+            remaining = relay.remaining_today()
+            if remaining is None:
+                return None
+            total += remaining
+        return total
+
+    def _send_share(self, engine, relay, messages, limiter):
+        try:
+            results = engine(messages, config=relay.config, limiter=combine_limiters(limiter, relay.limiter))
+        except Exception as e:
+            logger.exception("Relay %s failed a batch", relay.name)
+            results = [DeliveryResult(message, False, e) for message in messages]
+        results = [result._replace(relay=relay.name) for result in results]
+
+        faults = sum(1 for result in results if not result.sent and is_relay_fault(result.error))
+        sent = sum(1 for result in results if result.sent)
+        metrics.RELAY_MESSAGES.inc(sent, relay=relay.name, outcome='sent')
+        metrics.RELAY_MESSAGES.inc(len(results) - sent, relay=relay.name, outcome='failed')
+        if relay.health.record(len(results), faults):
+            metrics.RELAY_TRIPS.inc(relay=relay.name)
+            logger.warning(
+                "Relay %s benched after %d of %d messages failed (error rate %.2f)",
+                relay.name, faults, len(results), relay.health.error_rate,
+            )
+        return results
+
+    def _send_over(self, engine, relays, messages, indices, results, limiter):
+        allowances = [relay.remaining_today() for relay in relays]
+        shares = []
+        start = 0
+        for relay, count in zip(relays, _split(len(indices), relays, allowances)):
+            if count:
+                shares.append((relay, indices[start:start + count]))
+                start += count
+
+        def run(share):
+            relay, share_indices = share
+            return share_indices, self._send_share(
+                engine, relay, [messages[index] for index in share_indices], limiter,
+            )
+
+        if len(shares) == 1:
+            outcomes = [run(shares[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=len(shares), thread_name_prefix='relay') as executor:
+                outcomes = list(executor.map(run, shares))
+        for share_indices, share_results in outcomes:
+            for index, result in zip(share_indices, share_results):
+                results[index] = result
+
+    def send(self, engine, messages, limiter=None):
+        """
+        Send ``messages`` with ``engine`` (smtp_engine, or deliver_messages
+        for the async engine) and return DeliveryResults in input order.
+        """
+        messages = list(messages)
+        if not messages:
+            return []
+        results = [None] * len(messages)
+        relays = self.available()
+        if not relays:
+            raise RuntimeError("No SMTP relay is configured.")
+        self._send_over(engine, relays, messages, list(range(len(messages))), results, limiter)
+
+        failed_over = [index for index, result in enumerate(results) if not result.sent and is_relay_fault(result.error)]
+        if failed_over:
+            faulty = {results[index].relay for index in failed_over}
+            fallback = self.available(exclude=faulty, probe=False)
+            if fallback:
+                logger.info("Retrying %d messages on %s", len(failed_over), ', '.join(r.name for r in fallback))
+                metrics.RELAY_FAILOVERS.inc(len(failed_over))
+                self._send_over(engine, fallback, messages, failed_over, results, limiter)
+        return results
+
+
+_pool = None
+_checked_at = None
+_pool_lock = threading.Lock()
+
+
+def _build_pool(signature, profiles, previous):
+    defaults = get_smtp_config()
+    if not profiles:
+        relays = [Relay(DEFAULT_RELAY, defaults)]
+    else:
+        relays = [
+            Relay(
+                profile.name,
+                {
+                    'host': profile.email_host,
+                    'port': profile.email_port,
+                    'username': profile.email_host_user,
+                    'password': profile.email_host_password,
+                    'use_tls': profile.email_use_tls,
+                    'use_ssl': profile.email_use_ssl,
+                    'default_from_email': profile.default_from_email or defaults['default_from_email'],
+                },
+                weight=profile.weight,
+                per_second=profile.rate_limit_per_second,
+                per_minute=profile.rate_limit_per_minute,
+                per_day=profile.rate_limit_per_day,
+            )
+            for profile in profiles
+        ]
+    if previous is not None:
+        # Editing one relay shouldn't forget what we know about the others.
+        for relay in relays:
+            old = previous.get(relay.name)
+            if old is not None:
+                relay.health = old.health
+                if old.limiter.limits == relay.limiter.limits:
+                    relay.limiter = old.limiter
+    return RelayPool(relays, signature)
+
+
+def get_relay_pool():
+    """
+    Return this process's RelayPool.
+
+    Active RelayProfiles are re-read at most every RELAY_REFRESH_SECONDS
+    (sooner after a change made in this process) and the pool is rebuilt
+    only if they or the SiteSettings changed.
+    """
+    global _pool, _checked_at
+    with _pool_lock:
+        now = time.monotonic()
+        if _pool is not None and _checked_at is not None and now - _checked_at < getattr(settings, 'RELAY_REFRESH_SECONDS', 30):
+            return _pool
+        profiles = list(RelayProfile.objects.filter(is_active=True))
+        # The resolved SiteSettings relay rather than its version, which a
+        # replaced row can share with the one it replaced.
+        signature = (
+            tuple((profile.pk, profile.updated_at) for profile in profiles),
+            tuple(sorted(get_smtp_config().items())),
+        )
+        if _pool is None or _pool.signature != signature:
+            _pool = _build_pool(signature, profiles, _pool)
+        _checked_at = now
+        return _pool
+
+
+def invalidate_relay_pool():
+    global _checked_at
+    _checked_at = None
+
+
+@metrics.REGISTRY.add_collector
+def relay_metrics():
+    pool = _pool
+    if pool is None:
+        return []
+    now = time.monotonic()
+    lines = [
+        "# HELP sender_relay_weight Effective share weight of each relay (0 while benched).",
+        "# TYPE sender_relay_weight gauge",
+    ]
+    for relay in pool.relays:
+        weight = relay.effective_weight() if relay.health.available(now) else 0
+        lines.append(metrics.sample('sender_relay_weight', weight, relay=relay.name))
+    return lines
@@ -0,0 +1,52 @@
+from django.db import connections
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+SEARCH_TABLE = 'sender_useremail_fts'
+# The trigram tokenizer can only match terms of at least three characters.
+MIN_INDEXED_QUERY_LENGTH = 3
+
+_index_available = {}
+
+
+def search_index_available(using='default'):
+    """
+    Whether the FTS5 trigram index from migration 0005 exists on ``using``.
+    """
+    connection = connections[using]
+    key = (using, str(connection.settings_dict['NAME']))
+    if key not in _index_available:
+        available = False
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [SEARCH_TABLE]
+                )
+                available = cursor.fetchone() is not None
+        _index_available[key] = available
+    return _index_available[key]
+
+
+def _match_phrase(query):
+    # Quote the whole input as one FTS5 phrase so operators and punctuation
+    # in what the user typed are matched literally.
+    return '"' + query.replace('"', '""') + '"'
+
+
+def search_emails(queryset, query):
+    """
+    Filter a UserEmail queryset to rows whose username or email contains
+    ``query``, case-insensitively.
+
+    Uses the trigram index when it is available and the query is long
+    enough, and falls back to icontains otherwise, with identical results.
+    """
+    query = (query or '').strip()
+    if not query:
+        return queryset
+    if len(query) >= MIN_INDEXED_QUERY_LENGTH and search_index_available(queryset.db):
+        return queryset.filter(id__in=RawSQL(
+            f"SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s",
+            [_match_phrase(query)],
+        ))
+    return queryset.filter(Q(username__icontains=query) | Q(email__icontains=query))
@@ -0,0 +1,61 @@
+import re
+from collections import namedtuple
+
+from .models import RecipientAttribute, normalize_attribute_name
+
+# One ``name=value`` (or ``name!=value``) condition of a segment.
+Term = namedtuple('Term', ['name', 'value', 'negated'])
+
+_TERM = re.compile(r'\s*([A-Za-z][\w-]*)\s*(!=|=)\s*("(?:[^"]|"")*"|[^\s"]+)\s*')
+_AND = re.compile(r'AND\b', re.IGNORECASE)
+
+
+class InvalidSegment(ValueError):
+    pass
+
+
+def parse_segment(text):
+    """
+    Parse ``country=DE AND plan=pro`` into a list of Terms.
+
+    Names are matched like import columns (case-insensitively, see
+    normalize_attribute_name); values exactly, in double quotes if they
+    contain spaces. An empty segment has no terms and matches everyone.
+    """
+    text = (text or '').strip()
+    terms = []
+    position = 0
+    while position < len(text):
+        if terms:
+            separator = _AND.match(text, position)
+            if separator is None:
+                raise InvalidSegment(f"Expected AND at position {position + 1} of the segment.")
+            position = separator.end()
+        match = _TERM.match(text, position)
+        if match is None:
+            raise InvalidSegment(f"Expected name=value at position {position + 1} of the segment.")
+        name, operator, value = match.groups()
+        if value.startswith('"'):
+            value = value[1:-1].replace('""', '"')
+        terms.append(Term(normalize_attribute_name(name), value, operator == '!='))
+        position = match.end()
+    return terms
+
+
+def filter_segment(queryset, segment):
+    """
+    Narrow a UserEmail queryset to a segment (text or parsed Terms).
+
+    Every term becomes an ``id IN (SELECT recipient_id ...)`` on one
+    (name, value) range of the attribute index, so the segment is resolved
+    inside the database as one set-based query, however many contacts it
+    covers. ``!=`` also matches contacts without the attribute.
+    """
+    terms = parse_segment(segment) if isinstance(segment, str) else segment
+    for term in terms:
+        ids = RecipientAttribute.objects.filter(name=term.name, value=term.value).values('recipient_id')
+        if term.negated:
+            queryset = queryset.exclude(id__in=ids)
+        else:
+            queryset = queryset.filter(id__in=ids)
+    return queryset
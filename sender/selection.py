@@ -0,0 +1,142 @@
+from django.db import connections, models, router
+
+from . import stats
+from .database import write_lane
+from .models import UserEmail
+from .search import search_emails
+from .segments import filter_segment, parse_segment
+
+# Ids per chunk; well under SQLite's bound-parameter limit.
+SELECTION_CHUNK_SIZE = 500
+
+
+def _parse_ids(values):
+    ids = set()
+    for value in values:
+        try:
+            ids.add(int(value))
+        except (TypeError, ValueError):
+            continue
+    return ids
+
+
+class Selection:
+    """
+    A set of contacts chosen in the list view.
+
+    Either every contact matching ``query`` and ``segment`` (``all_matching``)
+    minus the ``exclude`` ids, or just the ``include`` ids. It is resolved on
+    the server in id order, one chunk at a time, so "all 80k matching" never
+    travels as 80k ids or becomes one enormous ``id IN (...)``.
+    """
+
+    def __init__(self, query='', all_matching=False, include=(), exclude=(), segment=''):
+        self.query = (query or '').strip()
+        self.segment = (segment or '').strip()
+        # Parsed up front so a malformed segment (InvalidSegment) is
+        # reported before anything is queued or deleted.
+        self.terms = parse_segment(self.segment)
+        self.all_matching = all_matching
+        self.include = set(include)
+        self.exclude = set(exclude)
+
+    @classmethod
+    def from_post(cls, data):
+        return cls(
+            query=data.get('q', ''),
+            all_matching=data.get('select_all') == '1',
+            include=_parse_ids(data.getlist('email_ids')),
+            exclude=_parse_ids(data.getlist('exclude_ids')),
+            segment=data.get('segment', ''),
+        )
+
+    def __bool__(self):
+        return self.all_matching or bool(self.include - self.exclude)
+
+    def matching(self):
+        return filter_segment(search_emails(UserEmail.objects.all(), self.query), self.terms)
+
+    def iter_id_chunks(self, chunk_size=SELECTION_CHUNK_SIZE):
+        """
+        Yield ascending lists of selected ids, at most ``chunk_size`` each.
+        """
+        if not self.all_matching:
+            ids = sorted(self.include - self.exclude)
+            for start in range(0, len(ids), chunk_size):
+                yield ids[start:start + chunk_size]
+            return
+
+        queryset = self.matching().order_by('id').values_list('id', flat=True)
+        if self.query or self.segment:
+            # Re-running the search or segment for every chunk would cost a
+            # full index lookup each time; the matching ids alone are small
+            # enough to resolve once.
+            ids = [pk for pk in queryset if pk not in self.exclude]
+            for start in range(0, len(ids), chunk_size):
+                yield ids[start:start + chunk_size]
+            return
+
+        last_id = 0
+        while True:
+            ids = list(queryset.filter(id__gt=last_id)[:chunk_size])
+            if not ids:
+                return
+            last_id = ids[-1]
+            chunk = [pk for pk in ids if pk not in self.exclude]
+            if chunk:
+                yield chunk
+
+    def queryset(self):
+        """
+        The selected contacts as one queryset, for set-based writes.
+        """
+        if self.all_matching:
+            queryset = self.matching()
+            return queryset.exclude(id__in=self.exclude) if self.exclude else queryset
+        return UserEmail.objects.filter(id__in=self.include - self.exclude)
+
+
+def _raw_deletable():
+    # Plain DELETEs are only safe when every reference to a contact can be
+    # handled up front with a set-based UPDATE or DELETE.
+    return all(
+        relation.on_delete in (models.SET_NULL, models.CASCADE)
+        for relation in UserEmail._meta.related_objects
+    )
+
+
+def delete_selection(selection, chunk_size=SELECTION_CHUNK_SIZE):
+    """
+    Delete the selected contacts chunk by chunk and return how many went.
+
+    Each chunk is its own transaction: references are cleared or cascaded
+    with one statement per relation, then the contacts are removed with a
+    single DELETE, instead of Django collecting and deleting row by row.
+    """
+    using = router.db_for_write(UserEmail)
+    connection = connections[using]
+    table = connection.ops.quote_name(UserEmail._meta.db_table)
+    raw = _raw_deletable()
+    deleted = 0
+    for ids in selection.iter_id_chunks(chunk_size):
+        with write_lane(using):
+            if raw:
+                for relation in UserEmail._meta.related_objects:
+                    related = relation.related_model._base_manager.using(using).filter(
+                        **{f'{relation.field.name}__in': ids}
+                    )
+                    if relation.on_delete is models.SET_NULL:
+                        related.update(**{relation.field.name: None})
+                    else:
+                        related.delete()
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        f"DELETE FROM {table} WHERE id IN ({', '.join(['%s'] * len(ids))})", ids
+                    )
+                    count = cursor.rowcount
+            else:
+                _, counts = UserEmail.objects.using(using).filter(id__in=ids).delete()
+                count = counts.get(UserEmail._meta.label, 0)
+            stats.recipients_removed(count)
+        deleted += count
+    return deleted
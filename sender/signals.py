@@ -0,0 +1,60 @@
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.template import TemplateSyntaxError
+
+from . import stats
+from .database import configure_connection
+from .models import EmailTemplate, RelayProfile, SiteSettings, Suppression, UserEmail
+from .relays import invalidate_relay_pool
+from .site_config import invalidate_site_settings
+from .suppression import get_suppression_filter
+from .templating import invalidate_template, precompile_template
+
+
+@receiver(post_save, sender=EmailTemplate)
+@receiver(post_delete, sender=EmailTemplate)
+def email_template_changed(sender, instance, **kwargs):
+    invalidate_template(instance.pk)
+
+
+@receiver(post_save, sender=EmailTemplate)
+def email_template_saved(sender, instance, raw=False, **kwargs):
+    # Compile and split at save time rather than on the first send.
+    if not raw:
+        try:
+            precompile_template(instance)
+        except TemplateSyntaxError:
+            pass
+
+
+@receiver(post_save, sender=SiteSettings)
+@receiver(post_delete, sender=SiteSettings)
+def site_settings_changed(sender, **kwargs):
+    invalidate_site_settings()
+    invalidate_relay_pool()
+
+
+@receiver(post_save, sender=RelayProfile)
+@receiver(post_delete, sender=RelayProfile)
+def relay_profile_changed(sender, **kwargs):
+    invalidate_relay_pool()
+
+
+@receiver(post_save, sender=UserEmail)
+def user_email_saved(sender, instance, created, raw=False, **kwargs):
+    # Deletes are counted where they happen: a post_delete receiver would
+    # force Django to fetch and delete rows one by one.
+    if created and not raw:
+        stats.recipients_added(1)
+
+
+@receiver(post_save, sender=Suppression)
+def suppression_saved(sender, **kwargs):
+    # Removals need nothing: every Bloom filter hit is confirmed in the database.
+    get_suppression_filter().mark_stale()
+
+
+@receiver(connection_created)
+def connection_opened(sender, connection, **kwargs):
+    configure_connection(connection)
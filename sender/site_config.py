@@ -0,0 +1,44 @@
+import time
+from collections import namedtuple
+
+from django.conf import settings
+
+from .models import SiteSettings
+
+_Entry = namedtuple('_Entry', ['instance', 'version', 'checked_at'])
+
+_cached = None
+
+
+def _current_version():
+    return SiteSettings.objects.order_by('pk').values_list('version', flat=True).first()
+
+
+def get_site_settings():
+    """
+    Return the SiteSettings row, or None if it hasn't been created yet.
+
+    The row is cached in this process. Saves made here clear the cache
+    straight away (see signals); saves made by another process are noticed
+    at the next version check, which happens at most once every
+    SITE_SETTINGS_CACHE_TTL seconds and only reloads the row if its version
+    changed. The returned instance is shared, so treat it as read-only.
+    """
+    global _cached
+    entry = _cached
+    now = time.monotonic()
+    ttl = getattr(settings, 'SITE_SETTINGS_CACHE_TTL', 30)
+    if entry is not None and now - entry.checked_at < ttl:
+        return entry.instance
+    if entry is not None and _current_version() == entry.version:
+        _cached = entry._replace(checked_at=now)
+        return entry.instance
+
+    instance = SiteSettings.objects.order_by('pk').first()
+    _cached = _Entry(instance, instance.version if instance is not None else None, now)
+    return instance
+
+
+def invalidate_site_settings():
+    global _cached
+    _cached = None
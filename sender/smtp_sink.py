@@ -0,0 +1,133 @@
+import asyncio
+import threading
+
+
+class SMTPSink:
+    """
+    In-process SMTP server that accepts and counts messages.
+
+    Meant for tests and benchmarks: it speaks just enough ESMTP (EHLO with
+    PIPELINING, MAIL, RCPT, DATA, RSET, NOOP, QUIT) for both Django's SMTP
+    backend and the asyncio delivery engine, without TLS or AUTH.
+
+    ``delay`` is slept before acknowledging each message body to mimic a
+    relay's per-message latency. ``reject`` is an optional callable taking a
+    recipient address; when it returns True the recipient gets a 550.
+    With ``drop_after``, a session that has accepted that many messages is
+    closed without a reply at its next command, like a relay enforcing a
+    per-connection limit.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, delay=0.0, reject=None, drop_after=None):
+        self.host = host
+        self.port = port
+        self.delay = delay
+        self.reject = reject
+        self.drop_after = drop_after
+        self.received = 0
+        self.connections = 0
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        ready = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._handle, self.host, self.port)
+            )
+            self.port = self._server.sockets[0].getsockname()[1]
+            ready.set()
+            self._loop.run_forever()
+            self._server.close()
+            self._loop.run_until_complete(self._server.wait_closed())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name='smtp-sink', daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    async def _handle(self, reader, writer):
+        with self._lock:
+            self.connections += 1
+
+        def reply(line):
+            writer.write(line.encode('ascii') + b'\r\n')
+
+        reply('220 sink ESMTP ready')
+        recipients = []
+        accepted = 0
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if self.drop_after is not None and accepted >= self.drop_after:
+                    break
+                verb = line[:4].upper()
+                if verb == b'EHLO':
+                    writer.write(b'250-sink\r\n250-PIPELINING\r\n250-8BITMIME\r\n250 SIZE 52428800\r\n')
+                elif verb == b'HELO':
+                    reply('250 sink')
+                elif verb == b'MAIL':
+                    recipients = []
+                    reply('250 OK')
+                elif verb == b'RCPT':
+                    address = line.split(b':', 1)[-1].strip().strip(b'<>').decode('utf-8', 'replace')
+                    if self.reject is not None and self.reject(address):
+                        reply('550 5.1.1 No such user')
+                    else:
+                        recipients.append(address)
+                        reply('250 OK')
+                elif verb == b'DATA':
+                    if not recipients:
+                        reply('554 No valid recipients')
+                        continue
+                    reply('354 End data with <CR><LF>.<CR><LF>')
+                    await writer.drain()
+                    while True:
+                        data_line = await reader.readline()
+                        if not data_line:
+                            return
+                        if data_line == b'.\r\n':
+                            break
+                    if self.delay:
+                        await asyncio.sleep(self.delay)
+                    with self._lock:
+                        self.received += 1
+                    accepted += 1
+                    recipients = []
+                    reply('250 OK queued')
+                elif verb == b'RSET':
+                    recipients = []
+                    reply('250 OK')
+                elif verb == b'NOOP':
+                    reply('250 OK')
+                elif verb == b'QUIT':
+                    reply('221 Bye')
+                    await writer.drain()
+                    break
+                else:
+                    reply('502 Command not implemented')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,88 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Counter, UserEmail
+
+RECIPIENTS = 'recipients'
+UPLOADS = 'uploads'
+
+STATS_VERSION_KEY = 'sender:stats-version'
+
+
+def _recount(name, default=0):
+    if name == RECIPIENTS:
+        return UserEmail.objects.count()
+    return default
+
+
+def increment(name, delta=1):
+    """
+    Add ``delta`` to a counter in the current transaction.
+    """
+    updated = Counter.objects.filter(name=name).update(
+        value=F('value') + delta, updated_at=timezone.now()
+    )
+    if not updated:
+        # First use (or the row was removed): seed it from the source table,
+        # which already includes this change.
+        Counter.objects.get_or_create(name=name, defaults={'value': _recount(name, delta)})
+    transaction.on_commit(invalidate_stats)
+
+
+def get_value(name):
+    counter = Counter.objects.filter(name=name).first()
+    if counter is None:
+        counter, _ = Counter.objects.get_or_create(name=name, defaults={'value': _recount(name)})
+    return counter.value
+
+
+def recipients_added(count):
+    if count:
+        increment(RECIPIENTS, count)
+        increment(UPLOADS)
+
+
+def recipients_removed(count):
+    if count:
+        increment(RECIPIENTS, -count)
+
+
+def recount():
+    """
+    Rebuild counters from the tables, e.g. after rows were changed by hand.
+    """
+    for name in (RECIPIENTS,):
+        Counter.objects.update_or_create(name=name, defaults={'value': _recount(name)})
+    invalidate_stats()
+
+
+def invalidate_stats():
+    # Bumping the version orphans every cached stats entry at once.
+    try:
+        cache.incr(STATS_VERSION_KEY)
+    except ValueError:
+        cache.set(STATS_VERSION_KEY, 1, None)
+
+
+def get_dashboard_stats():
+    """
+    Totals for the dashboard and list pages, cached until the next change.
+
+    Invalidation is per cache backend; with the default per-process cache,
+    other processes catch up after DASHBOARD_STATS_TTL seconds.
+    """
+    version = cache.get_or_set(STATS_VERSION_KEY, 1, None)
+    key = f'sender:dashboard-stats:{version}'
+    stats = cache.get(key)
+    if stats is None:
+        counters = {counter.name: counter for counter in Counter.objects.filter(name__in=[RECIPIENTS, UPLOADS])}
+        uploads = counters.get(UPLOADS)
+        stats = {
+            'total_recipients': counters[RECIPIENTS].value if RECIPIENTS in counters else get_value(RECIPIENTS),
+            'last_upload': uploads.updated_at if uploads is not None and uploads.value else None,
+        }
+        cache.set(key, stats, getattr(settings, 'DASHBOARD_STATS_TTL', 60))
+    return stats
@@ -0,0 +1,133 @@
+import hashlib
+import math
+import threading
+import time
+
+from django.conf import settings
+
+from .models import Suppression, normalize_email
+
+# Addresses per exact-check query; well under SQLite's parameter limit.
+EXACT_CHECK_CHUNK_SIZE = 500
+
+
+class BloomFilter:
+    """
+    Fixed-size Bloom filter over strings.
+
+    ``in`` never misses an added item and wrongly reports roughly
+    ``error_rate`` of other items, so a hit must be confirmed elsewhere.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = max(1, capacity)
+        self.size = max(8, int(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        # Double hashing: k positions from two independent 64-bit values.
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class SuppressionFilter:
+    """
+    In-memory view of the Suppression table for the send path.
+
+    A Bloom filter answers "definitely not suppressed" for almost every
+    recipient without touching the database; the few hits are confirmed with
+    one query per batch, which also makes removals from the list take effect
+    immediately. New suppressions are picked up incrementally by id, at most
+    every SUPPRESSION_REFRESH_SECONDS, or straight away when added in this
+    process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.bloom = None
+        self.last_id = 0
+        self.checked_at = None
+        self.rebuilt_at = None
+
+    def _rebuild(self):
+        count = Suppression.objects.count()
+        # Leave room to grow before the false-positive rate degrades.
+        bloom = BloomFilter(max(1024, count * 2))
+        last_id = 0
+        for pk, email in Suppression.objects.order_by('id').values_list('id', 'email').iterator(chunk_size=5000):
+            bloom.add(email)
+            last_id = pk
+        self.bloom = bloom
+        self.last_id = last_id
+        self.rebuilt_at = time.monotonic()
+
+    def _catch_up(self):
+        for pk, email in Suppression.objects.filter(id__gt=self.last_id).order_by('id').values_list('id', 'email'):
+            if self.bloom.count >= self.bloom.capacity:
+                self._rebuild()
+                return
+            self.bloom.add(email)
+            self.last_id = pk
+
+    def refresh(self, force=False):
+        interval = getattr(settings, 'SUPPRESSION_REFRESH_SECONDS', 5)
+        now = time.monotonic()
+        if not force and self.checked_at is not None and now - self.checked_at < interval:
+            return
+        with self._lock:
+            # Ids aren't guaranteed to commit in order on every database, so
+            # the incremental catch-up is backed by an occasional full load.
+            rebuild_interval = getattr(settings, 'SUPPRESSION_REBUILD_SECONDS', 600)
+            if self.bloom is None or now - self.rebuilt_at >= rebuild_interval:
+                self._rebuild()
+            else:
+                self._catch_up()
+            self.checked_at = now
+
+    def mark_stale(self):
+        self.checked_at = None
+
+    def suppressed(self, emails):
+        """
+        Return the subset of ``emails`` that are on the suppression list.
+        """
+        self.refresh()
+        bloom = self.bloom
+        candidates = list({email for email in (normalize_email(email) for email in emails) if email in bloom})
+        found = set()
+        for start in range(0, len(candidates), EXACT_CHECK_CHUNK_SIZE):
+            found.update(
+                Suppression.objects.filter(
+                    email__in=candidates[start:start + EXACT_CHECK_CHUNK_SIZE]
+                ).values_list('email', flat=True)
+            )
+        return {email for email in emails if normalize_email(email) in found}
+
+
+_filter = SuppressionFilter()
+
+
+def get_suppression_filter():
+    return _filter
+
+
+def suppress(emails, reason, detail=''):
+    """
+    Add addresses to the suppression list, ignoring ones already on it.
+    """
+    rows = [Suppression(email=normalize_email(email), reason=reason, detail=detail) for email in emails]
+    Suppression.objects.bulk_create(rows, ignore_conflicts=True)
+    _filter.mark_stale()
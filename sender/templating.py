@@ -0,0 +1,177 @@
+import hashlib
+import re
+import threading
+import uuid
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.template import Context, Template
+from django.template.base import TextNode, Variable, VariableNode
+from django.template.defaulttags import CommentNode, LoadNode
+from django.utils.html import conditional_escape, strip_tags
+
+_Entry = namedtuple('_Entry', ['compiled', 'split'])
+
+_compiled = OrderedDict()
+_lock = threading.Lock()
+
+
+class SplitTemplate:
+    """
+    A template pre-rendered into static chunks around its ``{{ variable }}`` slots.
+
+    ``html_parts`` and ``text_parts`` are the HTML output and its
+    strip_tags() version cut at the slots, alternating static text and the
+    name of the variable in between (static, name, static...), so rendering
+    for a recipient is two joins instead of a template render plus an HTML
+    parse.
+    """
+
+    def __init__(self, html_parts, text_parts):
+        self.html_parts = html_parts
+        self.text_parts = text_parts
+
+    def render(self, context):
+        """
+        Return (html, text) exactly as rendering the template with the
+        ``context`` dict would.
+        """
+        # Matches what autoescaping does to {{ name }}; the text part of a
+        # full render keeps those entities too, since strip_tags leaves them.
+        values = {}
+
+        def fill(parts):
+            pieces = list(parts)
+            for index in range(1, len(pieces), 2):
+                name = pieces[index]
+                if name not in values:
+                    values[name] = conditional_escape(context.get(name, ''))
+                pieces[index] = values[name]
+            return ''.join(pieces)
+
+        return fill(self.html_parts), fill(self.text_parts)
+
+
+def _slot_name(node):
+    """
+    The variable a plain ``{{ name }}`` node prints, or None for anything else.
+    """
+    if not isinstance(node, VariableNode):
+        return None
+    expression = node.filter_expression
+    if not isinstance(expression.var, Variable) or expression.filters:
+        return None
+    lookups = expression.var.lookups
+    return lookups[0] if lookups is not None and len(lookups) == 1 else None
+
+
+def _is_static(node):
+    # Every value in the context is per recipient (username, email and the
+    # imported attributes, whatever they are called), so any other tag may
+    # depend on the recipient and has to be rendered at send time.
+    return isinstance(node, (TextNode, CommentNode, LoadNode))
+
+
+def _cut(output, pattern, names):
+    parts = pattern.split(output)
+    for index in range(1, len(parts), 2):
+        parts[index] = names[parts[index]]
+    return parts
+
+
+def split_template(compiled):
+    """
+    Return a SplitTemplate for a compiled Template, or None if it has to be
+    rendered in full: anything at the top level other than text and plain
+    ``{{ name }}`` variables (tags, filters, dotted lookups...) may vary
+    per recipient.
+    """
+    slots = []
+    for node in compiled.nodelist:
+        name = _slot_name(node)
+        if name is not None:
+            slots.append(name)
+        elif not _is_static(node):
+            return None
+
+    markers = {name: f"slot{uuid.uuid4().hex}" for name in slots}
+    html = compiled.render(Context(markers))
+    if not slots:
+        return SplitTemplate([html], [strip_tags(html)])
+    names = {marker: name for name, marker in markers.items()}
+    pattern = re.compile('(' + '|'.join(names) + ')')
+    html_parts = _cut(html, pattern, names)
+    if len(html_parts) != 2 * len(slots) + 1:
+        return None
+    return SplitTemplate(html_parts, _cut(strip_tags(html), pattern, names))
+
+
+def _content_digest(template):
+    # Hashing a large newsletter for every recipient adds up, so remember the
+    # digest on the instance for as long as its content is unchanged.
+    content = template.html_content
+    cached = getattr(template, '_content_digest', None)
+    if cached is not None and cached[0] is content:
+        return cached[1]
+    digest = hashlib.sha1(content.encode('utf-8')).hexdigest()
+    template._content_digest = (content, digest)
+    return digest
+
+
+def _get_entry(template):
+    key = (template.pk, _content_digest(template))
+    with _lock:
+        entry = _compiled.get(key)
+        if entry is not None:
+            _compiled.move_to_end(key)
+            return entry
+
+    compiled = Template(template.html_content)
+    entry = _Entry(compiled, split_template(compiled))
+
+    with _lock:
+        _compiled[key] = entry
+        _compiled.move_to_end(key)
+        max_size = getattr(settings, 'EMAIL_TEMPLATE_CACHE_SIZE', 32)
+        while len(_compiled) > max_size:
+            _compiled.popitem(last=False)
+    return entry
+
+
+def get_compiled_template(template):
+    """
+    Return a compiled django Template for an EmailTemplate.
+
+    Entries are keyed by template id plus a hash of the content, so an edit
+    made in another process is picked up as soon as the new row is read.
+    """
+    return _get_entry(template).compiled
+
+
+def get_split_template(template):
+    """
+    Return the SplitTemplate for an EmailTemplate, or None if it has to be
+    rendered in full for every recipient. Cached like get_compiled_template.
+    """
+    return _get_entry(template).split
+
+
+def precompile_template(template):
+    """
+    Compile and split a template ahead of the first send.
+    """
+    _get_entry(template)
+
+
+def invalidate_template(template_id):
+    """
+    Drop every compiled version of a template from this process's cache.
+    """
+    with _lock:
+        for key in [key for key in _compiled if key[0] == template_id]:
+            del _compiled[key]
+
+
+def clear_template_cache():
+    with _lock:
+        _compiled.clear()
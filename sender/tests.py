@@ -1,3 +1,1105 @@
-from django.test import TestCase
+import asyncio
+import csv
+import functools
+import gzip
+import importlib.util
+import smtplib
+import socket
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.mail import EmailMessage
+from django.core.management import call_command
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models import Q
+from django.template import Context, Template
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.html import strip_tags
+import openpyxl
+import pandas as pd
+
+from . import metrics, outbox
+from .async_smtp import AsyncDeliveryEngine
+from .backends import DynamicSMTPBackend
+from .forms import EmailTemplateForm
+from .importers import RejectsWriter, import_file
+from .mailer import DeliveryResult, build_message, is_transient, send_batch
+from .management.commands import send_outbox
+from .models import (
+    Campaign, Counter, DeliveryRecord, EmailTemplate, OutboundMessage, RecipientAttribute, SiteSettings, Suppression, UserEmail,
+)
+from .outbox import claim_batch, deliver, enqueue, promote_due_retries, retry_delay
+from .pagination import InvalidCursor, decode_cursor, encode_cursor, keyset_paginate, ordering_for
+from .ratelimit import claim_within_quota, daily_remaining
+from .relays import Relay, RelayHealth, _split, is_relay_fault
+from .search import search_emails, search_index_available
+from .segments import InvalidSegment, Term, filter_segment, parse_segment
+from .selection import Selection
+from .smtp_sink import SMTPSink
+from .suppression import SuppressionFilter, suppress
+from .templating import split_template
+
+
+def relay_config(sink):
+    return {
+        'host': sink.host,
+        'port': sink.port,
+        'username': '',
+        'password': '',
+        'use_tls': False,
+        'use_ssl': False,
+        'default_from_email': 'sender@example.com',
+    }
+
+
+def make_messages(count, domain='example.com'):
+    return [
+        EmailMessage(f"Message {n}", "Hello", 'sender@example.com', [f"user{n}@{domain}"])
+        for n in range(count)
+    ]
+
+
+class SendBatchTests(SimpleTestCase):
+    def test_sends_every_message_over_one_connection(self):
+        with SMTPSink() as sink:
+            results = send_batch(make_messages(5), connection=DynamicSMTPBackend(relay=relay_config(sink)))
+        self.assertTrue(all(result.sent for result in results))
+        self.assertEqual(sink.received, 5)
+        self.assertEqual(sink.connections, 1)
+
+    def test_reconnects_when_the_relay_drops_the_session(self):
+        with SMTPSink(drop_after=2) as sink:
+            results = send_batch(make_messages(5), connection=DynamicSMTPBackend(relay=relay_config(sink)))
+        self.assertTrue(all(result.sent for result in results))
+        self.assertEqual(sink.received, 5)
+        self.assertEqual(sink.connections, 3)
+
+    def test_refused_recipient_fails_alone(self):
+        with SMTPSink(reject=lambda address: address == 'user1@example.com') as sink:
+            results = send_batch(make_messages(3), connection=DynamicSMTPBackend(relay=relay_config(sink)))
+        self.assertEqual([result.sent for result in results], [True, False, True])
+        self.assertIsInstance(results[1].error, smtplib.SMTPRecipientsRefused)
+        self.assertEqual(sink.received, 2)
+
+    def test_recycles_the_connection(self):
+        with SMTPSink() as sink:
+            results = send_batch(
+                make_messages(5), connection=DynamicSMTPBackend(relay=relay_config(sink)), max_per_connection=2,
+            )
+        self.assertTrue(all(result.sent for result in results))
+        self.assertEqual(sink.connections, 3)
+
+
+class AsyncDeliveryEngineTests(SimpleTestCase):
+    def deliver(self, sink, messages, **kwargs):
+        engine = AsyncDeliveryEngine(config=relay_config(sink), **kwargs)
+        return engine, asyncio.run(engine.deliver(messages))
+
+    def test_pipelines_over_one_session(self):
+        with SMTPSink() as sink:
+            engine, results = self.deliver(sink, make_messages(20), concurrency=1)
+        self.assertTrue(all(result.sent for result in results))
+        self.assertEqual(engine.sent, 20)
+        self.assertEqual(sink.received, 20)
+        self.assertEqual(sink.connections, 1)
+
+    def test_session_advertises_pipelining(self):
+        async def connect(sink):
+            session = AsyncDeliveryEngine(config=relay_config(sink))._session()
+            await session.connect()
+            try:
+                return session.pipelining
+            finally:
+                await session.quit()
+
+        with SMTPSink() as sink:
+            self.assertTrue(asyncio.run(connect(sink)))
+
+    def test_results_keep_input_order_across_sessions(self):
+        messages = make_messages(30)
+        with SMTPSink() as sink:
+            engine, results = self.deliver(sink, messages, concurrency=4)
+        self.assertEqual([result.message for result in results], messages)
+        self.assertLessEqual(sink.connections, 4)
+        self.assertEqual(sink.received, 30)
+
+    def test_refused_recipient_fails_alone(self):
+        with SMTPSink(reject=lambda address: address.startswith('user3@')) as sink:
+            engine, results = self.deliver(sink, make_messages(6), concurrency=2)
+        self.assertEqual([result.sent for result in results], [True, True, True, False, True, True])
+        self.assertIsInstance(results[3].error, smtplib.SMTPRecipientsRefused)
+        self.assertEqual(engine.failed, 1)
+        self.assertEqual(sink.received, 5)
+
+    def test_reconnects_when_the_relay_drops_the_session(self):
+        with SMTPSink(drop_after=3) as sink:
+            engine, results = self.deliver(sink, make_messages(10), concurrency=1)
+        self.assertTrue(all(result.sent for result in results))
+        self.assertEqual(sink.received, 10)
+        self.assertEqual(sink.connections, 4)
+
+
+class SendOutboxTests(TransactionTestCase):
+    def setUp(self):
+        self.sink = SMTPSink(reject=lambda address: address.startswith('bounce')).start()
+        self.addCleanup(self.sink.stop)
+        SiteSettings.objects.create(
+            email_host=self.sink.host,
+            email_port=self.sink.port,
+            email_use_tls=False,
+            default_from_email='sender@example.com',
+        )
+        self.template = EmailTemplate.objects.create(name="Default Template", html_content="<p>Hi {{ username }}</p>")
+        UserEmail.objects.bulk_create(
+            [UserEmail(username=f"user{n}", email=f"user{n}@example.com") for n in range(12)]
+            + [UserEmail(username="bounce", email="bounce@example.com")]
+        )
+
+    def run_worker(self, *args):
+        call_command('send_outbox', '--once', '--concurrency', '1', '--batch-size', '5', *args, stdout=StringIO())
+
+    def assert_delivered(self, campaign):
+        campaign.refresh_from_db()
+        self.assertEqual(campaign.status, Campaign.STATUS_COMPLETED)
+        self.assertEqual((campaign.sent_count, campaign.failed_count), (12, 1))
+        self.assertEqual(self.sink.received, 12)
+        self.assertFalse(OutboundMessage.objects.filter(status=OutboundMessage.STATUS_PENDING).exists())
+        self.assertEqual(DeliveryRecord.objects.filter(status=DeliveryRecord.STATUS_SENT).count(), 12)
+        # The 550 put the address on the suppression list.
+        self.assertTrue(Suppression.objects.filter(email='bounce@example.com').exists())
+
+    def test_delivers_the_queue(self):
+        campaign, queued = enqueue(self.template, UserEmail.objects.all())
+        self.assertEqual(queued, 13)
+        self.run_worker()
+        self.assert_delivered(campaign)
+
+    def test_delivers_the_queue_with_the_async_engine(self):
+        campaign, _ = enqueue(self.template, UserEmail.objects.all())
+        self.run_worker('--engine', 'async', '--sessions', '2')
+        self.assert_delivered(campaign)
+
+    def test_work_loop_requeues_expired_leases(self):
+        enqueue(self.template, UserEmail.objects.all())
+        OutboundMessage.objects.filter(id__in=list(OutboundMessage.objects.values_list('id', flat=True)[:5])).update(
+            status=OutboundMessage.STATUS_SENDING,
+            claimed_by='otherhost:1:0',
+            claimed_at=timezone.now() - timedelta(minutes=20),
+        )
+        command = send_outbox.Command(stdout=StringIO())
+        command.release_lock = threading.Lock()
+        command.next_release = time.monotonic() + 60
+        options = {'lease': 600, 'poll_interval': 60}
+        command.release_stale('worker', options)
+        self.assertEqual(OutboundMessage.objects.filter(status=OutboundMessage.STATUS_SENDING).count(), 5)
+        command.next_release = time.monotonic()
+        command.release_stale('worker', options)
+        self.assertFalse(OutboundMessage.objects.filter(status=OutboundMessage.STATUS_SENDING).exists())
+
+    def test_failed_batch_is_released_and_sent_again(self):
+        campaign, _ = enqueue(self.template, UserEmail.objects.all())
+        real_deliver = outbox.deliver
+        calls = []
+
+        def deliver_once_failing(batch, send):
+            calls.append(len(batch))
+            if len(calls) == 1:
+                raise RuntimeError("database is locked")
+            return real_deliver(batch, send=send)
+
+        with mock.patch('sender.outbox.deliver', side_effect=deliver_once_failing):
+            self.run_worker('--poll-interval', '0')
+        self.assertEqual(calls[:2], [5, 5])
+        self.assert_delivered(campaign)
+
+
+def accept_all(messages):
+    return [DeliveryResult(message, True, None) for message in messages]
+
+
+class DeliverTests(TestCase):
+    def setUp(self):
+        UserEmail.objects.bulk_create([UserEmail(username=f"user{n}", email=f"user{n}@example.com") for n in range(3)])
+
+    def queue(self, html_content):
+        template = EmailTemplate.objects.create(name="Template", html_content=html_content)
+        campaign, _ = enqueue(template, UserEmail.objects.all())
+        return campaign, claim_batch('worker', 10)
+
+    def test_message_that_fails_to_build_fails_alone(self):
+        campaign, batch = self.queue("<p>Hi {{ username }}</p>")
+        real_build = outbox.build_message
+
+        def build(template, item, attributes=None):
+            if item.email == 'user1@example.com':
+                raise ValueError("bad attribute")
+            return real_build(template, item, attributes)
+
+        with mock.patch('sender.outbox.build_message', side_effect=build):
+            self.assertEqual(deliver(batch, send=accept_all), (2, 1))
+        failed = OutboundMessage.objects.get(status=OutboundMessage.STATUS_FAILED)
+        self.assertEqual(failed.email, 'user1@example.com')
+        self.assertIn("bad attribute", failed.last_error)
+        campaign.refresh_from_db()
+        self.assertEqual((campaign.sent_count, campaign.failed_count), (2, 1))
+        self.assertEqual(campaign.status, Campaign.STATUS_COMPLETED)
+
+    def test_unparsable_template_fails_the_batch_without_sending(self):
+        send = mock.Mock(side_effect=accept_all)
+        campaign, batch = self.queue("<p>Hi {% if username %}</p>")
+        self.assertEqual(deliver(batch, send=send), (0, 3))
+        send.assert_not_called()
+        self.assertEqual(DeliveryRecord.objects.filter(status=DeliveryRecord.STATUS_FAILED).count(), 3)
+
+    def test_release_claimed_requeues_only_that_workers_batch(self):
+        self.queue("<p>Hi</p>")
+        OutboundMessage.objects.filter(email='user2@example.com').update(claimed_by='other')
+        self.assertEqual(outbox.release_claimed('worker'), 2)
+        self.assertEqual(OutboundMessage.objects.filter(status=OutboundMessage.STATUS_SENDING).count(), 1)
+
+
+class EmailTemplateFormTests(TestCase):
+    def test_rejects_invalid_template_syntax(self):
+        form = EmailTemplateForm(data={'name': "Broken", 'html_content': "<p>{% if username %}</p>"})
+        self.assertFalse(form.is_valid())
+        self.assertIn('html_content', form.errors)
+
+    def test_accepts_a_valid_template(self):
+        form = EmailTemplateForm(data={'name': "Welcome", 'html_content': "<p>{{ username }}</p>"})
+        self.assertTrue(form.is_valid(), form.errors)
+
+
+class RetryTests(TestCase):
+    def test_transient_failures(self):
+        for error in [
+            smtplib.SMTPRecipientsRefused({'a@example.com': (451, b'4.7.1 Greylisted')}),
+            smtplib.SMTPDataError(421, b'Too many messages'),
+            smtplib.SMTPServerDisconnected('Connection unexpectedly closed'),
+            smtplib.SMTPConnectError(-1, b'Connection refused'),
+            ConnectionRefusedError(),
+            ConnectionResetError(),
+            TimeoutError(),
+            socket.gaierror(-2, 'Name or service not known'),
+        ]:
+            with self.subTest(error=error):
+                self.assertTrue(is_transient(error))
+
+    def test_permanent_failures(self):
+        for error in [
+            smtplib.SMTPRecipientsRefused({'a@example.com': (550, b'5.1.1 No such user')}),
+            smtplib.SMTPDataError(554, b'Message rejected'),
+            smtplib.SMTPConnectError(554, b'Go away'),
+            smtplib.SMTPAuthenticationError(535, b'Bad credentials'),
+            smtplib.SMTPNotSupportedError('STARTTLS not supported'),
+            smtplib.SMTPException('No suitable authentication method found'),
+            PermissionError(),
+            ValueError('bad header'),
+            None,
+        ]:
+            with self.subTest(error=error):
+                self.assertFalse(is_transient(error))
+
+    def test_retry_delay_doubles_with_jitter_up_to_the_cap(self):
+        with self.settings(EMAIL_RETRY_BASE_SECONDS=60, EMAIL_RETRY_MAX_SECONDS=600):
+            for attempts, full in [(1, 60), (2, 120), (3, 240), (4, 480), (5, 600), (12, 600)]:
+                for _ in range(20):
+                    delay = retry_delay(attempts)
+                    self.assertGreaterEqual(delay, full / 2)
+                    self.assertLessEqual(delay, full)
+
+    def test_promote_due_retries_requeues_only_due_messages(self):
+        UserEmail.objects.bulk_create([UserEmail(username=f"user{n}", email=f"user{n}@example.com") for n in range(4)])
+        template = EmailTemplate.objects.create(name="Template", html_content="<p>Hi</p>")
+        enqueue(template, UserEmail.objects.all())
+        now = timezone.now()
+        messages = list(OutboundMessage.objects.order_by('id'))
+        for message, due in zip(messages, [-120, -60, -1, 3600]):
+            message.status = OutboundMessage.STATUS_RETRY
+            message.next_attempt_at = now + timedelta(seconds=due)
+            message.save()
+
+        self.assertEqual(promote_due_retries(limit=2), 2)
+        self.assertEqual(
+            set(OutboundMessage.objects.filter(status=OutboundMessage.STATUS_PENDING).values_list('id', flat=True)),
+            {messages[0].pk, messages[1].pk},
+        )
+        self.assertEqual(promote_due_retries(), 1)
+        self.assertEqual(promote_due_retries(), 0)
+        waiting = OutboundMessage.objects.get(status=OutboundMessage.STATUS_RETRY)
+        self.assertEqual(waiting.pk, messages[3].pk)
+        self.assertIsNone(OutboundMessage.objects.get(pk=messages[2].pk).next_attempt_at)
+
+    def test_transient_failure_is_deferred_until_the_last_attempt(self):
+        UserEmail.objects.create(username="grey", email="grey@example.com")
+        template = EmailTemplate.objects.create(name="Template", html_content="<p>Hi</p>")
+        campaign, _ = enqueue(template, UserEmail.objects.all())
+
+        def greylist(messages):
+            error = smtplib.SMTPRecipientsRefused({'grey@example.com': (451, b'4.7.1 Try again later')})
+            return [DeliveryResult(message, False, error) for message in messages]
+
+        with self.settings(EMAIL_MAX_ATTEMPTS=2):
+            self.assertEqual(deliver(claim_batch('worker', 10), send=greylist), (0, 0))
+            message = OutboundMessage.objects.get()
+            self.assertEqual(message.status, OutboundMessage.STATUS_RETRY)
+            self.assertGreater(message.next_attempt_at, timezone.now())
+            OutboundMessage.objects.update(next_attempt_at=timezone.now())
+            promote_due_retries()
+            self.assertEqual(deliver(claim_batch('worker', 10), send=greylist), (0, 1))
+        self.assertEqual(OutboundMessage.objects.get().status, OutboundMessage.STATUS_FAILED)
+        self.assertEqual(
+            list(DeliveryRecord.objects.order_by('attempt').values_list('status', flat=True)),
+            [DeliveryRecord.STATUS_DEFERRED, DeliveryRecord.STATUS_FAILED],
+        )
+        campaign.refresh_from_db()
+        self.assertEqual((campaign.failed_count, campaign.status), (1, Campaign.STATUS_COMPLETED))
+
+
+class RelayTests(SimpleTestCase):
+    def relays(self, *weights):
+        return [Relay(f"relay{n}", {}, weight=weight) for n, weight in enumerate(weights)]
+
+    def test_relay_faults(self):
+        for error, fault in [
+            (smtplib.SMTPRecipientsRefused({'a@example.com': (451, b'4.7.1 Try later')}), True),
+            (smtplib.SMTPRecipientsRefused({'a@example.com': (550, b'5.1.1 No such user')}), False),
+            (smtplib.SMTPAuthenticationError(535, b'Bad credentials'), True),
+            (smtplib.SMTPServerDisconnected('Connection unexpectedly closed'), True),
+            (smtplib.SMTPDataError(421, b'Too many messages'), True),
+            (smtplib.SMTPDataError(554, b'Spam'), False),
+            (smtplib.SMTPException('No suitable authentication method found'), False),
+            (ConnectionRefusedError(), True),
+            (TimeoutError(), True),
+            (socket.gaierror(-2, 'Name or service not known'), True),
+            (PermissionError(), False),
+            (ValueError('bad header'), False),
+            (None, False),
+        ]:
+            with self.subTest(error=error):
+                self.assertEqual(is_relay_fault(error), fault)
+
+    def test_split_follows_the_weights(self):
+        self.assertEqual(_split(8, self.relays(3, 1), [None, None]), [6, 2])
+
+    def test_split_gives_rounding_leftovers_to_the_largest_remainders(self):
+        # Exact shares are 1.33 and 2.67: the second relay gets the spare message.
+        self.assertEqual(_split(4, self.relays(1, 2), [None, None]), [1, 3])
+        self.assertEqual(_split(10, self.relays(1, 1, 1), [None, None, None]), [4, 3, 3])
+
+    def test_split_moves_overflow_to_relays_with_allowance_left(self):
+        self.assertEqual(_split(10, self.relays(1, 1), [2, None]), [2, 8])
+        self.assertEqual(_split(10, self.relays(1, 1, 2), [2, 4, 5]), [2, 3, 5])
+
+    def test_split_overshoots_on_the_heaviest_relay_when_every_quota_is_used(self):
+        self.assertEqual(_split(3, self.relays(2, 1), [0, 0]), [3, 0])
+
+    def test_split_scales_down_an_unhealthy_relay(self):
+        relays = self.relays(1, 1)
+        relays[0].health.error_rate = 0.75
+        self.assertEqual(_split(10, relays, [None, None]), [2, 8])
+
+    def test_health_trips_and_cools_down(self):
+        health = RelayHealth()
+        with self.settings(RELAY_TRIP_ERROR_RATE=0.5, RELAY_COOLDOWN_SECONDS=30, RELAY_MAX_COOLDOWN_SECONDS=100):
+            self.assertFalse(health.record(10, 2))
+            self.assertTrue(health.available())
+
+            before = time.monotonic()
+            self.assertTrue(health.record(10, 10))
+            self.assertFalse(health.available())
+            self.assertGreaterEqual(health.cooldown_until, before + 30)
+            self.assertTrue(health.available(now=health.cooldown_until))
+
+            # Another faulty batch after the cool-down benches it for twice as long.
+            before = time.monotonic()
+            self.assertTrue(health.record(10, 10))
+            self.assertGreaterEqual(health.cooldown_until, before + 60)
+            self.assertLess(health.cooldown_until, before + 100)
+            before = time.monotonic()
+            self.assertTrue(health.record(10, 10))
+            self.assertLessEqual(health.cooldown_until, time.monotonic() + 100)
+            self.assertGreaterEqual(health.cooldown_until, before + 100)
+
+            # Clean batches bring the error rate down and reset the doubling.
+            self.assertFalse(health.record(10, 0))
+            self.assertFalse(health.record(10, 0))
+            self.assertEqual(health.trips, 0)
+            self.assertLess(health.error_rate, 0.5)
+
+    def test_health_ignores_empty_batches(self):
+        health = RelayHealth()
+        self.assertFalse(health.record(0, 0))
+        self.assertEqual(health.error_rate, 0.0)
+
+
+TRICKY_USERNAMES = ["plain", "<b>Tom & Jerry</b>", "O'Brien \"Bob\"", "a > b < c", "&amp;", "{{ email }}", ""]
+
+
+class SplitTemplateTests(SimpleTestCase):
+    def assert_renders_like_the_template(self, source, context):
+        compiled = Template(source)
+        split = split_template(compiled)
+        self.assertIsNotNone(split, source)
+        html = compiled.render(Context(context))
+        self.assertEqual(split.render(context), (html, strip_tags(html)))
+
+    def test_matches_the_full_render(self):
+        for username in TRICKY_USERNAMES:
+            with self.subTest(username=username):
+                self.assert_renders_like_the_template(
+                    "<h1>Hi {{ username }}</h1>\n<p>Sent to {{ email }}, {{ username }}.</p>{# note #}",
+                    {'username': username, 'email': 'tom@example.com'},
+                )
+
+    def test_variable_inside_an_html_attribute(self):
+        for username in TRICKY_USERNAMES:
+            with self.subTest(username=username):
+                self.assert_renders_like_the_template(
+                    '<a title="{{ username }}" href="https://example.com/?u={{ email }}">{{ username }}</a>',
+                    {'username': username, 'email': 'tom@example.com'},
+                )
+
+    def test_static_template(self):
+        self.assert_renders_like_the_template("{% load static %}<p>Hello &amp; welcome</p>", {})
+
+    def test_missing_variable_renders_empty(self):
+        self.assert_renders_like_the_template("<p>{{ city }}|{{ username }}</p>", {'username': "tom"})
+
+    def test_falls_back_for_anything_but_plain_variables(self):
+        for source in [
+            "{% if username %}<p>Hi {{ username }}</p>{% endif %}",
+            "<p>Hi {{ username|upper }}</p>",
+            "<p>Hi {{ username.title }}</p>",
+            "<p>Hi {{ username|default:'there' }}</p>",
+            "<p>{% now 'Y' %}</p>{{ username }}",
+            "{% include 'sender/email_list.html' %}",
+            "{% autoescape off %}{{ username }}{% endautoescape %}",
+        ]:
+            with self.subTest(source=source):
+                self.assertIsNone(split_template(Template(source)))
+
+    def test_attributes_fill_their_slots_in_build_message(self):
+        source = "<p>{{ first_name }} {{ last_name }} ({{ username }}) in {{ city }}; hi {{ first_name }}</p>"
+        template = EmailTemplate(pk=-1, name="Attributes", html_content=source)
+        recipient = UserEmail(username="<tom>", email="tom@example.com")
+        attributes = {'first_name': "Tom & Co", 'last_name': "O'Neil", 'city': "<Paris>", 'username': "ignored"}
+        self.assertIsNotNone(split_template(Template(source)))
+
+        message = build_message(template, recipient, attributes)
+        html = Template(source).render(Context({**attributes, 'username': "<tom>", 'email': "tom@example.com"}))
+        self.assertEqual(message.alternatives[0][0], html)
+        self.assertEqual(message.body, strip_tags(html))
+        self.assertIn("(&lt;tom&gt;)", html)
+        self.assertIn("Tom &amp; Co", html)
+
+
+class SearchTests(TestCase):
+    usernames = [
+        "Alice", "alicia", "Bob Smith", 'say "hi"', "star*name", "100%real", "under_score", "x",
+        "MALICE", "ab", "Ali Baba",
+    ]
+
+    def setUp(self):
+        UserEmail.objects.bulk_create([
+            UserEmail(username=username, email=f"user{n}@{'Example.COM' if n % 2 else 'mail.example.org'}")
+            for n, username in enumerate(self.usernames)
+        ])
+
+    def search(self, query):
+        return set(search_emails(UserEmail.objects.all(), query).values_list('id', flat=True))
+
+    def icontains(self, query):
+        query = query.strip()
+        return set(
+            UserEmail.objects.filter(Q(username__icontains=query) | Q(email__icontains=query)).values_list('id', flat=True)
+        )
+
+    def test_uses_the_index(self):
+        self.assertTrue(search_index_available())
+        self.assertIn("MATCH", str(search_emails(UserEmail.objects.all(), "alice").query))
+        self.assertNotIn("MATCH", str(search_emails(UserEmail.objects.all(), "al").query))
+
+    def test_matches_icontains(self):
+        for query in [
+            "ali", "ALICE", "lic", "example.com", "EXAMPLE", "@mail", "user1", "bob smith", "  bob  ",
+            'say "hi"', '"hi"', '"', 'y "', "star*", "*name", "r*n", "100%", "%re", "under_", "_sc",
+            "a OR b", "ali AND bob", "NOT x", "(ab)", "x", "ab", "a", "zzz", "user10@",
+        ]:
+            with self.subTest(query=query):
+                self.assertEqual(self.search(query), self.icontains(query))
+
+    def test_blank_query_matches_everything(self):
+        self.assertEqual(len(self.search("   ")), len(self.usernames))
+
+    def test_index_follows_updates_and_deletes(self):
+        alice = UserEmail.objects.get(username="Alice")
+        alice.username = "Carol"
+        alice.save()
+        self.assertNotIn(alice.pk, self.search("alice"))
+        self.assertIn(alice.pk, self.search("carol"))
+
+        UserEmail.objects.filter(username="Bob Smith").update(email="robert@work.net")
+        self.assertEqual(self.search("work.net"), self.icontains("work.net"))
+        self.assertEqual(len(self.search("work.net")), 1)
+
+        UserEmail.objects.filter(username__in=["Carol", "MALICE"]).delete()
+        self.assertEqual(self.search("carol"), set())
+        self.assertEqual(self.search("alic"), self.icontains("alic"))
+
+        UserEmail.objects.bulk_create([UserEmail(username="Caroline", email="caroline@example.net")])
+        self.assertEqual(self.search("carol"), self.icontains("carol"))
+        self.assertEqual(len(self.search("carol")), 1)
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        # Several contacts share a username, so the id tie-breaker matters.
+        names = ["bob", "alice", "bob", "carol", "bob", "alice", "dave", "bob", "erin", "alice", "bob"]
+        UserEmail.objects.bulk_create([
+            UserEmail(username=name, email=f"{chr(ord('k') - n)}{n}@example.com") for n, name in enumerate(names)
+        ])
+
+    def walk(self, sort_by, sort_dir, page_size=3):
+        pages = [keyset_paginate(UserEmail.objects.all(), sort_by, sort_dir, page_size)]
+        while pages[-1].has_next:
+            pages.append(keyset_paginate(UserEmail.objects.all(), sort_by, sort_dir, page_size, pages[-1].next_cursor))
+        return pages
+
+    def test_walks_forward_and_back_in_every_order(self):
+        for sort_by in ['id', 'username', 'email']:
+            for sort_dir in ['asc', 'desc']:
+                with self.subTest(sort_by=sort_by, sort_dir=sort_dir):
+                    expected = list(UserEmail.objects.order_by(*ordering_for(sort_by, sort_dir == 'desc')))
+                    pages = self.walk(sort_by, sort_dir)
+                    self.assertEqual([item for page in pages for item in page], expected)
+                    self.assertEqual([len(page) for page in pages], [3, 3, 3, 2])
+                    self.assertFalse(pages[0].has_previous)
+
+                    page = pages[-1]
+                    for previous in reversed(pages[:-1]):
+                        page = keyset_paginate(
+                            UserEmail.objects.all(), sort_by, sort_dir, 3, page.previous_cursor,
+                        )
+                        self.assertEqual(page.items, previous.items)
+                    self.assertFalse(page.has_previous)
+                    self.assertTrue(page.has_next)
+
+    def test_exact_page_boundary_has_no_next(self):
+        pages = self.walk('username', 'asc', page_size=11)
+        self.assertEqual(len(pages), 1)
+        self.assertIsNone(pages[0].next_cursor)
+
+    def test_cursor_from_another_order_starts_over(self):
+        cursor = keyset_paginate(UserEmail.objects.all(), 'username', 'asc', 3).next_cursor
+        for sort_by, sort_dir in [('username', 'desc'), ('email', 'asc'), ('id', 'asc')]:
+            with self.subTest(sort_by=sort_by, sort_dir=sort_dir):
+                page = keyset_paginate(UserEmail.objects.all(), sort_by, sort_dir, 3, cursor)
+                self.assertEqual(page.items, keyset_paginate(UserEmail.objects.all(), sort_by, sort_dir, 3).items)
+                self.assertFalse(page.has_previous)
+
+    def test_ajax_search_pages_with_cursors(self):
+        url = reverse('ajax_search')
+        first = self.client.get(url, {'sort_by': 'username', 'page_size': '4'}).json()
+        second = self.client.get(url, {'sort_by': 'username', 'page_size': '4', 'cursor': first['next_cursor']}).json()
+        self.assertTrue(second['has_previous'])
+        back = self.client.get(
+            url, {'sort_by': 'username', 'page_size': '4', 'cursor': second['previous_cursor']},
+        ).json()
+        self.assertEqual(back['emails'], first['emails'])
+        usernames = [row['username'] for row in first['emails'] + second['emails']]
+        self.assertEqual(usernames, sorted(usernames))
+
+    def test_malformed_cursors(self):
+        bad_cursors = [
+            "not a cursor!",
+            "e30",  # {}
+            encode_cursor(["username:asc", "bob", 1, "next"]),
+            encode_cursor({'s': 'username:asc', 'k': 'bob', 'i': 1}),
+            encode_cursor({'s': 'password:asc', 'k': 'x', 'i': 1, 'd': 'next'}),
+            encode_cursor({'s': 7, 'k': 'bob', 'i': 1, 'd': 'next'}),
+            encode_cursor({'s': 'username:asc', 'k': 'bob', 'i': 1, 'd': 'sideways'}),
+            encode_cursor({'s': 'username:asc', 'k': 5, 'i': 1, 'd': 'next'}),
+            encode_cursor({'s': 'username:asc', 'k': None, 'i': 1, 'd': 'next'}),
+            encode_cursor({'s': 'username:asc', 'k': 'bob', 'i': '1', 'd': 'next'}),
+            encode_cursor({'s': 'username:asc', 'k': 'bob', 'i': True, 'd': 'next'}),
+            encode_cursor({'s': 'id:asc', 'k': '3', 'i': 3, 'd': 'next'}),
+            encode_cursor({'s': 'id:asc', 'k': 3.5, 'i': 3, 'd': 'next'}),
+            encode_cursor({'s': 'id:asc', 'k': [3], 'i': 3, 'd': 'next'}),
+        ]
+        for cursor in bad_cursors:
+            with self.subTest(cursor=cursor):
+                with self.assertRaises(InvalidCursor):
+                    decode_cursor(cursor)
+                response = self.client.get(reverse('ajax_search'), {'sort_by': 'username', 'cursor': cursor})
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.json(), {'error': "Malformed cursor."})
+
+    def test_well_formed_cursor_decodes(self):
+        payload = {'s': 'id:desc', 'k': 3, 'i': 3, 'd': 'prev'}
+        self.assertEqual(decode_cursor(encode_cursor(payload)), payload)
+
+
+class MergeDuplicateEmailsMigrationTests(TransactionTestCase):
+    before = [('sender', '0010_resumable_campaigns')]
+    after = [('sender', '0011_case_insensitive_email')]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        self.migrate(executor.loader.graph.leaf_nodes('sender'))
+
+    def test_keeps_the_oldest_of_each_address(self):
+        apps = self.migrate(self.before)
+        UserEmail = apps.get_model('sender', 'UserEmail')
+        contacts = [
+            UserEmail.objects.create(username=username, email=email)
+            for username, email in [
+                ("ann", "Ann@Example.com"),
+                ("bob", "bob@example.com"),
+                ("ann2", "ann@example.com"),
+                ("ann3", " ANN@example.COM "),
+                ("bob2", "BOB@example.com"),
+                ("cy", " Cy@Example.com"),
+            ]
+        ]
+        template = apps.get_model('sender', 'EmailTemplate').objects.create(name="Template", html_content="<p>Hi</p>")
+        campaign = apps.get_model('sender', 'Campaign').objects.create(template=template)
+        OutboundMessage = apps.get_model('sender', 'OutboundMessage')
+        DeliveryRecord = apps.get_model('sender', 'DeliveryRecord')
+        for contact in contacts:
+            message = OutboundMessage.objects.create(
+                campaign=campaign, recipient=contact, username=contact.username, email=contact.email,
+            )
+            DeliveryRecord.objects.create(
+                campaign=campaign, message=message, recipient=contact, email=contact.email, status='sent',
+                started_at=timezone.now(), finished_at=timezone.now(),
+            )
+        # Whatever the counter said, it is recounted after the merge.
+        apps.get_model('sender', 'Counter').objects.update_or_create(name='recipients', defaults={'value': 99})
+
+        apps = self.migrate(self.after)
+        UserEmail = apps.get_model('sender', 'UserEmail')
+        self.assertEqual(
+            list(UserEmail.objects.order_by('id').values_list('id', 'username', 'email')),
+            [
+                (contacts[0].pk, "ann", "ann@example.com"),
+                (contacts[1].pk, "bob", "bob@example.com"),
+                (contacts[5].pk, "cy", "cy@example.com"),
+            ],
+        )
+        for model_name in ['OutboundMessage', 'DeliveryRecord']:
+            with self.subTest(model=model_name):
+                rows = apps.get_model('sender', model_name).objects.order_by('id')
+                # History is kept; rows of the removed duplicates are detached.
+                self.assertEqual(
+                    list(rows.values_list('recipient_id', flat=True)),
+                    [contacts[0].pk, contacts[1].pk, None, None, None, contacts[5].pk],
+                )
+        self.assertEqual(apps.get_model('sender', 'Counter').objects.get(name='recipients').value, 3)
+
+
+class SuppressionTests(TestCase):
+    def setUp(self):
+        # The process-wide filter remembers ids from rolled back tests.
+        patcher = mock.patch('sender.outbox.get_suppression_filter', return_value=SuppressionFilter())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        UserEmail.objects.bulk_create([UserEmail(username=f"user{n}", email=f"user{n}@example.com") for n in range(5)])
+        self.template = EmailTemplate.objects.create(name="Template", html_content="<p>Hi {{ username }}</p>")
+
+    def test_suppressed_at_enqueue(self):
+        suppress(["User1@Example.com", "user3@example.com", "stranger@example.com"], Suppression.REASON_UNSUBSCRIBE)
+        campaign, queued = enqueue(self.template, UserEmail.objects.all())
+        self.assertEqual(queued, 3)
+        self.assertEqual((campaign.total, campaign.suppressed_count), (5, 2))
+        self.assertEqual(
+            set(OutboundMessage.objects.filter(status=OutboundMessage.STATUS_SUPPRESSED).values_list('email', flat=True)),
+            {"user1@example.com", "user3@example.com"},
+        )
+
+        sent_to = []
+
+        def send(messages):
+            sent_to.extend(message.to[0] for message in messages)
+            return accept_all(messages)
+
+        self.assertEqual(deliver(claim_batch('worker', 10), send=send), (3, 0))
+        self.assertEqual(sorted(sent_to), ["user0@example.com", "user2@example.com", "user4@example.com"])
+        campaign.refresh_from_db()
+        self.assertEqual(campaign.status, Campaign.STATUS_COMPLETED)
+
+    def test_campaign_with_everyone_suppressed_completes_at_once(self):
+        suppress(UserEmail.objects.values_list('email', flat=True), Suppression.REASON_MANUAL)
+        campaign, queued = enqueue(self.template, UserEmail.objects.all())
+        self.assertEqual(queued, 0)
+        campaign.refresh_from_db()
+        self.assertEqual((campaign.suppressed_count, campaign.status), (5, Campaign.STATUS_COMPLETED))
+
+    def test_suppressed_between_enqueue_and_send(self):
+        campaign, queued = enqueue(self.template, UserEmail.objects.all())
+        self.assertEqual(queued, 5)
+        batch = claim_batch('worker', 10)
+        suppress(["USER2@example.com "], Suppression.REASON_COMPLAINT)
+
+        send = mock.Mock(side_effect=accept_all)
+        self.assertEqual(deliver(batch, send=send), (4, 0))
+        self.assertNotIn("user2@example.com", [message.to[0] for message in send.call_args.args[0]])
+        self.assertEqual(OutboundMessage.objects.get(email="user2@example.com").status, OutboundMessage.STATUS_SUPPRESSED)
+        self.assertFalse(DeliveryRecord.objects.filter(email="user2@example.com").exists())
+        campaign.refresh_from_db()
+        self.assertEqual((campaign.sent_count, campaign.suppressed_count), (4, 1))
+        self.assertEqual(campaign.status, Campaign.STATUS_COMPLETED)
+
+    def test_hard_bounces_are_suppressed(self):
+        enqueue(self.template, UserEmail.objects.all())
+        replies = {
+            "user0@example.com": (550, b'5.1.1 No such user'),
+            "user1@example.com": (551, b'5.1.6 User has moved'),
+            "user2@example.com": (553, b'5.1.3 Bad address syntax'),
+            "user3@example.com": (552, b'5.2.2 Mailbox full'),
+            "user4@example.com": (554, b'5.7.1 Rejected'),
+        }
+
+        def bounce(messages):
+            return [
+                DeliveryResult(message, False, smtplib.SMTPRecipientsRefused({message.to[0]: replies[message.to[0]]}))
+                for message in messages
+            ]
+
+        self.assertEqual(deliver(claim_batch('worker', 10), send=bounce), (0, 5))
+        self.assertEqual(
+            dict(Suppression.objects.values_list('email', 'reason')),
+            {
+                "user0@example.com": Suppression.REASON_BOUNCE,
+                "user1@example.com": Suppression.REASON_BOUNCE,
+                "user2@example.com": Suppression.REASON_BOUNCE,
+            },
+        )
+        self.assertEqual(Suppression.objects.get(email="user1@example.com").detail, "5.1.6 User has moved")
+
+    def test_rejected_message_content_is_not_suppressed(self):
+        enqueue(self.template, UserEmail.objects.all())
+
+        def reject(messages):
+            return [DeliveryResult(message, False, smtplib.SMTPDataError(550, b'Content rejected')) for message in messages]
+
+        self.assertEqual(deliver(claim_batch('worker', 10), send=reject), (0, 5))
+        self.assertFalse(Suppression.objects.exists())
+
+
+def upload(name, content):
+    return SimpleUploadedFile(name, content if isinstance(content, bytes) else content.encode('utf-8'))
+
+
+class ImportTestCase(TestCase):
+    def setUp(self):
+        rejects_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(rejects_dir.cleanup)
+        override = self.settings(IMPORT_REJECTS_DIR=rejects_dir.name)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def attributes(self):
+        return {
+            (email, name): value
+            for email, name, value in RecipientAttribute.objects.values_list('recipient__email', 'name', 'value')
+        }
+
+
+class SegmentTests(ImportTestCase):
+    def test_parse(self):
+        self.assertEqual(parse_segment(""), [])
+        self.assertEqual(parse_segment("  Country = DE  "), [Term('country', 'DE', False)])
+        self.assertEqual(
+            parse_segment('country=DE and plan-type!="Pro ""Plus""" AND city="Bad Homburg"'),
+            [Term('country', 'DE', False), Term('plan_type', 'Pro "Plus"', True), Term('city', 'Bad Homburg', False)],
+        )
+        self.assertEqual(parse_segment('note=""'), [Term('note', '', False)])
+
+    def test_parse_errors(self):
+        for text, message in [
+            ("country", "Expected name=value at position 1"),
+            ("=DE", "Expected name=value at position 1"),
+            ("1st=DE", "Expected name=value at position 1"),
+            ("country=DE plan=pro", "Expected AND at position 12"),
+            ("country=DE OR plan=pro", "Expected AND at position 12"),
+            ("country=DE AND", "Expected name=value at position 15"),
+            ('country="DE', "Expected name=value at position 1"),
+        ]:
+            with self.subTest(text=text):
+                with self.assertRaisesMessage(InvalidSegment, message):
+                    parse_segment(text)
+
+    def test_filter(self):
+        import_file(upload("contacts.csv", (
+            "username,email,country,plan\n"
+            "ann,ann@example.com,DE,pro\n"
+            "bob,bob@example.com,DE,free\n"
+            "cy,cy@example.com,FR,pro\n"
+            "dee,dee@example.com,,\n"
+        )))
+
+        def emails(segment):
+            return sorted(filter_segment(UserEmail.objects.all(), segment).values_list('email', flat=True))
+
+        self.assertEqual(len(emails("")), 4)
+        self.assertEqual(emails("country=DE"), ["ann@example.com", "bob@example.com"])
+        self.assertEqual(emails("country=de"), [])
+        self.assertEqual(emails("COUNTRY=DE AND plan=pro"), ["ann@example.com"])
+        # != also matches contacts without the attribute.
+        self.assertEqual(emails("plan!=pro"), ["bob@example.com", "dee@example.com"])
+        self.assertEqual(emails("country!=DE AND plan=pro"), ["cy@example.com"])
+        self.assertEqual(emails("missing=x"), [])
+
+    def test_invalid_segment_is_rejected_before_anything_runs(self):
+        with self.assertRaises(InvalidSegment):
+            Selection(all_matching=True, segment="country")
+        response = self.client.get(reverse('ajax_search'), {'segment': "country=DE plan=pro"})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("Expected AND", response.json()['error'])
+
+
+class AttributeImportTests(ImportTestCase):
+    def test_reimport_updates_attributes_and_skips_blank_cells(self):
+        first = import_file(upload("first.csv", (
+            "Username,Email,Country,Plan Type,\n"
+            "ann,ann@example.com,DE,pro,x\n"
+            "bob,bob@example.com,FR,,y\n"
+        )))
+        self.assertEqual((first.inserted, first.attributes), (2, 3))
+        self.assertEqual(self.attributes(), {
+            ("ann@example.com", 'country'): "DE",
+            ("ann@example.com", 'plan_type'): "pro",
+            ("bob@example.com", 'country'): "FR",
+        })
+
+        second = import_file(upload("second.csv", (
+            "email,username,country,plan_type,city\n"
+            "ANN@example.com,ann,AT,,Wien\n"
+            "bob@example.com,bob,, free ,\n"
+            "cy@example.com,cy,ES,,\n"
+        )))
+        self.assertEqual((second.inserted, second.duplicates, second.attributes), (1, 2, 4))
+        self.assertEqual(self.attributes(), {
+            ("ann@example.com", 'country'): "AT",
+            ("ann@example.com", 'plan_type'): "pro",
+            ("ann@example.com", 'city'): "Wien",
+            ("bob@example.com", 'country'): "FR",
+            ("bob@example.com", 'plan_type'): "free",
+            ("cy@example.com", 'country'): "ES",
+        })
+
+
+class ImporterTests(ImportTestCase):
+    def recipients_counter(self):
+        return Counter.objects.filter(name='recipients').values_list('value', flat=True).first() or 0
+
+    def test_counts_only_rows_actually_inserted(self):
+        # Stored as typed, bypassing save(): the insert conflicts with it
+        # on the case-insensitive constraint.
+        UserEmail.objects.bulk_create([UserEmail(username="old", email="Ann@Example.com")])
+        counter = self.recipients_counter()
+
+        summary = import_file(upload("contacts.csv", (
+            "username,email,country\n"
+            "ann,ann@example.com,DE\n"
+            "bob,bob@example.com,FR\n"
+            "bob again,BOB@example.com,FR\n"
+        )))
+        self.assertEqual((summary.inserted, summary.duplicates, summary.invalid), (1, 2, 0))
+        self.assertEqual(self.recipients_counter(), counter + 1)
+        self.assertEqual(UserEmail.objects.count(), 2)
+        self.assertEqual(self.attributes(), {("Ann@Example.com", 'country'): "DE", ("bob@example.com", 'country'): "FR"})
+
+    CONTACTS_CSV = (
+        "Username , EMAIL\n"
+        "ann, Ann@Example.com \n"
+        "bob,bob@example.com\n"
+        "ann twice,ann@example.com\n"
+        "no address,\n"
+        "broken,not-an-email\n"
+        "spaces,a b@example.com\n"
+        "cy,cy@example.co.uk\n"
+    )
+
+    def assert_contacts_imported(self, summary):
+        self.assertEqual((summary.inserted, summary.duplicates, summary.invalid), (3, 1, 3))
+        self.assertEqual(summary.total, 7)
+        self.assertEqual(
+            list(UserEmail.objects.order_by('email').values_list('username', 'email')),
+            [("ann", "ann@example.com"), ("bob", "bob@example.com"), ("cy", "cy@example.co.uk")],
+        )
+
+    def read_rejects(self, summary):
+        self.assertIsNotNone(summary.rejects_token)
+        with open(RejectsWriter.path_for(summary.rejects_token), newline='', encoding='utf-8') as handle:
+            return list(csv.DictReader(handle))
+
+    def test_csv(self):
+        summary = import_file(upload("contacts.csv", self.CONTACTS_CSV), chunk_size=3)
+        self.assert_contacts_imported(summary)
+        self.assertEqual(
+            [(row['username'], row['email'], row['reason']) for row in self.read_rejects(summary)],
+            [
+                ("no address", "", "missing email"),
+                ("broken", "not-an-email", "invalid email"),
+                ("spaces", "a b@example.com", "invalid email"),
+            ],
+        )
+
+    def test_gzipped_csv(self):
+        summary = import_file(upload("contacts.csv.gz", gzip.compress(self.CONTACTS_CSV.encode('utf-8'))))
+        self.assert_contacts_imported(summary)
+
+    def test_excel(self):
+        workbook = openpyxl.Workbook()
+        sheet = workbook.active
+        for line in self.CONTACTS_CSV.splitlines():
+            sheet.append(line.split(',', 1))
+        content = BytesIO()
+        workbook.save(content)
+        summary = import_file(upload("contacts.xlsx", content.getvalue()), chunk_size=2)
+        self.assert_contacts_imported(summary)
+        self.assertEqual(len(self.read_rejects(summary)), 3)
+
+    @skipUnless(importlib.util.find_spec('pyarrow'), "pyarrow is not installed")
+    def test_parquet(self):
+        rows = list(csv.reader(StringIO(self.CONTACTS_CSV)))
+        content = BytesIO()
+        pd.DataFrame(rows[1:], columns=rows[0]).to_parquet(content)
+        summary = import_file(upload("contacts.parquet", content.getvalue()), chunk_size=3)
+        self.assert_contacts_imported(summary)
+
+    def test_clean_file_writes_no_rejects(self):
+        summary = import_file(upload("contacts.csv", "username,email\nann,ann@example.com\n"))
+        self.assertEqual(summary.inserted, 1)
+        self.assertIsNone(summary.rejects_token)
+
+    def test_missing_column(self):
+        with self.assertRaisesMessage(ValueError, "Missing required column(s): email"):
+            import_file(upload("contacts.csv", "username,mail\nann,ann@example.com\n"))
+        self.assertFalse(UserEmail.objects.exists())
+
+
+class DailyQuotaTests(TestCase):
+    def setUp(self):
+        UserEmail.objects.bulk_create([UserEmail(username=f"user{n}", email=f"user{n}@example.com") for n in range(6)])
+        template = EmailTemplate.objects.create(name="Template", html_content="<p>Hi</p>")
+        self.campaign, _ = enqueue(template, UserEmail.objects.all())
+
+    def record(self, status, relay='default', hours_ago=1):
+        finished = timezone.now() - timedelta(hours=hours_ago)
+        DeliveryRecord.objects.create(
+            campaign=self.campaign, email="user0@example.com", status=status, relay=relay,
+            started_at=finished, finished_at=finished,
+        )
+
+    def test_every_attempt_counts(self):
+        self.record(DeliveryRecord.STATUS_SENT)
+        self.record(DeliveryRecord.STATUS_DEFERRED)
+        self.record(DeliveryRecord.STATUS_FAILED, relay='backup')
+        self.record(DeliveryRecord.STATUS_SENT, hours_ago=25)
+        self.assertEqual(daily_remaining(10), 7)
+        self.assertIsNone(daily_remaining(None))
+
+        claim_batch('worker', 2)
+        self.assertEqual(daily_remaining(10), 5)
+        self.assertEqual(daily_remaining(4), 0)
+
+    def test_relay_quota_counts_its_own_attempts(self):
+        self.record(DeliveryRecord.STATUS_SENT)
+        self.record(DeliveryRecord.STATUS_DEFERRED)
+        self.record(DeliveryRecord.STATUS_FAILED)
+        self.record(DeliveryRecord.STATUS_SENT, relay='backup')
+        self.record(DeliveryRecord.STATUS_FAILED, hours_ago=30)
+        self.assertEqual(Relay('default', {}, per_day=5).remaining_today(), 2)
+        self.assertEqual(Relay('backup', {}, per_day=5).remaining_today(), 4)
+        self.assertEqual(Relay('default', {}, per_day=2).remaining_today(), 0)
+        self.assertIsNone(Relay('default', {}).remaining_today())
+
+    def test_claims_stop_at_the_quota(self):
+        for _ in range(3):
+            self.record(DeliveryRecord.STATUS_DEFERRED)
+        claim = functools.partial(claim_batch, 'worker')
+        self.assertEqual(len(claim_within_quota(claim, 10, 5)), 2)
+        self.assertEqual(claim_within_quota(claim, 10, 5), [])
+        self.assertEqual(len(claim_within_quota(claim, 10, 5, relay_remaining=lambda: 1)), 0)
+        self.assertEqual(len(claim_within_quota(claim, 10, None, relay_remaining=lambda: 1)), 1)
+
+
+class MetricsTests(TestCase):
+    def stage_counts(self):
+        return {name: metrics.STAGE_SECONDS.count(stage=name) for name in ['connect', 'handshake', 'transmit']}
+
+    def assert_one_session(self, before, messages):
+        after = self.stage_counts()
+        self.assertEqual(after['connect'] - before['connect'], 1)
+        self.assertEqual(after['handshake'] - before['handshake'], 1)
+        self.assertEqual(after['transmit'] - before['transmit'], messages)
+
+    def test_connect_and_handshake_are_timed_separately(self):
+        before = self.stage_counts()
+        with SMTPSink() as sink:
+            send_batch(make_messages(3), connection=DynamicSMTPBackend(relay=relay_config(sink)))
+        self.assert_one_session(before, 3)
+
+    def test_async_engine_times_the_same_stages(self):
+        before = self.stage_counts()
+        with SMTPSink() as sink:
+            asyncio.run(AsyncDeliveryEngine(config=relay_config(sink), concurrency=1).deliver(make_messages(3)))
+        self.assert_one_session(before, 3)
+
+    def test_web_endpoint_only_reports_the_queue(self):
+        metrics.MESSAGES_SENT.inc()
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        body = response.content.decode()
+        self.assertIn('sender_outbox_messages{status="pending"} 0', body)
+        self.assertNotIn('sender_messages_sent_total', body)
+        self.assertNotIn('sender_stage_seconds', body)
+        self.assertIn('sender_messages_sent_total', metrics.render())
+
+
+class ProgressStreamTests(TestCase):
+    def setUp(self):
+        UserEmail.objects.bulk_create([UserEmail(username=f"user{n}", email=f"user{n}@example.com") for n in range(3)])
+        template = EmailTemplate.objects.create(name="Template", html_content="<p>Hi</p>")
+        self.campaign, _ = enqueue(template, UserEmail.objects.all())
+
+    def read_stream(self):
+        response = self.client.get(reverse('campaign_progress_stream', args=[self.campaign.pk]))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        started = time.monotonic()
+        body = b''.join(response.streaming_content).decode()
+        return body, time.monotonic() - started
+
+    def test_wsgi_stream_answers_once_and_closes(self):
+        body, elapsed = self.read_stream()
+        self.assertLess(elapsed, 1)
+        self.assertTrue(body.startswith("retry: 3000\n\n"))
+        self.assertEqual(body.count("event: progress"), 1)
+        self.assertIn('"remaining": 3', body)
+
+    def test_wsgi_stream_duration_is_configurable(self):
+        with self.settings(PROGRESS_WSGI_STREAM_SECONDS=0.3, PROGRESS_REFRESH_SECONDS=0.1):
+            body, elapsed = self.read_stream()
+        self.assertGreaterEqual(elapsed, 0.3)
+        self.assertLess(elapsed, 2)
+        self.assertEqual(body.count("event: progress"), 1)
+
+    def test_unknown_campaign(self):
+        response = self.client.get(reverse('campaign_progress_stream', args=[self.campaign.pk + 1]))
+        self.assertEqual(response.status_code, 404)
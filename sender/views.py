@@ -1,31 +1,35 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.views.generic import ListView
-from django.db.models import Q
-from django.core.mail import EmailMultiAlternatives
-from django.utils.html import strip_tags
 from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
 from django.contrib import messages
-from django.core.paginator import Paginator
 from django.db import IntegrityError
-from django.http import JsonResponse
-from django.template import Template, Context
-import pandas as pd
-import smtplib
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.html import format_html
+import json
 import logging
-import traceback
+import os
 
-from .models import UserEmail, EmailTemplate, SiteSettings
+from .models import UserEmail, EmailTemplate, SiteSettings, Campaign
 from .forms import UploadExcelForm, EmailTemplateForm, AddEmailForm, SiteSettingsForm
+from . import metrics, outbox, stats
+from .importers import RejectsWriter, import_file
+from .progress import ProgressStream, get_progress, wsgi_stream_seconds
+from .search import search_emails
+from .segments import InvalidSegment, filter_segment
+from .selection import Selection, delete_selection
+from .site_config import get_site_settings
+from .pagination import (
+    MAX_PAGE_SIZE, InvalidCursor, keyset_paginate, normalise_sort, ordering_for, parse_page_size,
+)
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
 def dashboard(request):
-    emails = UserEmail.objects.all()
-    last_upload = UserEmail.objects.order_by('-id').first()
     return render(request, 'sender/dashboard.html', {
-        'emails': emails,
-        'last_upload': last_upload
+        'stats': stats.get_dashboard_stats(),
     })
 
 def upload_excel(request):
@@ -33,66 +37,100 @@ def upload_excel(request):
         form = UploadExcelForm(request.POST, request.FILES)
         if form.is_valid():
             excel_file = request.FILES['excel_file']
-            df = pd.read_excel(excel_file)
-            for _, row in df.iterrows():
-                username = row['username']
-                email = row['email']
-                if not UserEmail.objects.filter(email=email).exists():
-                    UserEmail.objects.create(username=username, email=email)
-            messages.success(request, "Excel file uploaded and emails saved.")
-            return redirect('email_list')
+            try:
+                summary = import_file(excel_file)
+            except ValueError as e:
+                form.add_error('excel_file', str(e))
+            else:
+                messages.success(request, f"File uploaded: {summary}.")
+                if summary.rejects_token:
+                    request.session['import_rejects'] = (
+                        request.session.get('import_rejects', [])[-9:] + [summary.rejects_token]
+                    )
+                    messages.warning(
+                        request,
+                        format_html(
+                            'Some rows were rejected. <a href="{}" class="underline">Download rejected rows</a>.',
+                            reverse('download_rejects', args=[summary.rejects_token]),
+                        ),
+                    )
+                return redirect('email_list')
     else:
         form = UploadExcelForm()
     return render(request, 'sender/upload_excel.html', {'form': form})
 
+def download_rejects(request, token):
+    if token not in request.session.get('import_rejects', []):
+        raise Http404("No such import report.")
+    path = RejectsWriter.path_for(token)
+    if not os.path.exists(path):
+        raise Http404("This import report has expired.")
+    return FileResponse(open(path, 'rb'), as_attachment=True, filename=f"rejected_rows_{token[:8]}.csv")
+
 class EmailListView(ListView):
     model = UserEmail
     template_name = 'sender/email_list.html'
     context_object_name = 'emails'
-    paginate_by = 10  # Default pagination
 
     def get_queryset(self):
         queryset = super().get_queryset()
         query = self.request.GET.get('q')
-        sort_by = self.request.GET.get('sort_by', 'id')
-        sort_dir = self.request.GET.get('sort_dir', 'asc')
         if query:
-            queryset = queryset.filter(
-                Q(username__icontains=query) | Q(email__icontains=query)
-            )
-        return queryset.order_by(f'{"-" if sort_dir == "desc" else ""}{sort_by}')
+            queryset = search_emails(queryset, query)
+        segment = self.request.GET.get('segment')
+        if segment:
+            try:
+                queryset = filter_segment(queryset, segment)
+            except InvalidSegment as e:
+                messages.error(self.request, str(e))
+        return queryset
 
-    def get_paginate_by(self, queryset):
+    def get_context_data(self, **kwargs):
         page_size = self.request.GET.get('page_size', '10')
-        if page_size == 'all':
-            return None  # No pagination for 'All'
+        # 'All' is streamed by the page's script; render the first rows meanwhile.
+        size = parse_page_size(MAX_PAGE_SIZE if page_size == 'all' else page_size)
+        sort_by = self.request.GET.get('sort_by', 'id')
+        sort_dir = self.request.GET.get('sort_dir', 'asc')
         try:
-            return int(page_size)
-        except ValueError:
-            return 10  # Fallback to default
-
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        context['total'] = UserEmail.objects.count()
-        context['page_size'] = self.request.GET.get('page_size', '10')
+            page = keyset_paginate(self.object_list, sort_by, sort_dir, size, self.request.GET.get('cursor'))
+            page_number = max(1, int(self.request.GET.get('page', 1)))
+        except (InvalidCursor, ValueError):
+            page = keyset_paginate(self.object_list, sort_by, sort_dir, size)
+            page_number = 1
+
+        context = super().get_context_data(object_list=page.items, **kwargs)
+        context['page'] = page
+        context['is_paginated'] = page.has_next or page.has_previous
+        context['page_number'] = page_number
+        context['row_offset'] = (page_number - 1) * size
+        if self.request.GET.get('q') or self.request.GET.get('segment'):
+            context['total'] = self.object_list.count()
+        else:
+            context['total'] = stats.get_dashboard_stats()['total_recipients']
+        context['num_pages'] = max(1, -(-context['total'] // size))
+        context['page_size'] = page_size
+        context['segment'] = self.request.GET.get('segment', '')
         return context
 
 def delete_email(request, pk):
     email = get_object_or_404(UserEmail, pk=pk)
     email.delete()
+    stats.recipients_removed(1)
     messages.success(request, f"Email {email.email} deleted successfully.")
     return redirect('email_list')
 
 def bulk_delete(request):
     if request.method == 'POST':
-        email_ids = request.POST.getlist('email_ids')
-        if not email_ids:
+        try:
+            selection = Selection.from_post(request.POST)
+        except InvalidSegment as e:
+            messages.error(request, str(e))
+            return redirect('email_list')
+        if not selection:
             messages.warning(request, "No emails selected.")
             return redirect('email_list')
 
-        emails = UserEmail.objects.filter(id__in=email_ids)
-        count = emails.count()
-        emails.delete()
+        count = delete_selection(selection)
         messages.success(request, f"{count} emails deleted successfully.")
     return redirect('email_list')
 
@@ -117,62 +155,38 @@ def send_emails(request):
         return redirect('edit_template')
 
     emails = UserEmail.objects.all()
+    segment = request.GET.get('segment', '')
+    try:
+        emails = filter_segment(emails, segment)
+    except InvalidSegment as e:
+        messages.error(request, str(e))
+        return redirect('email_list')
     if not emails.exists():
-        messages.warning(request, "No recipients found in the system.")
+        if segment:
+            messages.warning(request, "No recipients match this segment.")
+        else:
+            messages.warning(request, "No recipients found in the system.")
         return redirect('email_list')
 
-    try:
-        SiteSettings.objects.get()  # Check if settings exist
-    except SiteSettings.DoesNotExist:
+    if get_site_settings() is None:
         messages.error(request, "Email settings are not configured. Please configure them in Settings.")
         return redirect('site_settings')
 
-    # Pagination setup for batching
-    paginator = Paginator(emails, 50)  # Send 50 per batch
-    page_number = request.GET.get("page", 1)
-    page_obj = paginator.get_page(page_number)
-
-    failed_emails = []
-    for user_email in page_obj.object_list:
-        context = {'username': user_email.username}
-        html_content = Template(template.html_content).render(Context(context))
-        text_content = strip_tags(html_content)
-
-        msg = EmailMultiAlternatives(
-            subject="Hello from Django App",
-            body=text_content,
-            from_email=None,  # Use dynamic DEFAULT_FROM_EMAIL from SiteSettings
-            to=[user_email.email]
-        )
-        msg.attach_alternative(html_content, "text/html")
-        try:
-            msg.send()
-        except smtplib.SMTPException as smtp_e:
-            error_msg = f"SMTP error sending to {user_email.email}: {str(smtp_e)}"
-            logger.error(f"{error_msg}\n{traceback.format_exc()}")
-            failed_emails.append(error_msg)
-        except Exception as e:
-            error_msg = f"Unexpected error sending to {user_email.email}: {str(e)}"
-            logger.error(f"{error_msg}\n{traceback.format_exc()}")
-            failed_emails.append(error_msg)
-
-    if failed_emails:
-        messages.error(request, f"Failed to send some emails: {'; '.join(failed_emails)}")
-        return redirect('email_list')
-
-    # If there's another page, redirect to it
-    if page_obj.has_next():
-        next_url = f"{request.path}?page={page_obj.next_page_number()}"
-        messages.info(request, f"Batch {page_number} processed. Continuing to next batch...")
-        return redirect(next_url)
-
-    messages.success(request, "All emails processed successfully!")
-    return redirect('email_list')
+    # Delivery happens in the send_outbox worker, not in this request
+    campaign, queued = outbox.enqueue(template, emails)
+    messages.success(request, f"Queued {queued} emails for delivery (campaign #{campaign.pk}).")
+    if campaign.suppressed_count:
+        messages.info(request, f"Skipped {campaign.suppressed_count} suppressed addresses.")
+    return redirect('campaign_progress', pk=campaign.pk)
 
 def send_selected(request):
     if request.method == 'POST':
-        email_ids = request.POST.getlist('email_ids')
-        if not email_ids:
+        try:
+            selection = Selection.from_post(request.POST)
+        except InvalidSegment as e:
+            messages.error(request, str(e))
+            return redirect('email_list')
+        if not selection:
             messages.warning(request, "No emails selected.")
             return redirect('email_list')
 
@@ -181,48 +195,47 @@ def send_selected(request):
             messages.error(request, "No email template found. Please create one before sending emails.")
             return redirect('edit_template')
 
-        try:
-            SiteSettings.objects.get()  # Check if settings exist
-        except SiteSettings.DoesNotExist:
+        if get_site_settings() is None:
             messages.error(request, "Email settings are not configured. Please configure them in Settings.")
             return redirect('site_settings')
 
-        emails = UserEmail.objects.filter(id__in=email_ids)
-        if not emails.exists():
+        campaign, queued = outbox.enqueue_selection(template, selection)
+        if not queued:
+            # Nothing selected still exists or can be sent to; don't leave an
+            # empty campaign behind.
+            campaign.delete()
             messages.warning(request, "No valid recipients selected.")
             return redirect('email_list')
 
-        failed_emails = []
-        for user_email in emails:
-            context = {'username': user_email.username}
-            html_content = Template(template.html_content).render(Context(context))
-            text_content = strip_tags(html_content)
-
-            msg = EmailMultiAlternatives(
-                subject="Hello from Django App",
-                body=text_content,
-                from_email=None,  # Use dynamic DEFAULT_FROM_EMAIL from SiteSettings
-                to=[user_email.email]
-            )
-            msg.attach_alternative(html_content, "text/html")
-            try:
-                msg.send()
-            except smtplib.SMTPException as smtp_e:
-                error_msg = f"SMTP error sending to {user_email.email}: {str(smtp_e)}"
-                logger.error(f"{error_msg}\n{traceback.format_exc()}")
-                failed_emails.append(error_msg)
-            except Exception as e:
-                error_msg = f"Unexpected error sending to {user_email.email}: {str(e)}"
-                logger.error(f"{error_msg}\n{traceback.format_exc()}")
-                failed_emails.append(error_msg)
-
-        if failed_emails:
-            messages.error(request, f"Failed to send some emails: {'; '.join(failed_emails)}")
-            return redirect('email_list')
-
-        messages.success(request, f"Emails sent to {len(emails) - len(failed_emails)} selected recipients successfully!")
+        messages.success(request, f"Queued {queued} selected recipients for delivery (campaign #{campaign.pk}).")
+        if campaign.suppressed_count:
+            messages.info(request, f"Skipped {campaign.suppressed_count} suppressed addresses.")
+        return redirect('campaign_progress', pk=campaign.pk)
     return redirect('email_list')
 
+def campaign_progress(request, pk):
+    campaign = get_object_or_404(Campaign.objects.select_related('template'), pk=pk)
+    return render(request, 'sender/campaign_progress.html', {
+        'campaign': campaign,
+        'progress': get_progress(campaign.pk),
+    })
+
+def campaign_progress_stream(request, pk):
+    """
+    Server-Sent Events with a campaign's sent/failed/remaining counts and rate.
+    """
+    if get_progress(pk) is None:
+        raise Http404("No such campaign.")
+    if isinstance(request, ASGIRequest):
+        events = ProgressStream(pk).aevents()
+    else:
+        events = ProgressStream(pk, duration=wsgi_stream_seconds()).events()
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Stop nginx from buffering the stream.
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
 def edit_template(request):
     template, created = EmailTemplate.objects.get_or_create(name="Default Template")
     if request.method == 'POST':
@@ -252,38 +265,64 @@ def ajax_search(request):
     sort_by = request.GET.get('sort_by', 'id')
     sort_dir = request.GET.get('sort_dir', 'asc')
     page_size = request.GET.get('page_size', '10')
-    page = request.GET.get('page', 1)
-
-    emails = UserEmail.objects.filter(
-        Q(username__icontains=query) | Q(email__icontains=query)
-    ).order_by(f'{"-" if sort_dir == "desc" else ""}{sort_by}')
 
-    if page_size == 'all':
-        paginated_emails = emails
-        page_obj = None
-    else:
-        paginator = Paginator(emails, int(page_size))
-        try:
-            page_obj = paginator.page(page)
-            paginated_emails = page_obj.object_list
-        except:
-            page_obj = None
-            paginated_emails = []
+    segment = request.GET.get('segment', '')
+    try:
+        emails = filter_segment(search_emails(UserEmail.objects.all(), query), segment)
+        page = keyset_paginate(
+            emails,
+            sort_by,
+            sort_dir,
+            parse_page_size(MAX_PAGE_SIZE if page_size == 'all' else page_size),
+            request.GET.get('cursor'),
+        )
+    except (InvalidCursor, InvalidSegment) as e:
+        return JsonResponse({'error': str(e)}, status=400)
 
     data = [
         {
             'id': e.id,
             'username': e.username,
             'email': e.email,
-        } for e in paginated_emails
+        } for e in page
     ]
 
     response = {
         'emails': data,
-        'total': emails.count(),
-        'page': int(page) if page_obj else 1,
-        'has_next': page_obj.has_next() if page_obj else False,
-        'has_previous': page_obj.has_previous() if page_obj else False,
-        'num_pages': page_obj.paginator.num_pages if page_obj else 1,
+        'total': emails.count() if query or segment else stats.get_dashboard_stats()['total_recipients'],
+        'has_next': page.has_next,
+        'has_previous': page.has_previous,
+        'next_cursor': page.next_cursor,
+        'previous_cursor': page.previous_cursor,
     }
-    return JsonResponse(response)
\ No newline at end of file
+    return JsonResponse(response)
+
+def ajax_search_stream(request):
+    """
+    Stream every matching row as newline-delimited JSON for the 'All' view.
+    """
+    sort_by, descending = normalise_sort(
+        request.GET.get('sort_by', 'id'), request.GET.get('sort_dir', 'asc')
+    )
+    emails = search_emails(UserEmail.objects.all(), request.GET.get('q', ''))
+    try:
+        emails = filter_segment(emails, request.GET.get('segment', ''))
+    except InvalidSegment as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    rows = emails.order_by(*ordering_for(sort_by, descending)).values('id', 'username', 'email')
+
+    def lines():
+        for row in rows.iterator(chunk_size=2000):
+            yield json.dumps(row) + '\n'
+
+    return StreamingHttpResponse(lines(), content_type='application/x-ndjson')
+
+def metrics_view(request):
+    """
+    Prometheus text exposition of the outbox depth, by status.
+
+    The web server doesn't send, so the send metrics (stage timings,
+    messages, connections, relays) are left out rather than shown as zeros:
+    they live in each send_outbox worker, scraped on its --metrics-port.
+    """
+    return HttpResponse(metrics.render(collected_only=True), content_type=metrics.CONTENT_TYPE)